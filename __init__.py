@@ -4,7 +4,10 @@
 from trytond.pool import Pool
 from . import aeat
 from . import invoice
+from . import ir
 from . import move
+from . import party
+from . import tax
 
 
 def register():
@@ -17,10 +20,33 @@ def register():
         aeat.TaxCodeRelation,
         aeat.Report,
         aeat.Register,
+        aeat.RegisterMoveLine,
+        aeat.RegisterInvoice,
+        aeat.RegisterArchive,
+        aeat.RegisterArchiveMoveLine,
+        aeat.RegisterArchiveInvoice,
+        aeat.RegisterAll,
+        aeat.RegisterAnalytic,
+        aeat.CalculationChunk,
+        aeat.LedgerChange,
+        aeat.ReportImport,
+        aeat.ImportPayrollStart,
+        aeat.History,
+        aeat.HistoryLine,
         invoice.Invoice,
+        ir.Cron,
+        move.Move,
         move.MoveLine,
+        party.Party,
+        party.PartyIdentifier,
+        party.PartyCanonical,
+        tax.TaxCode,
+        tax.TaxCodeLine,
+        tax.TaxLine,
         module='aeat_111', type_='model')
     Pool.register(
         aeat.CreateChart,
         aeat.UpdateChart,
+        aeat.ExportRegisters,
+        aeat.ImportPayroll,
         module='aeat_111', type_='wizard')
@@ -1,21 +1,45 @@
 # -*- coding: utf-8 -*-
 from decimal import Decimal
+import csv
 import datetime
 import calendar
+import hashlib
+import io
+import logging
+import mmap
+import os
+import tempfile
 import unicodedata
+from collections import Counter, defaultdict
 from itertools import groupby
+from weakref import WeakKeyDictionary
 
 from retrofix import aeat111
+from retrofix.exception import RetrofixException
+from retrofix.fields import Number
 from retrofix.record import Record, write as retrofix_write
-from trytond.model import Workflow, ModelSQL, ModelView, fields, Unique
+from sql import Cast, Column, Literal, Null, Select, Union, Window
+from sql.aggregate import Count, Max, Min, Sum
+from sql.conditionals import Case, Coalesce, NullIf
+from sql.functions import (
+    CurrentTimestamp, Extract, Function, Lag, Round)
+from sql.operators import Exists
+from trytond import backend
+from trytond import config
+from trytond.cache import Cache
+from trytond.model import (
+    Workflow, ModelSQL, ModelView, fields, Unique, Index)
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval, Bool, If
 from trytond.i18n import gettext
-from trytond.exceptions import UserError
+from trytond.exceptions import UserError, UserWarning
+from trytond.tools import grouped_slice, reduce_ids
 from trytond.transaction import Transaction
+from trytond.wizard import Wizard, StateView, StateTransition, Button
 from trytond.modules.currency.fields import Monetary
 
 _ZERO = Decimal("0.0")
+logger = logging.getLogger(__name__)
 
 
 def remove_accents(text):
@@ -25,6 +49,204 @@ def remove_accents(text):
         )
 
 
+def migrate_register_links(Relation, Document, field):
+    'Copy the aeat111_register column of Document into Relation'
+    table = Relation.__table__()
+    document = Document.__table__()
+    cursor = Transaction().connection.cursor()
+    cursor.execute(*table.insert(
+            [table.register, getattr(table, field)],
+            document.select(document.aeat111_register, document.id,
+                where=document.aeat111_register != Null)))
+
+
+# The first key of the advisory locks of the calculations which is a key
+# space apart from the single key locks of Tryton
+_CALCULATION_LOCK = int.from_bytes(
+    hashlib.sha256(b'aeat.111.report.calculation').digest()[:4],
+    'big', signed=True)
+
+
+class TryAdvisoryLock(Function):
+    __slots__ = ()
+    _function = 'pg_try_advisory_xact_lock'
+
+
+class CurrentTransactionId(Function):
+    __slots__ = ()
+    _function = 'pg_current_xact_id'
+
+
+class CurrentSnapshot(Function):
+    __slots__ = ()
+    _function = 'pg_current_snapshot'
+
+
+class VisibleInSnapshot(Function):
+    __slots__ = ()
+    _function = 'pg_visible_in_snapshot'
+
+
+# The snapshot date of the transactions by start
+_snapshot_dates = WeakKeyDictionary()
+
+
+def get_snapshot_date():
+    '''
+    Return the date of the start of the transaction which is before the
+    snapshot of the database it reads.
+    It is the same for all the calls until the transaction commits.
+    '''
+    transaction = Transaction()
+    dates = _snapshot_dates.setdefault(transaction, {})
+    if transaction.started_at not in dates:
+        elapsed = transaction.monotonic_time() - transaction.started_at
+        dates.clear()
+        dates[transaction.started_at] = (datetime.datetime.now()
+            - datetime.timedelta(microseconds=elapsed // 1000))
+    return dates[transaction.started_at]
+
+
+def get_snapshot():
+    '''
+    Return as text the snapshot of the database read by the connection of
+    the transaction or None if the backend has no snapshot.
+    '''
+    if backend.name != 'postgresql':
+        return None
+    cursor = Transaction().connection.cursor()
+    cursor.execute(*Select([Cast(CurrentSnapshot(), 'TEXT')]))
+    return cursor.fetchone()[0]
+
+
+def get_transaction_id():
+    '''
+    Return as text the id of the transaction in the database or None if the
+    backend has no snapshot.
+    '''
+    if backend.name != 'postgresql':
+        return None
+    cursor = Transaction().connection.cursor()
+    cursor.execute(*Select([Cast(CurrentTransactionId(), 'TEXT')]))
+    return cursor.fetchone()[0]
+
+
+def read_fixed(stream, size):
+    '''
+    Read size characters of the fixed width record from the text stream
+    ignoring the line breaks between records.
+    Return less characters only at the end of the stream.
+    '''
+    data = ''
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            break
+        data += chunk.replace('\r', '').replace('\n', '')
+    return data
+
+
+def read_record(line, structure):
+    '''
+    Return the record of structure read from line.
+    Numbers padded with blanks, as written by the reports, are accepted.
+    '''
+    record = Record(structure)
+    for start, length, name, type_ in structure:
+        value = line[start - 1:start - 1 + length]
+        if type_ is Number or isinstance(type_, Number):
+            value = value.strip().rjust(length, '0')
+        record.set_from_file(name, value)
+    return record
+
+
+def tree_closure(rows):
+    '''
+    Return for each id of the (id, parent id) rows of a tree the set of the
+    id and all its descendants
+    '''
+    children = {}
+    for id_, parent_id in rows:
+        children.setdefault(id_, [])
+        if parent_id is not None:
+            children.setdefault(parent_id, []).append(id_)
+
+    closure = {}
+
+    def descendants(id_):
+        if id_ not in closure:
+            # Mark as visited to stop on a malformed tree
+            closure[id_] = {id_}
+            for child_id in children[id_]:
+                closure[id_] |= descendants(child_id)
+        return closure[id_]
+    for id_ in children:
+        descendants(id_)
+    return closure
+
+
+def analyze_mappings(fields, account_links, code_links, closure):
+    '''
+    Return the issues of mappings given as {mapping id: field name}, their
+    (mapping id, account id) and (mapping id, code id) links and the closure
+    of the tax code tree.
+    The issues are tuples starting with their kind:
+        ('account', account id, field names): mapped to several fields
+        ('code', code id, field names): mapped to several fields
+        ('nested', code id, descendant id): both mapped so counted twice
+        ('unused', field name): mapping without account nor code
+    '''
+    issues = []
+    account_fields, code_fields = {}, {}
+    for links, mapped in [
+            (account_links, account_fields),
+            (code_links, code_fields),
+            ]:
+        for mapping_id, record_id in links:
+            mapped.setdefault(record_id, set()).add(fields[mapping_id])
+    for kind, mapped in [('account', account_fields), ('code', code_fields)]:
+        for record_id, names in sorted(mapped.items()):
+            if len(names) > 1:
+                issues.append((kind, record_id, sorted(names)))
+    for code_id in sorted(code_fields):
+        for descendant_id in sorted(closure.get(code_id, set())):
+            if descendant_id != code_id and descendant_id in code_fields:
+                issues.append(('nested', code_id, descendant_id))
+    used = {m for m, _ in account_links} | {m for m, _ in code_links}
+    for mapping_id, name in sorted(fields.items()):
+        if mapping_id not in used:
+            issues.append(('unused', name))
+    return issues
+
+
+def format_mapping_issues(issues, Account, TaxCode):
+    'Return the issues of analyze_mappings as text lines'
+    accounts = {a.id: a for a in Account.browse(
+            [i[1] for i in issues if i[0] == 'account'])}
+    codes = {c.id: c for c in TaxCode.browse(list(
+                {i[1] for i in issues if i[0] == 'code'}
+                | {i[j] for i in issues if i[0] == 'nested' for j in (1, 2)}
+                ))}
+    lines = []
+    for issue in issues:
+        if issue[0] == 'account':
+            lines.append(gettext('aeat_111.msg_mapping_account_fields',
+                    account=accounts[issue[1]].rec_name,
+                    fields=', '.join(issue[2])))
+        elif issue[0] == 'code':
+            lines.append(gettext('aeat_111.msg_mapping_code_fields',
+                    code=codes[issue[1]].rec_name,
+                    fields=', '.join(issue[2])))
+        elif issue[0] == 'nested':
+            lines.append(gettext('aeat_111.msg_mapping_code_nested',
+                    code=codes[issue[1]].rec_name,
+                    descendant=codes[issue[2]].rec_name))
+        else:
+            lines.append(gettext('aeat_111.msg_mapping_unused',
+                    field=issue[1]))
+    return lines
+
+
 class TemplateAccountRelation(ModelSQL):
     '''
     AEAT 111 Account Mapping Codes Relation
@@ -89,6 +311,45 @@ class TemplateMapping(ModelSQL):
                 'Field must be unique.')
             ]
 
+    @classmethod
+    def analyze(cls, unused=True):
+        '''
+        Return the issues of the template mappings as text lines
+        If unused is False the mappings without account nor tax code are not
+        reported.
+        '''
+        pool = Pool()
+        Field = pool.get('ir.model.field')
+        AccountRelation = pool.get(
+            'aeat.111.mapping-account.account.template')
+        CodeRelation = pool.get('aeat.111.mapping-account.tax.code.template')
+        AccountTemplate = pool.get('account.account.template')
+        TaxCodeTemplate = pool.get('account.tax.code.template')
+        mapping = cls.__table__()
+        field = Field.__table__()
+        account_relation = AccountRelation.__table__()
+        code_relation = CodeRelation.__table__()
+        code = TaxCodeTemplate.__table__()
+        cursor = Transaction().connection.cursor()
+
+        cursor.execute(*mapping.join(field,
+                condition=mapping.aeat111_field == field.id
+                ).select(mapping.id, field.name))
+        fields = dict(cursor)
+        cursor.execute(*account_relation.select(
+                account_relation.mapping, account_relation.account))
+        account_links = cursor.fetchall()
+        cursor.execute(*code_relation.select(
+                code_relation.mapping, code_relation.code))
+        code_links = cursor.fetchall()
+        cursor.execute(*code.select(code.id, code.parent))
+        closure = tree_closure(cursor)
+        issues = analyze_mappings(
+            fields, account_links, code_links, closure)
+        if not unused:
+            issues = [i for i in issues if i[0] != 'unused']
+        return format_mapping_issues(issues, AccountTemplate, TaxCodeTemplate)
+
     def _get_mapping_value(self, mapping=None):
         pool = Pool()
         Account = pool.get('account.account')
@@ -174,6 +435,7 @@ class UpdateChart(metaclass=PoolMeta):
         if to_create:
             Mapping.create(to_create)
 
+        Mapping.log_analysis(company)
         return ret
 
 
@@ -196,6 +458,7 @@ class CreateChart(metaclass=PoolMeta):
                 to_create.append(vals)
 
         Mapping.create(to_create)
+        Mapping.log_analysis(company)
         return ret
 
 
@@ -278,6 +541,9 @@ class Mapping(ModelSQL, ModelView):
             ('aeat111_field_uniq', Unique(t, t.company, t.aeat111_field),
                 'Field must be unique.')
             ]
+        cls._buttons.update({
+                'check_mappings': {},
+                })
 
     @staticmethod
     def default_company():
@@ -287,6 +553,124 @@ class Mapping(ModelSQL, ModelView):
     def default_debit_credit_type():
         return 'both'
 
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        LedgerChange = pool.get('aeat.111.ledger.change')
+        LedgerChange._mapped_cache.clear()
+        return super().create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        LedgerChange = pool.get('aeat.111.ledger.change')
+        LedgerChange._mapped_cache.clear()
+        super().write(*args)
+
+    @classmethod
+    def delete(cls, mappings):
+        pool = Pool()
+        LedgerChange = pool.get('aeat.111.ledger.change')
+        LedgerChange._mapped_cache.clear()
+        super().delete(mappings)
+
+    @classmethod
+    def analyze(cls, company, unused=True):
+        '''
+        Return the issues of the mappings of the company as text lines
+        If unused is False the mappings without account nor tax code are not
+        reported.
+        '''
+        pool = Pool()
+        Field = pool.get('ir.model.field')
+        AccountRelation = pool.get('aeat.111.mapping-account.account')
+        CodeRelation = pool.get('aeat.111.mapping-account.tax.code')
+        Account = pool.get('account.account')
+        TaxCode = pool.get('account.tax.code')
+        Report = pool.get('aeat.111.report')
+        mapping = cls.__table__()
+        field = Field.__table__()
+        account_relation = AccountRelation.__table__()
+        code_relation = CodeRelation.__table__()
+        account = Account.__table__()
+        code = TaxCode.__table__()
+        cursor = Transaction().connection.cursor()
+
+        company_id = int(company)
+        cursor.execute(*mapping.join(field,
+                condition=mapping.aeat111_field == field.id
+                ).select(mapping.id, field.name,
+                where=mapping.company == company_id))
+        fields = dict(cursor)
+        if not fields:
+            return []
+        mapping_ids = list(fields.keys())
+        cursor.execute(*account_relation.join(account,
+                condition=account_relation.account == account.id
+                ).select(account_relation.mapping, account_relation.account,
+                where=(reduce_ids(account_relation.mapping, mapping_ids)
+                    & (account.company == company_id))))
+        account_links = cursor.fetchall()
+        cursor.execute(*code_relation.join(code,
+                condition=code_relation.code == code.id
+                ).select(code_relation.mapping, code_relation.code,
+                where=(reduce_ids(code_relation.mapping, mapping_ids)
+                    & (code.company == company_id))))
+        code_links = cursor.fetchall()
+        closure = Report._get_tax_code_closure(company_id, active=False)
+        issues = analyze_mappings(
+            fields, account_links, code_links, closure)
+        if not unused:
+            issues = [i for i in issues if i[0] != 'unused']
+        return format_mapping_issues(issues, Account, TaxCode)
+
+    @classmethod
+    @ModelView.button
+    def check_mappings(cls, mappings):
+        'Check the analysis of the mappings of the companies of mappings'
+        for company in {m.company for m in mappings if m.company}:
+            cls.check_analysis(company)
+
+    @classmethod
+    def _get_analysis_issues(cls, company):
+        '''
+        Return the issues of the templates and of the mappings of the company
+        about the accounts and tax codes counted in several fields or twice.
+        The mappings without account nor tax code are left to configure.
+        '''
+        pool = Pool()
+        Template = pool.get('aeat.111.template.mapping')
+        return (Template.analyze(unused=False)
+            + cls.analyze(company, unused=False))
+
+    @classmethod
+    def check_analysis(cls, company):
+        'Raise an error with the issues of the mappings of the company'
+        pool = Pool()
+        Company = pool.get('company.company')
+
+        company = Company(int(company))
+        issues = cls._get_analysis_issues(company)
+        if issues:
+            raise UserError(gettext(
+                    'aeat_111.msg_mapping_analysis',
+                    company=company.rec_name,
+                    issues='\n'.join(issues)))
+
+    @classmethod
+    def log_analysis(cls, company):
+        '''
+        Log the issues of the mappings of the company without raising so the
+        wizards of the chart are not interrupted
+        '''
+        pool = Pool()
+        Company = pool.get('company.company')
+
+        company = Company(int(company))
+        for issue in cls._get_analysis_issues(company):
+            logger.warning(
+                "AEAT 111 mapping of %s: %s", company.rec_name, issue)
+
     @classmethod
     def get_code_by_companies(cls, records, name):
         user_company = Transaction().context.get('company')
@@ -312,18 +696,61 @@ class Mapping(ModelSQL, ModelView):
         return res
 
 
+# The order in which the registers of a report are created
+_REGISTER_ORDER = {
+    'work_payment': 0,
+    'work_amount': 1,
+    'economic_activity': 2,
+    }
+
+
+class _RegisterAccumulator:
+    """The amount and documents of a register being calculated
+
+    Amounts read from the database are added as integers in the smallest
+    unit of the currency and only converted to Decimal at the end.
+    The units are kept signed by account as the absolute value is taken of
+    the balance of each account once all its move lines are added.
+    The units of the tax lines are kept by tax code and are already absolute.
+    """
+    __slots__ = ('digits', 'units', 'lines', 'invoices')
+
+    def __init__(self, digits):
+        self.digits = digits
+        self.units = defaultdict(int)
+        self.lines = []
+        self.invoices = []
+
+    @property
+    def amount(self):
+        units = sum(abs(u) for u in self.units.values())
+        return Decimal(units).scaleb(-self.digits)
+
+
+def _get_accumulator(accumulators, type_, party_id, digits):
+    key = (type_, party_id)
+    accumulator = accumulators.get(key)
+    if accumulator is None:
+        accumulator = accumulators[key] = _RegisterAccumulator(digits)
+    return accumulator
+
+
 class Report(Workflow, ModelSQL, ModelView):
     '''
     AEAT 111 Report
     '''
     __name__ = 'aeat.111.report'
 
+    # {company id: [(tax code id, ids of the code and its descendants)]}
+    _tax_code_closure_cache = Cache(__name__ + '.tax_code_closure',
+        context=False)
+
     company = fields.Many2One('company.company', 'Company', required=True,
         states={
             'readonly': Eval('state').in_(['done', 'calculated']),
             })
     currency = fields.Function(fields.Many2One('currency.currency',
-        'Currency'), 'get_currency')
+        'Currency'), 'get_company_fields')
 
     # DRM11101
     type = fields.Selection([
@@ -493,6 +920,9 @@ class Report(Workflow, ModelSQL, ModelView):
 
     registers = fields.One2Many('aeat.111.report.register', 'report',
         'Registers', readonly=True)
+    archived_registers = fields.One2Many(
+        'aeat.111.report.register.archive', 'report', "Archived Registers",
+        readonly=True)
 
     withholdings_payments_amount = fields.Function(fields.Numeric(
             "Withholding and Payments", digits=(15, 2)),
@@ -500,7 +930,8 @@ class Report(Workflow, ModelSQL, ModelView):
     to_deduce = fields.Numeric("To Deduce", digits=(15, 2),
         help="Exclusively in case of complementary self-assessment. "
         "Results to be entered from previous self-assessments for the same "
-        "concept, year and period")
+        "concept, year and period. Filled on calculation from the done "
+        "reports of the same company, year and period.")
     result = fields.Function(fields.Numeric("Result", digits=(15, 2)),
         'get_result')
 
@@ -512,7 +943,7 @@ class Report(Workflow, ModelSQL, ModelView):
     company_party = fields.Function(fields.Many2One('party.party',
             'Company Party', context={
                 'company': Eval('company', -1),
-            }), 'on_change_with_company_party')
+            }), 'get_company_fields')
     bank_account = fields.Many2One('bank.account', "Bank Account",
         domain=[
             ('owners', '=', Eval('company_party')),
@@ -527,11 +958,39 @@ class Report(Workflow, ModelSQL, ModelView):
             ('done', 'Done'),
             ('cancelled', 'Cancelled')
             ], "State", readonly=True)
-    calculation_date = fields.DateTime("Calculation Date", readonly=True)
-    file_ = fields.Binary("File", filename='filename', states={
+    calculation_date = fields.Timestamp("Calculation Date", readonly=True)
+    calculation_snapshot = fields.Char("Calculation Snapshot", readonly=True,
+        help="The snapshot of the database the ledger was read from.")
+    calculation_transaction = fields.Char("Calculation Transaction",
+        readonly=True)
+    stale = fields.Function(fields.Boolean("Stale",
+            help="The ledger changed since the report was calculated."),
+        'get_stale', searcher='search_stale')
+    calculation_fingerprint = fields.Char("Calculation Fingerprint",
+        readonly=True)
+    calculation_cache = fields.Dict(None, "Calculation Cache", readonly=True)
+    calculation_registers = fields.One2Many('aeat.111.report.register',
+        'calculation_report', "Calculation Registers", readonly=True,
+        help="The registers of the calculation kept while in draft.")
+    payroll_totals = fields.Dict(None, "Payroll Totals", readonly=True,
+        help="The amounts added to the report by the last payroll import.")
+    register_differences = fields.Text("Register Differences", readonly=True,
+        help="Differences between the calculated amounts and the sum of the "
+        "registers of each type.")
+    file_ = fields.Binary("File", filename='filename', file_id='file_id',
+        states={
             'invisible': Eval('state') != 'done',
             }, readonly=True)
+    file_id = fields.Char("File ID", readonly=True)
+    file_inputs_hash = fields.Char("File Inputs Hash", readonly=True)
+    file_hash = fields.Char("File Hash", readonly=True)
     filename = fields.Function(fields.Char("File Name"), 'get_filename')
+    registers_file = fields.Binary("Registers File",
+        filename='registers_filename', file_id='registers_file_id',
+        readonly=True)
+    registers_file_id = fields.Char("Registers File ID", readonly=True)
+    registers_filename = fields.Function(fields.Char("Registers File Name"),
+        'get_filename')
 
     @classmethod
     def __setup__(cls):
@@ -541,6 +1000,13 @@ class Report(Workflow, ModelSQL, ModelView):
             ('period', 'DESC'),
             ('id', 'DESC'),
             ]
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(t,
+                (t.company, Index.Range()),
+                (t.year, Index.Range()),
+                (t.period, Index.Equality()),
+                (t.state, Index.Equality())))
         cls._buttons.update({
                 'draft': {
                     'invisible': ~Eval('state').in_(['calculated',
@@ -549,6 +1015,9 @@ class Report(Workflow, ModelSQL, ModelView):
                 'calculate': {
                     'invisible': ~Eval('state').in_(['draft']),
                     },
+                'calculate_in_background': {
+                    'invisible': ~Eval('state').in_(['draft']),
+                    },
                 'process': {
                     'invisible': ~Eval('state').in_(['calculated']),
                     },
@@ -580,12 +1049,15 @@ class Report(Workflow, ModelSQL, ModelView):
         Company = pool.get('company.company')
         company_id = cls.default_company()
         if company_id is not None and company_id >= 0:
-            company = Company(company_id)
-            vat_code = company.party.tax_identifier and \
-                company.party.tax_identifier.code or None
-            if vat_code and vat_code.startswith('ES'):
-                return vat_code[2:]
-            return vat_code
+            return cls._get_company_vat(Company(company_id))
+
+    @staticmethod
+    def _get_company_vat(company):
+        vat_code = company.party.tax_identifier and \
+            company.party.tax_identifier.code or None
+        if vat_code and vat_code.startswith('ES'):
+            return vat_code[2:]
+        return vat_code
 
     @staticmethod
     def default_work_productivity_in_kind_parties():
@@ -700,8 +1172,30 @@ class Report(Workflow, ModelSQL, ModelView):
             if tax_identifier and tax_identifier.code.startswith('ES'):
                 return tax_identifier.code[2:]
 
-    def get_currency(self, name):
-        return self.company.currency.id
+    @classmethod
+    def get_company_fields(cls, reports, names):
+        pool = Pool()
+        Company = pool.get('company.company')
+        report = cls.__table__()
+        company = Company.__table__()
+        cursor = Transaction().connection.cursor()
+
+        result = {n: {} for n in names}
+        columns = {
+            'currency': company.currency,
+            'company_party': company.party,
+            }
+        for sub_ids in grouped_slice([r.id for r in reports],
+                backend.MAX_QUERY_PARAMS):
+            cursor.execute(*report.join(company,
+                    condition=report.company == company.id
+                    ).select(report.id,
+                    *[columns[n] for n in names],
+                    where=reduce_ids(report.id, sub_ids)))
+            for row in cursor:
+                for name, value in zip(names, row[1:]):
+                    result[name][row[0]] = value
+        return result
 
     def get_withholdings_payments_amount(self, name=None):
         return (
@@ -721,193 +1215,1163 @@ class Report(Workflow, ModelSQL, ModelView):
     def get_result(self, name):
         return (self.withholdings_payments_amount or _ZERO) - self.to_deduce
 
+    @classmethod
+    def _get_period_months(cls, table):
+        '''
+        Return the SQL expressions of the first and last month of the period
+        of the report table
+        '''
+        start_months, end_months = [], []
+        for period, _ in cls.period.selection:
+            start_date, end_date = cls._get_date_range(2000, period)
+            start_months.append((table.period == period, start_date.month))
+            end_months.append((table.period == period, end_date.month))
+        return Case(*start_months), Case(*end_months)
+
+    @classmethod
+    def _get_stale_query(cls, where=None):
+        '''
+        Return the query of the ids of the reports with ledger changes after
+        their calculation
+        '''
+        pool = Pool()
+        FiscalYear = pool.get('account.fiscalyear')
+        Period = pool.get('account.period')
+        LedgerChange = pool.get('aeat.111.ledger.change')
+        table = cls.__table__()
+        fiscalyear = FiscalYear.__table__()
+        period = Period.__table__()
+        change = LedgerChange.__table__()
+
+        start_month, end_month = cls._get_period_months(table)
+        condition = (table.state.in_(['calculated', 'done'])
+            & (table.calculation_date != Null))
+        if where is not None:
+            condition &= where(table)
+        return table.join(fiscalyear,
+            condition=fiscalyear.company == table.company
+            ).join(period,
+            condition=(period.fiscalyear == fiscalyear.id)
+            & (Extract('YEAR', period.start_date) == table.year)
+            & (Extract('MONTH', period.start_date) >= start_month)
+            & (Extract('YEAR', period.end_date) == table.year)
+            & (Extract('MONTH', period.end_date) <= end_month)
+            ).join(change,
+            condition=(change.period == period.id)
+            & cls._get_stale_condition(table, change)
+            ).select(table.id, where=condition, group_by=[table.id])
+
+    @classmethod
+    def _get_stale_condition(cls, table, change):
+        '''
+        Return the condition of the ledger changes not read by the
+        calculation of the reports
+        '''
+        condition = change.date > table.calculation_date
+        if backend.name == 'postgresql':
+            # The changes are dated by the start of their transaction so
+            # those committed after the snapshot of the calculation are only
+            # found by their transaction.
+            # The changes of the calculating transaction are read by it.
+            snapshot = ((table.calculation_snapshot != Null)
+                & (change.transaction != Null))
+            condition = ((snapshot
+                    & ~VisibleInSnapshot(
+                        Cast(change.transaction, 'xid8'),
+                        Cast(table.calculation_snapshot, 'pg_snapshot'))
+                    & (change.transaction
+                        != Coalesce(table.calculation_transaction, '')))
+                | (~snapshot & condition))
+        return condition
+
+    @classmethod
+    def get_stale(cls, reports, name):
+        cursor = Transaction().connection.cursor()
+
+        result = dict.fromkeys([r.id for r in reports], False)
+        for sub_ids in grouped_slice(
+                list(result.keys()), backend.MAX_QUERY_PARAMS):
+            sub_ids = list(sub_ids)
+            cursor.execute(*cls._get_stale_query(
+                    lambda table: reduce_ids(table.id, sub_ids)))
+            for report_id, in cursor:
+                result[report_id] = True
+        return result
+
+    @classmethod
+    def search_stale(cls, name, clause):
+        _, operator, value = clause
+        if (operator == '=') == bool(value):
+            return [('id', 'in', cls._get_stale_query())]
+        return [('id', 'not in', cls._get_stale_query())]
+
     def get_filename(self, name):
+        if name == 'registers_filename':
+            return 'aeat111-registers-%s-%s.csv' % (self.year, self.period)
         return 'aeat111-%s-%s.txt' % (
             self.year, self.period)
 
+    @classmethod
+    def _get_mappings(cls, company):
+        '''
+        Return the account and tax code mappings of company as two
+        dictionaries:
+            {account id: (field name, debit credit type)}
+            {tax code id: field name}
+        '''
+        pool = Pool()
+        Mapping = pool.get('aeat.111.mapping')
+
+        # Work Productivity
+        mapping_accounts = {}
+        for mapp in Mapping.search([
+                ('type_', '=', 'account'),
+                ('company', '=', company),
+                ]):
+            for account in mapp.account_by_companies:
+                mapping_accounts[account.id] = (mapp.aeat111_field.name,
+                    mapp.debit_credit_type)
+        # Economic Activities
+        mapping_codes = {}
+        for mapp in Mapping.search([
+                ('type_', '=', 'code'),
+                ('company', '=', company),
+                ]):
+            for code in mapp.code_by_companies:
+                mapping_codes[code.id] = mapp.aeat111_field.name
+        return mapping_accounts, mapping_codes
+
+    @classmethod
+    def _get_tax_code_closure(cls, company, active=True):
+        '''
+        Return for each tax code of the company the ids of the code and all
+        its descendants.
+        If active, only the codes active for the dates of the context are
+        included like the child_of of the amount of the codes.
+        '''
+        pool = Pool()
+        TaxCode = pool.get('account.tax.code')
+        table = TaxCode.__table__()
+        company_id = int(company)
+
+        where = table.company == company_id
+        key = (company_id,)
+        if active:
+            from_date, to_date = TaxCode._active_dates()
+            where &= TaxCode.domain_active(
+                ('active', '=', True), {None: (table, None)})
+            key += (from_date.isoformat(), to_date.isoformat())
+        closure = cls._tax_code_closure_cache.get(key)
+        if closure is not None:
+            return {c: set(d) for c, d in closure}
+
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*table.select(table.id, table.parent, where=where))
+        closure = tree_closure(cursor)
+        cls._tax_code_closure_cache.set(key,
+            [(c, sorted(d)) for c, d in closure.items()])
+        return closure
+
+    @staticmethod
+    def _get_date_range(year, period):
+        '''
+        Return the first and last day of the report period
+        '''
+        if 'T' in period:
+            period = period[0]
+            start_month = (int(period) - 1) * 3 + 1
+            end_month = start_month + 2
+        else:
+            start_month = int(period)
+            end_month = start_month
+        lday = calendar.monthrange(year, end_month)[1]
+        return (datetime.date(year, start_month, 1),
+            datetime.date(year, end_month, lday))
+
+    @classmethod
+    def _get_periods(cls, company, year, period):
+        pool = Pool()
+        Period = pool.get('account.period')
+
+        start_date, end_date = cls._get_date_range(year, period)
+        return [p.id for p in Period.search([
+                    ('start_date', '>=', start_date),
+                    ('end_date', '<=', end_date),
+                    ('company', '=', company),
+                    ])]
+
+    @staticmethod
+    def _get_account_totals(mapping_accounts, amounts):
+        '''
+        Return the value of each account mapped field given the
+        {account id: (debit, credit)} amounts
+        '''
+        totals = {}
+        for account_id, (field, debit_credit_type) in (
+                mapping_accounts.items()):
+            debit, credit = amounts.get(account_id, (_ZERO, _ZERO))
+            amount = totals.get(field, _ZERO)
+            if debit_credit_type in ('debit', 'both'):
+                amount += debit
+            if debit_credit_type in ('credit', 'both'):
+                amount -= credit
+            totals[field] = abs(amount)
+        return totals
+
+    @staticmethod
+    def _get_code_totals(mapping_codes, amounts):
+        '''
+        Return the value of each tax code mapped field given the
+        {tax code id: amount} amounts
+        '''
+        totals = {}
+        for code_id, field in mapping_codes.items():
+            amount = totals.get(field, _ZERO) + amounts.get(code_id, _ZERO)
+            totals[field] = abs(amount)
+        return totals
+
+    @classmethod
+    def simulate_mappings(cls, reports, configurations):
+        '''
+        Return for each configuration of mappings, given as the account and
+        tax code mappings returned by _get_mappings, the totals of the mapped
+        fields and the number of parties of the reports as
+        {report id: {field name: amount}} without storing anything.
+        The move lines are aggregated by period, account and party and the
+        tax codes are computed by report once for all the configurations.
+        '''
+        account_ids = {a for accounts, _ in configurations for a in accounts}
+        code_ids = {c for _, codes in configurations for c in codes}
+        # {report id: {(account id, party id): amounts}}
+        report_amounts = {r.id: {} for r in reports}
+        # {report id: {tax code id: (amount, party ids)}}
+        report_codes = {r.id: {} for r in reports}
+        digits = {}
+        for company, company_reports in groupby(
+                sorted(reports, key=lambda r: r.company.id),
+                key=lambda r: r.company):
+            digits[company.id] = company.currency.digits
+            period_reports = {}
+            for report in company_reports:
+                periods = cls._get_periods(
+                    company, report.year, report.period)
+                for period_id in periods:
+                    period_reports.setdefault(period_id, []).append(
+                        report.id)
+                if code_ids:
+                    with Transaction().set_context(periods=periods):
+                        report_codes[report.id] = (
+                            cls._get_simulation_codes(company.id, code_ids))
+            for period_id, account_id, party_id, *amounts in (
+                    cls._get_simulation_amounts(company.id,
+                        list(period_reports), list(account_ids),
+                        digits[company.id])):
+                for report_id in period_reports[period_id]:
+                    totals = report_amounts[report_id].setdefault(
+                        (account_id, party_id), [0] * len(amounts))
+                    for i, amount in enumerate(amounts):
+                        totals[i] += amount
+
+        results = []
+        for mapping_accounts, mapping_codes in configurations:
+            result = {}
+            for report in reports:
+                # {account id: (debit, credit)}
+                amounts = {}
+                parties = set()
+                for (account_id, party_id), (debit, credit, debit_lines,
+                        credit_lines) in report_amounts[report.id].items():
+                    if account_id not in mapping_accounts:
+                        continue
+                    field, debit_credit_type = mapping_accounts[account_id]
+                    account_debit, account_credit = amounts.get(
+                        account_id, (0, 0))
+                    amounts[account_id] = (
+                        account_debit + debit, account_credit + credit)
+                    # Same move lines as the registers of the calculation
+                    lines = {
+                        'debit': debit_lines,
+                        'credit': credit_lines,
+                        }.get(debit_credit_type, 1)
+                    if lines and 'payment' not in field:
+                        parties.add(party_id)
+                # Same accumulation by account as the calculation
+                totals = cls._get_account_totals(mapping_accounts, amounts)
+                result[report.id] = {
+                    f: Decimal(u).scaleb(-digits[report.company.id])
+                    for f, u in totals.items()}
+                result[report.id]['work_productivity_monetary_parties'] = (
+                    len(parties))
+                codes = report_codes[report.id]
+                result[report.id].update(cls._get_code_totals(mapping_codes,
+                        {c: codes[c][0] for c in mapping_codes}))
+                code_parties = set()
+                for code_id in mapping_codes:
+                    code_parties |= codes[code_id][1]
+                result[report.id][
+                    'economic_activities_productivity_monetary_parties'] = (
+                    len(code_parties))
+            results.append(result)
+        return results
+
+    @classmethod
+    def _get_simulation_codes(cls, company_id, code_ids):
+        '''
+        Return for the periods in the context the amount and the canonical
+        parties of the economic activity registers of each tax code as
+        {tax code id: (amount, party ids)}
+        '''
+        pool = Pool()
+        TaxCode = pool.get('account.tax.code')
+
+        closure = cls._get_tax_code_closure(company_id)
+        descendants = set()
+        for code_id in code_ids:
+            descendants |= closure.get(code_id, {code_id})
+        # The amounts of all the codes are computed at once
+        amounts = TaxCode.get_amount(TaxCode.browse(descendants), 'amount')
+        codes = {}
+        for code_id in code_ids:
+            accumulators = {}
+            cls._calculate_code_registers(company_id, code_id, accumulators,
+                amounts=amounts)
+            codes[code_id] = (amounts.get(code_id, _ZERO),
+                {p for _, p in accumulators})
+        return codes
+
+    @staticmethod
+    def _get_simulation_amounts(company_id, period_ids, account_ids, digits):
+        '''
+        Yield for the move lines of the periods and accounts grouped by
+        period, account and canonical party: the debit, the credit as
+        integers in the smallest unit of the currency and the number of
+        lines with debit and with credit.
+        '''
+        pool = Pool()
+        MoveLine = pool.get('account.move.line')
+        Move = pool.get('account.move')
+        PartyCanonical = pool.get('aeat.111.party.canonical')
+        line = MoveLine.__table__()
+        move = Move.__table__()
+        canonical = PartyCanonical.__table__()
+        cursor = Transaction().connection.cursor()
+
+        def units(expression):
+            # Round as SQLite may compute with float
+            return Cast(Round(Sum(expression) * (10 ** digits)), 'BIGINT')
+        party = Coalesce(canonical.canonical, line.party)
+        # The periods and the accounts share the parameters of the query
+        size = backend.MAX_QUERY_PARAMS // 2
+        for sub_periods in grouped_slice(period_ids, size):
+            sub_periods = list(sub_periods)
+            for sub_accounts in grouped_slice(account_ids, size):
+                cursor.execute(*line.join(move,
+                        condition=line.move == move.id
+                        ).join(canonical, 'LEFT',
+                        condition=line.party == canonical.party
+                        ).select(
+                        move.period, line.account, party,
+                        units(line.debit),
+                        units(line.credit),
+                        Sum(Case((line.debit != 0, 1), else_=0)),
+                        Sum(Case((line.credit != 0, 1), else_=0)),
+                        where=reduce_ids(move.period, sub_periods)
+                        & reduce_ids(line.account, sub_accounts)
+                        & (move.company == company_id),
+                        group_by=[move.period, line.account, party]))
+                for row in cursor:
+                    yield row[:3] + tuple(int(v or 0) for v in row[3:])
+
+    @classmethod
+    def _get_calculation_fingerprint(cls, company_id, mapping_accounts,
+            mapping_codes, periods):
+        '''
+        Return a hash of everything the calculation depends on: the mapping,
+        the tree and the lines of the mapped tax codes, the periods, the
+        moves, move lines, tax lines and invoices of the periods and the
+        canonical parties.
+        The records are summarized by their count, last id and last
+        modification so computing it is a single indexed query each.
+        '''
+        pool = Pool()
+        Move = pool.get('account.move')
+        MoveLine = pool.get('account.move.line')
+        TaxLine = pool.get('account.tax.line')
+        Invoice = pool.get('account.invoice')
+        PartyCanonical = pool.get('aeat.111.party.canonical')
+        TaxCodeLine = pool.get('account.tax.code.line')
+        move = Move.__table__()
+        line = MoveLine.__table__()
+        tax_line = TaxLine.__table__()
+        code_line = TaxCodeLine.__table__()
+        invoice = Invoice.__table__()
+        canonical = PartyCanonical.__table__()
+        cursor = Transaction().connection.cursor()
+
+        def summary(table):
+            return [Count(), Max(table.id),
+                Max(Coalesce(table.write_date, table.create_date))]
+
+        values = [
+            sorted(mapping_accounts.items()),
+            sorted(mapping_codes.items()),
+            sorted(periods),
+            ]
+        # The registers are grouped by canonical party
+        cursor.execute(*canonical.select(*summary(canonical)))
+        values.append(cursor.fetchone())
+        if mapping_codes:
+            # The amounts of the codes are those of their descendants
+            # computed from the taxes of their lines
+            with Transaction().set_context(periods=periods):
+                closure = cls._get_tax_code_closure(company_id)
+            code_ids = set()
+            for code_id in sorted(mapping_codes):
+                descendants = closure.get(code_id, {code_id})
+                values.append((code_id, sorted(descendants)))
+                code_ids |= descendants
+            cursor.execute(*code_line.select(*summary(code_line),
+                    where=reduce_ids(code_line.code, list(code_ids))))
+            values.append(cursor.fetchone())
+        if periods:
+            in_periods = reduce_ids(move.period, periods)
+            # The origin of the moves gives the invoices of the tax lines
+            cursor.execute(*move.select(*summary(move), where=in_periods))
+            values.append(cursor.fetchone())
+            if mapping_accounts:
+                cursor.execute(*line.join(move,
+                        condition=line.move == move.id
+                        ).select(*summary(line),
+                        where=(in_periods
+                            & reduce_ids(line.account,
+                                list(mapping_accounts.keys())))))
+                values.append(cursor.fetchone())
+            if mapping_codes:
+                cursor.execute(*tax_line.join(line,
+                        condition=tax_line.move_line == line.id
+                        ).join(move, condition=line.move == move.id
+                        ).select(*summary(tax_line), where=in_periods))
+                values.append(cursor.fetchone())
+                # The party of the invoices gives the party of the registers
+                cursor.execute(*invoice.join(move,
+                        condition=invoice.move == move.id
+                        ).select(*summary(invoice), where=in_periods))
+                values.append(cursor.fetchone())
+        return hashlib.sha256(repr(values).encode('utf-8')).hexdigest()
+
     @classmethod
     @ModelView.button
     @Workflow.transition('calculated')
     def calculate(cls, reports):
+        '''
+        Calculate the reports from the ledger.
+        The ledger is only read, from the snapshot of the transaction or from
+        the replica database, and only the reports, their registers and the
+        links of the registers are written so calculating never waits for nor
+        blocks posting.
+        '''
+        pool = Pool()
+        Register = pool.get('aeat.111.report.register')
+
+        transaction_id = get_transaction_id()
+        to_write = []
+        for report in reports:
+            report._lock_calculation()
+            mapping_accounts, mapping_codes = cls._get_mappings(
+                report.company)
+            periods = cls._get_periods(report.company, report.year,
+                report.period)
+
+            # Nothing changed since another report was calculated
+            fingerprint = report._get_calculation_fingerprint(
+                report.company.id, mapping_accounts, mapping_codes, periods)
+            if report._reuse_calculation(fingerprint):
+                snapshot = get_snapshot()
+            else:
+                if report.registers:
+                    Register.delete(report.registers)
+                fingerprint, snapshot, totals, accumulators = (
+                    cls._read_ledger_from_replica(report.company.id,
+                        mapping_accounts, mapping_codes, periods,
+                        fingerprint=fingerprint))
+                for field, amount in totals.items():
+                    setattr(report, field, amount)
+                report._save_registers(accumulators, mapping_accounts,
+                    mapping_codes, fingerprint)
+            to_write.extend(([report], {
+                        'calculation_date': get_snapshot_date(),
+                        'calculation_snapshot': snapshot,
+                        'calculation_transaction': transaction_id,
+                        }))
+        if to_write:
+            cls.write(*to_write)
+        cls.update_to_deduce(reports)
+        cls.check_registers(reports)
+
+    @classmethod
+    def update_to_deduce(cls, reports):
+        '''
+        Set to deduce of the complementary reports to the sum of the results
+        of the earlier done reports of the same company, year and period.
+        The reports without earlier done report keep their amount as the
+        original declaration may have been filed outside.
+        '''
+        table = cls.__table__()
+        previous = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        reports = [r for r in reports if r.complementary_declaration]
+        amount = sum((Coalesce(getattr(previous, f), 0) for f in [
+                    'work_productivity_monetary_withholdings_amount',
+                    'work_productivity_in_kind_payments_amount',
+                    'economic_activities_productivity_monetary_'
+                    'withholdings_amount',
+                    'economic_activities_productivity_in_kind_payments_amount',
+                    'awards_monetary_withholdings_amount',
+                    'awards_in_kind_payments_amount',
+                    'gains_forestry_exploitation_monetary_withholdings_amount',
+                    'gains_forestry_exploitation_in_kind_payments_amount',
+                    'image_rights_payments_amount',
+                    ]), -Coalesce(previous.to_deduce, 0))
+        to_deduce = {}
+        for sub_ids in grouped_slice(
+                [r.id for r in reports], backend.MAX_QUERY_PARAMS):
+            cursor.execute(*table.join(previous,
+                    condition=(previous.company == table.company)
+                    & (previous.year == table.year)
+                    & (previous.period == table.period)
+                    & (previous.state == 'done')
+                    & (previous.id < table.id)
+                    ).select(table.id, Sum(amount),
+                    where=reduce_ids(table.id, sub_ids),
+                    group_by=[table.id]))
+            for report_id, value in cursor:
+                # SQLite uses float for SUM
+                if not isinstance(value, Decimal):
+                    value = Decimal(str(value or 0))
+                to_deduce[report_id] = value.quantize(Decimal('0.01'))
+        to_write = []
+        for report in reports:
+            if (report.id in to_deduce
+                    and report.to_deduce != to_deduce[report.id]):
+                to_write.extend(([report], {
+                            'to_deduce': to_deduce[report.id],
+                            }))
+        if to_write:
+            cls.write(*to_write)
+
+    def _lock_calculation(self):
+        '''
+        Lock the calculation of the company, year and period until the end
+        of the transaction.
+        If another transaction is calculating it, raise without waiting as
+        the snapshot of the transaction could not see its result.
+        '''
+        if not self._try_lock_calculation():
+            raise UserError(gettext('aeat_111.msg_calculation_locked',
+                    report=self.rec_name))
+
+    def _try_lock_calculation(self):
+        '''
+        Try to take the lock of the calculation and return if it is taken.
+        '''
+        # SQLite serializes the writing transactions
+        if backend.name != 'postgresql':
+            return True
+        cursor = Transaction().connection.cursor()
+        key = '%s,%s,%s' % (self.company.id, self.year, self.period)
+        key = int.from_bytes(
+            hashlib.sha256(key.encode('utf-8')).digest()[:4],
+            'big', signed=True)
+        cursor.execute(*Select([TryAdvisoryLock(_CALCULATION_LOCK, key)]))
+        return cursor.fetchone()[0]
+
+    def _reuse_calculation(self, fingerprint):
+        '''
+        Copy the calculation of another report of the same company, year and
+        period computed from the same ledger.
+        Return True if there is one.
+        '''
+        pool = Pool()
+        Register = pool.get('aeat.111.report.register')
+
+        # The report went back to draft without changes in the ledger
+        if (self.calculation_fingerprint == fingerprint
+                and self.calculation_cache is not None):
+            if self.registers:
+                Register.delete(self.registers)
+            if self.calculation_registers:
+                Register.write(list(self.calculation_registers), {
+                        'report': self.id,
+                        'calculation_report': None,
+                        })
+            for field, value in self.calculation_cache.items():
+                setattr(self, field, value)
+            self.save()
+            return True
+
+        others = self.search([
+                ('id', '!=', self.id),
+                ('company', '=', self.company.id),
+                ('year', '=', self.year),
+                ('period', '=', self.period),
+                ('state', 'in', ['calculated', 'done']),
+                ('calculation_fingerprint', '=', fingerprint),
+                ], order=[('id', 'DESC')])
+        # The archived registers are not copied
+        others = [o for o in others
+            if o.calculation_cache is not None and not o.archived_registers]
+        if not others:
+            return False
+        other = others[0]
+        if self.registers:
+            Register.delete(self.registers)
+        if self.calculation_registers:
+            Register.delete(self.calculation_registers)
+        registers = Register.create([{
+                    'report': self.id,
+                    'type_': r.type_,
+                    'party': r.party.id if r.party else None,
+                    'amount': r.amount,
+                    } for r in other.registers])
+        Register.copy_documents(
+            {o.id: r.id for o, r in zip(other.registers, registers)})
+        for field, value in other.calculation_cache.items():
+            setattr(self, field, value)
+        self.calculation_fingerprint = fingerprint
+        self.calculation_cache = other.calculation_cache
+        self.save()
+        return True
+
+    @classmethod
+    def _read_ledger_from_replica(cls, company_id, mapping_accounts,
+            mapping_codes, periods, fingerprint=None):
+        '''
+        Return the result of _read_ledger from the replica_database of the
+        aeat_111 section or from the current database if there is none.
+        The fingerprint of the current database is only reused when reading
+        from it as the replica may lag behind.
+        '''
+        transaction = Transaction()
+        database_name = config.get('aeat_111', 'replica_database')
+        if not database_name:
+            return cls._read_ledger(company_id, mapping_accounts,
+                mapping_codes, periods, fingerprint=fingerprint)
+        # The replica is read in a transaction and a pool of its own
+        if database_name not in Pool.database_list():
+            with Transaction(new=True).start(
+                    database_name, transaction.user, readonly=True):
+                Pool(database_name).init()
+        with Transaction(new=True).start(database_name, transaction.user,
+                readonly=True, context=transaction.context):
+            Report = Pool().get(cls.__name__)
+            return Report._read_ledger(
+                company_id, mapping_accounts, mapping_codes, periods)
+
+    @classmethod
+    def _read_ledger(cls, company_id, mapping_accounts, mapping_codes,
+            periods, fingerprint=None):
+        '''
+        Return the fingerprint, the snapshot, the totals by field and the
+        register accumulators of the ledger of the periods.
+        The fingerprint is computed if it is not given.
+        Only the ledger is read so it can run on a read-only replica.
+        '''
+        snapshot = get_snapshot()
+        if fingerprint is None:
+            fingerprint = cls._get_calculation_fingerprint(
+                company_id, mapping_accounts, mapping_codes, periods)
+        # The registers keyed by (type, party id)
+        accumulators = {}
+        with Transaction().set_context(periods=periods):
+            totals, amounts = cls._get_totals(
+                company_id, mapping_accounts, mapping_codes)
+            for code_id in mapping_codes:
+                cls._calculate_code_registers(company_id, code_id,
+                    accumulators, amounts=amounts)
+            for account_id, (field, debit_credit_type) in (
+                    mapping_accounts.items()):
+                cls._calculate_account_registers(company_id, account_id,
+                    field, debit_credit_type, periods, accumulators)
+        return fingerprint, snapshot, totals, accumulators
+
+    @classmethod
+    def _get_totals(cls, company_id, mapping_accounts, mapping_codes):
+        '''
+        Return the amounts of the fields of the mappings and of the tax codes
+        for the periods in the context
+        '''
         pool = Pool()
-        Mapping = pool.get('aeat.111.mapping')
-        Period = pool.get('account.period')
         Account = pool.get('account.account')
-        MoveLine = pool.get('account.move.line')
+        TaxCode = pool.get('account.tax.code')
+
+        totals = {}
+        for field, _ in mapping_accounts.values():
+            totals[field] = _ZERO
+        for field in mapping_codes.values():
+            totals[field] = _ZERO
+
+        closure = cls._get_tax_code_closure(company_id)
+        code_ids = set()
+        for code_id in mapping_codes:
+            code_ids |= closure.get(code_id, {code_id})
+        # The amounts of all the codes are computed at once
+        amounts = (TaxCode.get_amount(TaxCode.browse(code_ids), 'amount')
+            if code_ids else {})
+        totals.update(cls._get_code_totals(mapping_codes,
+                {c: amounts.get(c, _ZERO) for c in mapping_codes}))
+
+        accounts = Account.browse(mapping_accounts.keys())
+        totals.update(cls._get_account_totals(mapping_accounts,
+                {a.id: (a.debit, a.credit) for a in accounts}))
+        return totals, amounts
+
+    @classmethod
+    def _calculate_code_registers(cls, company_id, code_id, accumulators,
+            amounts=None):
+        '''
+        Add to the accumulators the economic activity registers of the tax
+        code for the periods in the context
+        '''
+        pool = Pool()
+        Company = pool.get('company.company')
         TaxCode = pool.get('account.tax.code')
         Tax = pool.get('account.tax')
         TaxLine = pool.get('account.tax.line')
-        Invoice = pool.get('account.invoice')
+        PartyCanonical = pool.get('aeat.111.party.canonical')
+
+        digits = Company(company_id).currency.digits
+        closure = cls._get_tax_code_closure(company_id)
+        code_ids = closure.get(code_id, {code_id})
+        if amounts is None:
+            amounts = TaxCode.get_amount(TaxCode.browse(code_ids), 'amount')
+        # To count the number of parties of economic activities
+        # we have to do it from the party in the related moves
+        # of all codes used for the amount calculation
+        # It is expected TaxCode was created from invoices, not
+        # manually.
+        childs = [c for c in code_ids if c in amounts]
+        if len(childs) == 1:
+            children = childs
+        else:
+            children = [c for c in childs
+                if closure.get(c, {c}) == {c} and amounts[c]]
+        # [(child id, invoice id, party id, units)]
+        tax_units = []
+        for child in TaxCode.browse(children):
+            if not child.lines:
+                continue
+            domain = [['OR'] + [x._line_domain for x in child.lines
+                if x.amount == 'tax']]
+            if domain == [['OR']]:
+                continue
+            domain.extend(Tax._amount_domain())
+            tax_units.extend((child.id,) + u
+                for u in cls._get_tax_line_units(
+                    TaxLine.search(domain, query=True), digits))
+        canonicals = PartyCanonical.get_canonical(
+            {p for _, _, p, _ in tax_units})
+        for child_id, invoice_id, party_id, units in tax_units:
+            accumulator = _get_accumulator(accumulators,
+                'economic_activity', canonicals[party_id], digits)
+            # The absolute value is taken of each tax line
+            accumulator.units[child_id] += abs(units)
+            accumulator.invoices.append(invoice_id)
+
+    @classmethod
+    def _calculate_account_registers(cls, company_id, account_id, field,
+            debit_credit_type, periods, accumulators, lines=None):
+        '''
+        Add to the accumulators the work registers of the account or only
+        of its move lines with id between the first and last of lines
+        '''
+        pool = Pool()
+        Company = pool.get('company.company')
         MoveLine = pool.get('account.move.line')
+
+        digits = Company(company_id).currency.digits
+        # To count the number of parties of work
+        # we have to do it from the party in the related moves
+        # of all accounts used for the amount calculation deffined in
+        # the mapping.
+        domain = [
+            ('move.period', 'in', periods),
+            ('account', '=', account_id),
+            ]
+        if lines:
+            domain.extend([
+                    ('id', '>=', lines[0]),
+                    ('id', '<=', lines[1]),
+                    ])
+        if debit_credit_type == 'debit':
+            domain.append(
+                ('debit', '!=', 0),
+                )
+        elif debit_credit_type == 'credit':
+            domain.append(
+                ('credit', '!=', 0),
+                )
+        units = cls._get_move_line_units(
+            MoveLine.search(domain, query=True), digits)
+        payment = 'payment' in field
+        for party_id, group_units in groupby(units, key=lambda u: u[1]):
+            group_units = list(group_units)
+            accumulator = _get_accumulator(accumulators,
+                'work_payment' if payment else 'work_amount',
+                party_id, digits)
+            accumulator.units[account_id] += sum(
+                u for _, _, u in group_units)
+            accumulator.lines.extend(l for l, _, _ in group_units)
+
+    def _save_registers(self, accumulators, mapping_accounts, mapping_codes,
+            fingerprint):
+        '''
+        Create the registers from the accumulators and save the report
+        '''
+        pool = Pool()
         Register = pool.get('aeat.111.report.register')
 
+        # The records are only created once all the amounts are known
+        keys = sorted(accumulators, key=lambda k: _REGISTER_ORDER[k[0]])
+        registers = Register.create([{
+                    'report': self.id,
+                    'type_': type_,
+                    'party': party_id,
+                    'amount': accumulators[type_, party_id].amount,
+                    } for type_, party_id in keys])
+        Register.link_documents(
+            move_lines=[(r.id, l)
+                for r, k in zip(registers, keys)
+                for l in accumulators[k].lines],
+            invoices=[(r.id, i)
+                for r, k in zip(registers, keys)
+                for i in set(accumulators[k].invoices)])
+        parties = Counter(type_ for type_, _ in keys)
+        self.work_productivity_monetary_parties = parties['work_amount']
+        self.economic_activities_productivity_monetary_parties = (
+            parties['economic_activity'])
+        cached_fields = ({f for f, _ in mapping_accounts.values()}
+            | set(mapping_codes.values())
+            | {'work_productivity_monetary_parties',
+                'economic_activities_productivity_monetary_parties'})
+        self.calculation_fingerprint = fingerprint
+        self.calculation_cache = {
+            f: getattr(self, f) for f in cached_fields}
+        if self.calculation_registers:
+            Register.delete(self.calculation_registers)
+        self.save()
+
+    @classmethod
+    @ModelView.button
+    def calculate_in_background(cls, reports):
         for report in reports:
-            # Work Productivity
-            mapping_accounts = {}
-            for mapp in Mapping.search([
-                    ('type_', '=', 'account'),
-                    ('company', '=', report.company),
-                    ]):
-                for account in mapp.account_by_companies:
-                    mapping_accounts[account.id] = (mapp.aeat111_field.name,
-                        mapp.debit_credit_type)
-            # Economic Activities
-            mapping_codes = {}
-            for mapp in Mapping.search([
-                    ('type_', '=', 'code'),
-                    ('company', '=', report.company),
-                    ]):
-                for code in mapp.code_by_companies:
-                    mapping_codes[code.id] = mapp.aeat111_field.name
-
-            year = report.year
-            period = report.period
-            if 'T' in period:
-                period = period[0]
-                start_month = (int(period) - 1) * 3 + 1
-                end_month = start_month + 2
+            cls.__queue__.calculate_chunked([report])
+
+    @classmethod
+    def calculate_chunked(cls, reports):
+        '''
+        Calculate the reports one tax code or range of move lines of an
+        account at a time.
+        Each chunk is committed to the staging table by its own transaction
+        so an interrupted calculation resumes from the last chunk done.
+        The reports are only calculated once all the chunks are done.
+        '''
+        transaction = Transaction()
+        retries = config.getint('aeat_111', 'calculation_retries', default=3)
+
+        for report in reports:
+            if report.state != 'draft':
+                continue
+            mapping_accounts, mapping_codes = cls._get_mappings(
+                report.company)
+            periods = cls._get_periods(report.company, report.year,
+                report.period)
+            for _ in range(retries + 1):
+                with transaction.new_transaction():
+                    sources = cls(report.id)._get_calculation_sources(
+                        mapping_accounts, mapping_codes, periods)
+                for source, start, end in sources:
+                    with transaction.new_transaction():
+                        cls(report.id)._calculate_chunk(source, start, end,
+                            mapping_accounts, mapping_codes, periods)
+                with transaction.new_transaction():
+                    fingerprint = cls._get_calculation_fingerprint(
+                        report.company.id, mapping_accounts, mapping_codes,
+                        periods)
+                    chunks = cls(report.id)._get_calculation_chunks(
+                        fingerprint)
+                    # Otherwise the ledger changed while calculating
+                    if set(chunks) == {(s, b) for s, b, _ in sources}:
+                        cls.calculate_from_chunks([cls(report.id)],
+                            mapping_accounts, mapping_codes, periods)
+                        break
             else:
-                start_month = int(period)
-                end_month = start_month
-            lday = calendar.monthrange(year, end_month)[1]
-            periods = [p.id for p in Period.search([
-                    ('start_date', '>=', datetime.date(year, start_month, 1)),
-                    ('end_date', '<=', datetime.date(year, end_month, lday)),
-                    ('company', '=', report.company),
-                    ])]
+                raise UserError(gettext(
+                        'aeat_111.msg_calculation_ledger_changing',
+                        report=report.rec_name,
+                        retries=retries))
+
+    def _get_calculation_sources(self, mapping_accounts, mapping_codes,
+            periods):
+        '''
+        Return the source, first and last move line of the chunks of the
+        calculation: the tax codes and the ranges of at most
+        calculation_chunk_size move lines of the accounts
+        '''
+        pool = Pool()
+        Move = pool.get('account.move')
+        MoveLine = pool.get('account.move.line')
+        line = MoveLine.__table__()
+        move = Move.__table__()
+        cursor = Transaction().connection.cursor()
+
+        size = config.getint('aeat_111', 'calculation_chunk_size',
+            default=10000)
+        sources = []
+        for account_id in sorted(mapping_accounts):
+            cursor.execute(*line.join(move, condition=line.move == move.id
+                    ).select(line.id,
+                    where=(line.account == account_id)
+                    & reduce_ids(move.period, periods),
+                    order_by=[line.id]))
+            ids = [i for i, in cursor]
+            source = 'account.account,%s' % account_id
+            if not ids:
+                sources.append((source, 0, 0))
+            for i in range(0, len(ids), size):
+                chunk = ids[i:i + size]
+                sources.append((source, chunk[0], chunk[-1]))
+        sources.extend(
+            ('account.tax.code,%s' % c, 0, 0) for c in sorted(mapping_codes))
+        return sources
+
+    def _get_calculation_chunks(self, fingerprint):
+        '''
+        Return the chunks computed from the ledger of the fingerprint by
+        source and delete the others
+        '''
+        pool = Pool()
+        Chunk = pool.get('aeat.111.report.calculation.chunk')
+
+        chunks = Chunk.search([('report', '=', self.id)])
+        Chunk.delete([c for c in chunks if c.fingerprint != fingerprint])
+        return {(str(c.source), c.start): c for c in chunks
+            if c.fingerprint == fingerprint}
 
-            for field, _ in mapping_accounts.values():
-                setattr(report, field, _ZERO)
-            for field in mapping_codes.values():
-                setattr(report, field, _ZERO)
+    def _calculate_chunk(self, source, start, end, mapping_accounts,
+            mapping_codes, periods):
+        pool = Pool()
+        Chunk = pool.get('aeat.111.report.calculation.chunk')
+
+        self._lock_calculation()
+        fingerprint = self._get_calculation_fingerprint(
+            self.company.id, mapping_accounts, mapping_codes, periods)
+        if (source, start) in self._get_calculation_chunks(fingerprint):
+            return
+        accumulators = {}
+        model, id_ = source.split(',')
+        with Transaction().set_context(periods=periods):
+            if model == 'account.account':
+                field, debit_credit_type = mapping_accounts[int(id_)]
+                self._calculate_account_registers(self.company.id, int(id_),
+                    field, debit_credit_type, periods, accumulators,
+                    lines=(start, end))
+            else:
+                self._calculate_code_registers(self.company.id, int(id_),
+                    accumulators)
+        Chunk.create([{
+                    'report': self.id,
+                    'source': source,
+                    'start': start,
+                    'fingerprint': fingerprint,
+                    'snapshot': get_snapshot(),
+                    'registers': Chunk.dump_accumulators(accumulators),
+                    }])
+
+    @classmethod
+    @Workflow.transition('calculated')
+    def calculate_from_chunks(cls, reports, mapping_accounts, mapping_codes,
+            periods):
+        pool = Pool()
+        Chunk = pool.get('aeat.111.report.calculation.chunk')
+        Register = pool.get('aeat.111.report.register')
 
-            work_payment_registers = {}
-            work_amount_registers = {}
-            economic_activities_registers = {}
+        transaction_id = get_transaction_id()
+        to_write = []
+        for report in reports:
+            report._lock_calculation()
+            chunks = Chunk.search([('report', '=', report.id)],
+                order=[('id', 'ASC')])
+            # The registers were read by the transactions of the chunks so
+            # the first one read the oldest ledger
+            calculation_date = min([get_snapshot_date()]
+                + [c.create_date for c in chunks])
+            snapshot = chunks[0].snapshot if chunks else get_snapshot()
+            to_write.extend(([report], {
+                        'calculation_date': calculation_date,
+                        'calculation_snapshot': snapshot,
+                        'calculation_transaction': transaction_id,
+                        }))
+            if report.registers:
+                Register.delete(report.registers)
+            accumulators = {}
+            digits = report.currency.digits
+            for chunk in chunks:
+                Chunk.load_accumulators(chunk.registers, digits, accumulators)
             with Transaction().set_context(periods=periods):
-                for code in TaxCode.browse(mapping_codes.keys()):
-                    value = getattr(report, mapping_codes[code.id])
-                    amount = value + code.amount
-                    setattr(report, mapping_codes[code.id], abs(amount))
-
-                    # To count the number of parties of economic activities
-                    # we have to do it from the party in the related moves
-                    # of all codes used for the amount calculation
-                    # It is expected TaxCode was created from invoices, not
-                    # manually.
-                    children = []
-                    childs = TaxCode.search([
-                            ('parent', 'child_of', [code]),
-                            ])
-                    if len(childs) == 1:
-                        children = childs
-                    else:
-                        for child in childs:
-                            if not child.childs and child.amount:
-                                children.append(child)
-                    for child in children:
-                        if not child.lines:
-                            continue
-                        domain = [['OR'] + [x._line_domain for x in child.lines
-                            if x.amount == 'tax']]
-                        if domain == [['OR']]:
-                            continue
-                        domain.extend(Tax._amount_domain())
-                        for tax_line in TaxLine.search(domain):
-                            if (tax_line.move_line and tax_line.move_line.move
-                                    and isinstance(
-                                        tax_line.move_line.move.origin,
-                                        Invoice)):
-                                invoice = tax_line.move_line.move.origin
-                                party = invoice.party
-                                if party in economic_activities_registers:
-                                    economic_activities_registers[
-                                        party].amount += abs(tax_line.amount)
-                                    economic_activities_registers[
-                                        party].invoices += (invoice,)
-                                else:
-                                    register = Register()
-                                    register.report = report
-                                    register.type_ = 'economic_activity'
-                                    register.party = party
-                                    register.amount = abs(tax_line.amount)
-                                    register.invoices = (invoice,)
-                                    economic_activities_registers[party] = (
-                                        register)
-
-                # To count the number of parties of work
-                # we have to do it from the party in the related moves
-                # of all accounts used for the amount calculation deffined in
-                # the mapping.
-                for account in Account.browse(mapping_accounts.keys()):
-                    field = mapping_accounts[account.id][0]
-                    debit_credit_type = mapping_accounts[account.id][1]
-                    value = getattr(report, field)
-                    amount = value
-                    if debit_credit_type in ('debit', 'both'):
-                        amount += account.debit
-                    if debit_credit_type in ('credit', 'both'):
-                        amount -= account.credit
-                    setattr(report, field, abs(amount))
-                    domain = [
-                        ('move.period', 'in', periods),
-                        ('account', '=', account),
-                        ]
-                    if debit_credit_type == 'debit':
-                        domain.append(
-                            ('debit', '!=', 0),
-                            )
-                    elif debit_credit_type == 'credit':
-                        domain.append(
-                            ('credit', '!=', 0),
-                            )
-                    move_lines = MoveLine.search(domain)
-                    payment = 'payment' in field
-                    for party, group_lines in groupby(move_lines,
-                            key=lambda l: l.party):
-                        lines = list(group_lines)
-                        amount = sum(x.debit - x.credit for x in lines)
-                        if payment and party in work_payment_registers:
-                            work_payment_registers[party].amount += abs(amount)
-                            work_payment_registers[party].move_lines += tuple(lines)
-                        elif not payment and party in work_amount_registers:
-                            work_amount_registers[party].amount += abs(amount)
-                            work_amount_registers[party].move_lines += tuple(lines)
-                        else:
-                            register = Register()
-                            register.report = report
-                            register.amount = abs(amount)
-                            register.move_lines = lines
-                            if payment:
-                                register.type_ = 'work_payment'
-                                work_payment_registers[party] = register
-                            else:
-                                register.type_ = 'work_amount'
-                                work_amount_registers[party] = register
-            registers = []
-            if work_payment_registers:
-                registers.extend(work_payment_registers.values())
-            if work_amount_registers:
-                registers.extend(work_amount_registers.values())
-            if economic_activities_registers:
-                registers.extend(economic_activities_registers.values())
-            if registers:
-                Register.save(registers)
-            report.work_productivity_monetary_parties = (
-                len(work_amount_registers) if work_amount_registers else 0)
-            report.economic_activities_productivity_monetary_parties = (
-                len(economic_activities_registers)
-                if economic_activities_registers else 0)
-            report.save()
-
-        cls.write(reports, {
-                'calculation_date': datetime.datetime.now(),
-                })
+                totals, _ = cls._get_totals(
+                    report.company.id, mapping_accounts, mapping_codes)
+            for field, amount in totals.items():
+                setattr(report, field, amount)
+            report._save_registers(accumulators, mapping_accounts,
+                mapping_codes, chunks[0].fingerprint if chunks else None)
+            Chunk.delete(chunks)
+        if to_write:
+            cls.write(*to_write)
+        cls.update_to_deduce(reports)
+        cls.check_registers(reports)
+
+    @staticmethod
+    def _get_move_line_units(query, digits):
+        '''
+        Return the list of (move line id, canonical party id, units) of the
+        move lines of the query of ids ordered by party, with the units the
+        debit minus credit as an integer in the smallest unit of the currency
+        '''
+        pool = Pool()
+        MoveLine = pool.get('account.move.line')
+        PartyCanonical = pool.get('aeat.111.party.canonical')
+        table = MoveLine.__table__()
+        canonical = PartyCanonical.__table__()
+        cursor = Transaction().connection.cursor()
+
+        # Round as SQLite may compute with float
+        amount = Cast(Round((table.debit - table.credit) * (10 ** digits)),
+            'BIGINT')
+        party = Coalesce(canonical.canonical, table.party)
+        # The lines are read in the same query as the search
+        cursor.execute(*table.join(canonical, 'LEFT',
+                condition=table.party == canonical.party
+                ).select(table.id, party, amount,
+                where=table.id.in_(query),
+                order_by=[party.asc, table.id.asc]))
+        return [(l, p, int(u)) for l, p, u in cursor]
+
+    @staticmethod
+    def _get_tax_line_units(query, digits):
+        '''
+        Return the list of (invoice id, party id, units) of the tax lines of
+        the query of ids whose move has an invoice as origin, with the units
+        the amount as an integer in the smallest unit of the currency
+        '''
+        pool = Pool()
+        TaxLine = pool.get('account.tax.line')
+        MoveLine = pool.get('account.move.line')
+        Move = pool.get('account.move')
+        Invoice = pool.get('account.invoice')
+        tax_line = TaxLine.__table__()
+        line = MoveLine.__table__()
+        move = Move.__table__()
+        invoice = Invoice.__table__()
+        cursor = Transaction().connection.cursor()
+
+        # Round as SQLite may compute with float
+        amount = Cast(Round(tax_line.amount * (10 ** digits)), 'BIGINT')
+        cursor.execute(*tax_line.join(line,
+                condition=tax_line.move_line == line.id
+                ).join(move, condition=line.move == move.id
+                ).join(invoice,
+                condition=(move.origin.like(Invoice.__name__ + ',%')
+                    & (Move.origin.sql_id(move.origin, Move) == invoice.id))
+                ).select(invoice.id, invoice.party, amount,
+                where=tax_line.id.in_(query),
+                order_by=tax_line.id.asc))
+        return [(i, p, int(u)) for i, p, u in cursor]
+
+    @classmethod
+    def _get_register_fields(cls, mapping_accounts, mapping_codes):
+        '''
+        Return for each register type the fields its amounts are included in
+        '''
+        register_fields = {
+            'work_payment': set(),
+            'work_amount': set(),
+            'economic_activity': set(),
+            }
+        for field, _ in mapping_accounts.values():
+            if 'payment' in field:
+                register_fields['work_payment'].add(field)
+            else:
+                register_fields['work_amount'].add(field)
+        for field in mapping_codes.values():
+            # Economic activity registers only sum the withheld tax, not the
+            # base which is reported on the *_payments fields
+            if not field.endswith('_payments'):
+                register_fields['economic_activity'].add(field)
+        return register_fields
+
+    @classmethod
+    def check_registers(cls, reports):
+        '''
+        Store on each report the differences between the calculated fields
+        and the sum of its registers.
+        '''
+        pool = Pool()
+        Register = pool.get('aeat.111.report.register')
+        register = Register.__table__()
+        cursor = Transaction().connection.cursor()
+
+        types = dict(Register.fields_get(['type_'])['type_']['selection'])
+        amounts = {}
+        for sub_ids in grouped_slice([r.id for r in reports],
+                backend.MAX_QUERY_PARAMS):
+            cursor.execute(*register.select(
+                    register.report, register.type_, Sum(register.amount),
+                    where=reduce_ids(register.report, sub_ids),
+                    group_by=[register.report, register.type_]))
+            for report_id, type_, amount in cursor:
+                # SQLite uses float for SUM
+                if not isinstance(amount, Decimal):
+                    amount = Decimal(str(amount or 0))
+                amounts[(report_id, type_)] = amount
+
+        register_fields = {}
+        to_write = []
+        for report in reports:
+            if report.company not in register_fields:
+                register_fields[report.company] = cls._get_register_fields(
+                    *cls._get_mappings(report.company))
+            differences = []
+            for type_, fields_ in register_fields[report.company].items():
+                expected = sum((getattr(report, f) or _ZERO
+                        for f in fields_), _ZERO)
+                amount = report.currency.round(
+                    amounts.get((report.id, type_), _ZERO))
+                if expected != amount:
+                    differences.append('%s: %s / %s' % (
+                            types[type_], expected, amount))
+            to_write.extend(([report], {
+                        'register_differences': (
+                            '\n'.join(differences) or None),
+                        }))
+        if to_write:
+            cls.write(*to_write)
 
     @classmethod
     @ModelView.button
     @Workflow.transition('done')
     def process(cls, reports):
+        pool = Pool()
+        Warning = pool.get('res.user.warning')
+
+        for report in reports:
+            if report.register_differences:
+                key = Warning.format('aeat111_register_differences', [report])
+                if Warning.check(key):
+                    raise UserWarning(key, gettext(
+                            'aeat_111.msg_register_differences',
+                            report=report.rec_name,
+                            differences=report.register_differences))
         for report in reports:
             report.create_file()
 
@@ -921,10 +2385,42 @@ class Report(Workflow, ModelSQL, ModelView):
     @ModelView.button
     @Workflow.transition('draft')
     def draft(cls, reports):
-        registers = [register for report in reports
-            for register in report.registers]
+        pool = Pool()
+        Register = pool.get('aeat.111.report.register')
+        Archive = pool.get('aeat.111.report.register.archive')
+
+        to_write = []
+        kept, registers = [], []
+        for report in reports:
+            registers.extend(report.calculation_registers)
+            # The registers are kept to be reused if the ledger does not
+            # change but detached from the report to release the documents
+            if (report.calculation_fingerprint
+                    and not report.archived_registers):
+                kept.extend(([r for r in report.registers], {
+                            'report': None,
+                            'calculation_report': report.id,
+                            }))
+                to_write.extend(([report], {
+                            'payroll_totals': None,
+                            }))
+            else:
+                registers.extend(report.registers)
+                to_write.extend(([report], {
+                            'calculation_fingerprint': None,
+                            'calculation_cache': None,
+                            'payroll_totals': None,
+                            }))
         if registers:
             Register.delete(registers)
+        if kept:
+            Register.write(*kept)
+        archived = [register for report in reports
+            for register in report.archived_registers]
+        if archived:
+            Archive.delete(archived)
+        if to_write:
+            cls.write(*to_write)
 
     def create_file(self):
         if (self.work_productivity_monetary_withholdings_amount != 0 and self.work_productivity_monetary_parties == 0):
@@ -934,6 +2430,7 @@ class Report(Workflow, ModelSQL, ModelView):
         footer = Record(aeat111.FOOTER_RECORD)
         record = Record(aeat111.RECORD)
         columns = [x for x in self.__class__._fields if x != 'report']
+        values = []
         for column in columns:
             value = getattr(self, column, None)
             if not value:
@@ -943,6 +2440,18 @@ class Report(Workflow, ModelSQL, ModelView):
             elif column == 'bank_account':
                 value = next((n.number_compact for n in value.numbers
                         if n.type == 'iban'), '')
+            if (column in header._fields
+                    or column in record._fields
+                    or column in footer._fields):
+                values.append((column, value))
+
+        # Nothing to render if the values of the records did not change
+        inputs_hash = hashlib.sha256(
+            repr(values).encode('utf-8')).hexdigest()
+        if (inputs_hash == self.file_inputs_hash
+                and (self.file_id or self.file_)):
+            return
+        for column, value in values:
             if column in header._fields:
                 setattr(header, column, value)
             if column in record._fields:
@@ -957,48 +2466,1612 @@ class Report(Workflow, ModelSQL, ModelView):
         data = remove_accents(data).upper()
         if isinstance(data, str):
             data = data.encode('iso-8859-1')
-        self.file_ = self.__class__.file_.cast(data)
+        self.file_inputs_hash = inputs_hash
+        file_hash = hashlib.sha256(data).hexdigest()
+        if file_hash != self.file_hash:
+            # The file store deduplicates identical content
+            self.file_ = self.__class__.file_.cast(data)
+            self.file_hash = file_hash
         self.save()
 
+    @classmethod
+    def read_file(cls, stream):
+        '''
+        Yield the values of the reports read from the AEAT 111 text stream
+        with the file of each declaration.
+        The records are read one by one so the stream may contain any number
+        of declarations.
+        '''
+        structures = [
+            aeat111.HEADER_RECORD, aeat111.RECORD, aeat111.FOOTER_RECORD]
+        while True:
+            records, lines = [], []
+            for structure in structures:
+                size = max(f[0] + f[1] - 1 for f in structure)
+                line = read_fixed(stream, size)
+                if not line and not records:
+                    return
+                if len(line) != size:
+                    raise AssertionError(
+                        "Unexpected end of file: %r" % line[:20])
+                records.append(read_record(line, structure))
+                lines.append(line)
+            header, record, footer = records
+            if ((header.year, header.period) != (record.year, record.period)
+                    or (footer.year, footer.period)
+                    != (record.year, record.period)):
+                raise AssertionError("Header and footer do not match")
+            values = {}
+            for name, field in cls._fields.items():
+                if (name not in record._fields
+                        or isinstance(field, fields.Function)):
+                    continue
+                value = getattr(record, name)
+                if field._type == 'integer':
+                    value = int(value or 0)
+                elif field._type == 'boolean':
+                    value = bool(value)
+                elif isinstance(value, str):
+                    value = value.strip() or None
+                values[name] = value
+            values['file_'] = ''.join(lines).encode('iso-8859-1')
+            yield values
 
-class Register(ModelSQL, ModelView):
-    """
-    AEAT 111 Register
-    """
-    __name__ = 'aeat.111.report.register'
+    @staticmethod
+    def _get_import_path(filename):
+        '''
+        Return the path of filename in the import_directory of the aeat_111
+        section of the configuration.
+        '''
+        directory = config.get('aeat_111', 'import_directory')
+        if not directory:
+            raise UserError(gettext('aeat_111.msg_import_directory_missing'))
+        directory = os.path.realpath(directory)
+        path = os.path.realpath(os.path.join(directory, filename))
+        if os.path.commonpath([directory, path]) != directory:
+            raise UserError(gettext('aeat_111.msg_import_file_outside',
+                    filename=filename))
+        return path
 
-    company = fields.Function(fields.Many2One('company.company', 'Company'),
-        'on_change_with_company', searcher='search_company')
-    report = fields.Many2One('aeat.111.report', 'AEAT 111 Report')
-    type_ = fields.Selection([
-            ('work_payment', 'Work Payment'),
-            ('work_amount', 'Work Amount'),
-            ('economic_activity', 'Economic Activity'),
-            ], 'Type', required=True)
-    party = fields.Many2One(
-        'party.party', 'Party',
-        context={
-            'company': Eval('company', -1),
-            },
-        depends={'company'})
-    currency = fields.Function(fields.Many2One('currency.currency', 'Currency'),
-        'on_change_with_currency')
+    @classmethod
+    def import_files(cls, company, filenames):
+        '''
+        Create done reports for company from the AEAT 111 files.
+        The filenames are relative to the import_directory of the
+        configuration.
+        The declarant of the files must be the company.
+        Declarations already imported or created are skipped and the reports
+        are created in bulk.
+        '''
+        pool = Pool()
+        Company = pool.get('company.company')
+        AccountNumber = pool.get('bank.account.number')
+
+        company = Company(int(company))
+        company_id = company.id
+        company_vat = cls._get_company_vat(company)
+        for sub_filenames in grouped_slice(filenames,
+                backend.MAX_QUERY_PARAMS):
+            to_create = {}
+            for filename in sub_filenames:
+                with open(cls._get_import_path(filename),
+                        encoding='iso-8859-1', newline='') as stream:
+                    try:
+                        for values in cls.read_file(stream):
+                            if values['company_vat'] != company_vat:
+                                raise UserError(gettext(
+                                        'aeat_111.msg_import_file_company_vat',
+                                        vat=values['company_vat'],
+                                        filename=filename,
+                                        company=company.rec_name))
+                            file_hash = hashlib.sha256(
+                                values['file_']).hexdigest()
+                            values.update({
+                                    'company': company_id,
+                                    'state': 'done',
+                                    'file_hash': file_hash,
+                                    })
+                            to_create[file_hash] = values
+                    except (AssertionError, RetrofixException) as exception:
+                        raise UserError(gettext(
+                                'aeat_111.msg_invalid_aeat111_file',
+                                filename=filename,
+                                exception=exception)) from exception
+
+            existing = {r.file_hash for r in cls.search([
+                        ('company', '=', company_id),
+                        ('file_hash', 'in', list(to_create.keys())),
+                        ])}
+            vlist = [v for h, v in to_create.items() if h not in existing]
+            ibans = {v['bank_account'] for v in vlist if v['bank_account']}
+            numbers = {n.number_compact: n.account.id
+                for n in AccountNumber.search([
+                        ('type', '=', 'iban'),
+                        ('number_compact', 'in', list(ibans)),
+                        ])}
+            for values in vlist:
+                values['bank_account'] = numbers.get(values['bank_account'])
+            cls.create(vlist)
+
+    @classmethod
+    def import_files_in_background(cls, company, filenames, size=100):
+        '''
+        Queue the import of the files by chunks of size to be run in
+        parallel by the workers.
+        The import directory must be accessible from the workers.
+        '''
+        pool = Pool()
+        Import = pool.get('aeat.111.report.import')
+        filenames = list(filenames)
+        imports = Import.create([{
+                    'company': int(company),
+                    'filenames': '\n'.join(filenames[i:i + size]),
+                    } for i in range(0, len(filenames), size)])
+        for import_ in imports:
+            Import.__queue__.process([import_])
+
+    @classmethod
+    def get_yearly_totals(cls, company, year):
+        '''
+        Yield (party id, register type, amount) for the year of company.
+        See aeat.111.report.register get_yearly_totals.
+        '''
+        pool = Pool()
+        Register = pool.get('aeat.111.report.register')
+        yield from Register.get_yearly_totals(company, year)
+
+    def export_registers(self):
+        '''
+        Store the registers of the report as CSV in the registers file.
+        The CSV is written to a temporary file which is mapped in memory to
+        be copied to the file store so it is never loaded as a whole.
+        '''
+        with tempfile.TemporaryFile() as file_:
+            stream = io.TextIOWrapper(file_, encoding='utf-8', newline='')
+            self.write_registers(stream)
+            stream.flush()
+            stream.detach()
+            with mmap.mmap(
+                    file_.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                self.__class__.write([self], {
+                        'registers_file': data,
+                        })
+
+    def write_registers(self, stream):
+        '''
+        Write the registers of the report and their linked documents as CSV
+        to stream.
+        Registers are read in chunks of ids so memory does not grow with the
+        size of the report.
+        '''
+        pool = Pool()
+        Register = pool.get('aeat.111.report.register')
+        Archive = pool.get('aeat.111.report.register.archive')
+        Party = pool.get('party.party')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        types = dict(Register.fields_get(['type_'])['type_']['selection'])
+        writer = csv.writer(stream)
+        writer.writerow([
+                'Party', 'VAT', 'Type', 'Amount', 'Document Type',
+                'Document'])
+        for register, archived in [
+                (Register.__table__(), False),
+                (Archive.__table__(), True),
+                ]:
+            last_id = 0
+            while True:
+                cursor.execute(*register.select(
+                        register.id, register.party, register.type_,
+                        register.amount,
+                        where=((register.report == self.id)
+                            & (register.id > last_id)),
+                        order_by=[register.id.asc],
+                        limit=backend.MAX_QUERY_PARAMS))
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+                parties = {p.id: p for p in Party.browse(
+                        list({r[1] for r in rows if r[1]}))}
+                documents = Register.get_documents(
+                    [r[0] for r in rows], archived=archived)
+                for register_id, party_id, type_, amount in rows:
+                    party = parties.get(party_id)
+                    values = [
+                        party.rec_name if party else '',
+                        (party.tax_identifier.code
+                            if party and party.tax_identifier else ''),
+                        types.get(type_, type_),
+                        amount,
+                        ]
+                    register_documents = documents.get(register_id)
+                    if not register_documents:
+                        writer.writerow(values + ['', ''])
+                    for document in register_documents or []:
+                        writer.writerow(values + list(document))
+
+    def read_payroll(self, stream):
+        '''
+        Replace the payroll withholdings of the report by the ones read as
+        CSV from stream.
+        Each row is the VAT of the party, the type ("work" or
+        "economic_activity"), the payment and the withholding. The first row
+        is the header.
+        The rows are aggregated by party while reading so memory only grows
+        with the number of parties.
+        '''
+        pool = Pool()
+        Register = pool.get('aeat.111.report.register')
+        PartyIdentifier = pool.get('party.identifier')
+        PartyCanonical = pool.get('aeat.111.party.canonical')
+
+        if self.state != 'calculated':
+            raise UserError(gettext('aeat_111.msg_payroll_report_state',
+                    report=self.rec_name))
+
+        type_fields = {
+            'work': (
+                'work_productivity_monetary_payments',
+                'work_productivity_monetary_withholdings_amount'),
+            'economic_activity': (
+                'economic_activities_productivity_monetary_payments',
+                ('economic_activities_productivity_monetary_'
+                    'withholdings_amount')),
+            }
+        # {(type, vat): [payment, withholding]}
+        totals = {}
+        reader = csv.reader(stream)
+        next(reader, None)
+        for number, row in enumerate(reader, 2):
+            if not row:
+                continue
+            try:
+                vat, type_, payment, withholding = row
+                payment = Decimal(payment.strip() or 0)
+                withholding = Decimal(withholding.strip() or 0)
+            except (ValueError, ArithmeticError):
+                raise UserError(gettext('aeat_111.msg_payroll_invalid_row',
+                        line=number))
+            type_ = type_.strip()
+            if type_ not in type_fields:
+                raise UserError(gettext('aeat_111.msg_payroll_invalid_type',
+                        line=number, type=type_))
+            amounts = totals.setdefault(
+                (type_, PartyIdentifier.compact_code(vat)), [_ZERO, _ZERO])
+            amounts[0] += payment
+            amounts[1] += withholding
+
+        parties = PartyIdentifier.get_parties_by_code(
+            list({v for _, v in totals}))
+        canonicals = PartyCanonical.get_canonical(set(parties.values()))
+        parties = {v: canonicals[p] for v, p in parties.items()}
+        unknown = sorted({v for _, v in totals if v not in parties})
+        if unknown:
+            raise UserError(gettext('aeat_111.msg_payroll_unknown_parties',
+                    parties=', '.join(unknown)))
+
+        # The previous import is replaced so importing again does not add
+        # the same payroll twice
+        for field, amount in (self.payroll_totals or {}).items():
+            setattr(self, field, (getattr(self, field) or _ZERO) - amount)
+        Register.delete([r for r in self.registers if r.payroll])
+
+        payroll_totals = defaultdict(lambda: _ZERO)
+        # {(register type, party): amount}
+        amounts = defaultdict(lambda: _ZERO)
+        for (type_, vat), (payment, withholding) in totals.items():
+            payment_field, withholding_field = type_fields[type_]
+            payroll_totals[payment_field] += payment
+            payroll_totals[withholding_field] += withholding
+            if type_ == 'work':
+                amounts['work_payment', parties[vat]] += abs(payment)
+                amounts['work_amount', parties[vat]] += abs(withholding)
+            else:
+                amounts['economic_activity', parties[vat]] += abs(withholding)
+        for field, amount in payroll_totals.items():
+            setattr(self, field, (getattr(self, field) or _ZERO) + amount)
+        keys = sorted((k for k, a in amounts.items() if a),
+            key=lambda k: _REGISTER_ORDER[k[0]])
+        Register.create([{
+                    'report': self.id,
+                    'type_': type_,
+                    'party': party_id,
+                    'amount': amounts[type_, party_id],
+                    'payroll': True,
+                    } for type_, party_id in keys])
+
+        parties = defaultdict(set)
+        for register in Register.search([('report', '=', self.id)]):
+            parties[register.type_].add(
+                register.party.id if register.party else None)
+        self.work_productivity_monetary_parties = len(parties['work_amount'])
+        self.economic_activities_productivity_monetary_parties = len(
+            parties['economic_activity'])
+        self.payroll_totals = dict(payroll_totals) or None
+        # The imported amounts are not in the ledger
+        self.calculation_fingerprint = None
+        self.calculation_cache = None
+        self.save()
+        self.check_registers([self])
+
+
+class Register(ModelSQL, ModelView):
+    """
+    AEAT 111 Register
+    """
+    __name__ = 'aeat.111.report.register'
+
+    company = fields.Function(fields.Many2One('company.company', 'Company'),
+        'get_report_fields', searcher='search_company')
+    report = fields.Many2One('aeat.111.report', 'AEAT 111 Report',
+        ondelete='CASCADE')
+    type_ = fields.Selection([
+            ('work_payment', 'Work Payment'),
+            ('work_amount', 'Work Amount'),
+            ('economic_activity', 'Economic Activity'),
+            ], 'Type', required=True)
+    party = fields.Many2One(
+        'party.party', 'Party',
+        context={
+            'company': Eval('company', -1),
+            },
+        depends={'company'})
+    currency = fields.Function(fields.Many2One('currency.currency', 'Currency'),
+        'get_report_fields')
     amount = Monetary("Amount", currency='currency', digits='currency')
-    invoices = fields.One2Many('account.invoice', 'aeat111_register',
-        'Invoices', readonly=True)
-    move_lines = fields.One2Many('account.move.line', 'aeat111_register',
+    invoices = fields.Many2Many('aeat.111.report.register-account.invoice',
+        'register', 'invoice', 'Invoices', readonly=True)
+    move_lines = fields.Many2Many(
+        'aeat.111.report.register-account.move.line', 'register', 'line',
         'Move Lines', readonly=True)
+    payroll = fields.Boolean("Payroll", readonly=True,
+        help="Imported from a payroll file.")
+    calculation_report = fields.Many2One('aeat.111.report',
+        "Calculation Report", readonly=True, ondelete='CASCADE',
+        help="The draft report for which the register is kept to reuse its "
+        "calculation.")
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t,
+                    (t.report, Index.Range()),
+                    (t.type_, Index.Equality()),
+                    (t.party, Index.Range())),
+                Index(t,
+                    (t.calculation_report, Index.Range()),
+                    where=t.calculation_report != Null),
+                })
 
     @fields.depends('report', '_parent_report.company')
     def on_change_with_company(self, name=None):
         return (self.report and self.report.company
             and self.report.company.id or None)
 
+    @classmethod
+    def get_report_fields(cls, registers, names):
+        pool = Pool()
+        Report = pool.get('aeat.111.report')
+        Company = pool.get('company.company')
+        register = cls.__table__()
+        report = Report.__table__()
+        company = Company.__table__()
+        cursor = Transaction().connection.cursor()
+
+        ids = [r.id for r in registers]
+        # The registers of deleted reports have none
+        result = {n: dict.fromkeys(ids) for n in names}
+        columns = {
+            'company': report.company,
+            'currency': company.currency,
+            }
+        for sub_ids in grouped_slice(ids, backend.MAX_QUERY_PARAMS):
+            cursor.execute(*register.join(report,
+                    condition=register.report == report.id
+                    ).join(company,
+                    condition=report.company == company.id
+                    ).select(register.id,
+                    *[columns[n] for n in names],
+                    where=reduce_ids(register.id, sub_ids)))
+            for row in cursor:
+                for name, value in zip(names, row[1:]):
+                    result[name][row[0]] = value
+        return result
+
     @classmethod
     def search_company(cls, name, clause):
         return [('report.%s' % name,) + tuple(clause[1:])]
 
+    @classmethod
+    def get_yearly_totals(cls, company, year):
+        '''
+        Yield (party id, register type, amount) with the total of the
+        registers of company for year, ordered by party and type.
+        Only the last done report of each period is taken into account as
+        complementary declarations replace the previous ones, and the monthly
+        reports are ignored for the months of a done quarterly report.
+        '''
+        pool = Pool()
+        Report = pool.get('aeat.111.report')
+        RegisterAll = pool.get('aeat.111.report.register.all')
+        report = Report.__table__()
+        quarter = Report.__table__()
+        registers = RegisterAll.__table__()
+        cursor = Transaction().connection.cursor()
+
+        company_id = int(company)
+        start_month, end_month = Report._get_period_months(report)
+        quarter_start_month, quarter_end_month = Report._get_period_months(
+            quarter)
+        # The months of a done quarterly report are not counted again from
+        # the monthly reports
+        covered = quarter.select(quarter.id,
+            where=(quarter.company == report.company)
+            & (quarter.year == report.year)
+            & (quarter.state == 'done')
+            & (quarter.period != report.period)
+            & (quarter_start_month <= start_month)
+            & (quarter_end_month >= end_month))
+        last_reports = report.select(Max(report.id),
+            where=((report.company == company_id)
+                & (report.year == year)
+                & (report.state == 'done')
+                & ~Exists(covered)),
+            group_by=[report.period])
+        cursor.execute(*registers.select(
+                registers.party, registers.type_, Sum(registers.amount),
+                where=registers.report.in_(last_reports),
+                group_by=[registers.party, registers.type_],
+                order_by=[registers.party, registers.type_]))
+        for party_id, type_, amount in cursor:
+            # SQLite uses float for SUM
+            if not isinstance(amount, Decimal):
+                amount = Decimal(str(amount or 0))
+            yield party_id, type_, amount
+
+    @classmethod
+    def get_documents(cls, register_ids, archived=False):
+        '''
+        Return for each register id the list of (document type, document)
+        linked to it.
+        If archived, the register ids are of aeat.111.report.register.archive.
+        '''
+        pool = Pool()
+        if archived:
+            RegisterInvoice = pool.get(
+                'aeat.111.report.register.archive-account.invoice')
+            RegisterLine = pool.get(
+                'aeat.111.report.register.archive-account.move.line')
+        else:
+            RegisterInvoice = pool.get(
+                'aeat.111.report.register-account.invoice')
+            RegisterLine = pool.get(
+                'aeat.111.report.register-account.move.line')
+        Invoice = pool.get('account.invoice')
+        MoveLine = pool.get('account.move.line')
+        Move = pool.get('account.move')
+        register_invoice = RegisterInvoice.__table__()
+        register_line = RegisterLine.__table__()
+        invoice = Invoice.__table__()
+        line = MoveLine.__table__()
+        move = Move.__table__()
+        cursor = Transaction().connection.cursor()
+
+        documents = {}
+        cursor.execute(*register_invoice.join(invoice,
+                condition=register_invoice.invoice == invoice.id
+                ).select(
+                register_invoice.register, invoice.number, invoice.id,
+                where=reduce_ids(register_invoice.register, register_ids),
+                order_by=[register_invoice.register, invoice.id]))
+        for register_id, number, invoice_id in cursor:
+            documents.setdefault(register_id, []).append(
+                ('Invoice', number or str(invoice_id)))
+        cursor.execute(*register_line.join(line,
+                condition=register_line.line == line.id
+                ).join(move, condition=line.move == move.id
+                ).select(
+                register_line.register, move.number, line.id,
+                where=reduce_ids(register_line.register, register_ids),
+                order_by=[register_line.register, line.id]))
+        for register_id, number, line_id in cursor:
+            documents.setdefault(register_id, []).append(
+                ('Move Line', '%s/%s' % (number or '', line_id)))
+        return documents
+
+    @classmethod
+    def archive(cls, years=None):
+        '''
+        Move the registers of the done reports older than years and their
+        links to the documents to the archive tables.
+        By default years is the archive_years option of the configuration
+        and nothing is archived if it is not set.
+        '''
+        pool = Pool()
+        Report = pool.get('aeat.111.report')
+        Archive = pool.get('aeat.111.report.register.archive')
+        Date = pool.get('ir.date')
+        register = cls.__table__()
+        report = Report.__table__()
+        cursor = Transaction().connection.cursor()
+
+        if years is None:
+            years = config.getint('aeat_111', 'archive_years', default=0)
+        if not years:
+            return
+        cursor.execute(*register.join(report,
+                condition=register.report == report.id
+                ).select(register.report,
+                where=(report.state == 'done')
+                & (report.year < Date.today().year - years),
+                group_by=[register.report]))
+        report_ids = [r for r, in cursor]
+        for sub_ids in grouped_slice(report_ids, backend.MAX_QUERY_PARAMS):
+            cls._move_registers(cls, Archive, list(sub_ids))
+
+    @classmethod
+    def unarchive(cls, reports):
+        'Move back the archived registers of the reports and their links'
+        pool = Pool()
+        Archive = pool.get('aeat.111.report.register.archive')
+
+        for sub_ids in grouped_slice([r.id for r in reports],
+                backend.MAX_QUERY_PARAMS):
+            cls._move_registers(Archive, cls, list(sub_ids))
+
+    @staticmethod
+    def _move_registers(Source, Target, report_ids):
+        '''
+        Move in bulk the registers of the reports and their links from Source
+        to Target keeping the register ids.
+        '''
+        source = Source.__table__()
+        target = Target.__table__()
+        cursor = Transaction().connection.cursor()
+
+        columns = ['id', 'create_uid', 'create_date', 'write_uid',
+            'write_date', 'report', 'type_', 'party', 'amount', 'payroll']
+        registers = source.select(source.id,
+            where=reduce_ids(source.report, report_ids))
+        cursor.execute(*target.insert(
+                [Column(target, c) for c in columns],
+                source.select(*[Column(source, c) for c in columns],
+                    where=reduce_ids(source.report, report_ids))))
+        for field in ['move_lines', 'invoices']:
+            source_link = Source._fields[field].get_relation().__table__()
+            target_link = Target._fields[field].get_relation().__table__()
+            document = Source._fields[field].target
+            columns = ['create_uid', 'create_date', 'register', document]
+            cursor.execute(*target_link.insert(
+                    [Column(target_link, c) for c in columns],
+                    source_link.select(
+                        *[Column(source_link, c) for c in columns],
+                        where=source_link.register.in_(registers))))
+            cursor.execute(*source_link.delete(
+                    where=source_link.register.in_(registers)))
+        cursor.execute(*source.delete(
+                where=reduce_ids(source.report, report_ids)))
+
+    @classmethod
+    def delete(cls, registers):
+        pool = Pool()
+        RegisterInvoice = pool.get('aeat.111.report.register-account.invoice')
+        RegisterLine = pool.get('aeat.111.report.register-account.move.line')
+        cursor = Transaction().connection.cursor()
+
+        # Remove the links in bulk instead of cascading through the ORM
+        for Relation in [RegisterLine, RegisterInvoice]:
+            table = Relation.__table__()
+            for sub_ids in grouped_slice([r.id for r in registers],
+                    backend.MAX_QUERY_PARAMS):
+                cursor.execute(*table.delete(
+                        where=reduce_ids(table.register, sub_ids)))
+        super().delete(registers)
+
+    @classmethod
+    def get_document_links(cls, register_ids):
+        '''
+        Return the links of the registers to their documents as lists of
+        (register id, move line id) and (register id, invoice id)
+        '''
+        pool = Pool()
+        RegisterInvoice = pool.get('aeat.111.report.register-account.invoice')
+        RegisterLine = pool.get('aeat.111.report.register-account.move.line')
+        cursor = Transaction().connection.cursor()
+
+        links = {}
+        for Relation, field in [
+                (RegisterLine, 'line'),
+                (RegisterInvoice, 'invoice'),
+                ]:
+            table = Relation.__table__()
+            links[field] = []
+            for sub_ids in grouped_slice(
+                    register_ids, backend.MAX_QUERY_PARAMS):
+                cursor.execute(*table.select(
+                        table.register, getattr(table, field),
+                        where=reduce_ids(table.register, sub_ids)))
+                links[field].extend(cursor)
+        return links['line'], links['invoice']
+
+    @classmethod
+    def copy_documents(cls, register_map):
+        '''
+        Link to the new registers the documents of the registers given as a
+        dictionary of {register id: new register id}
+        '''
+        move_lines, invoices = cls.get_document_links(
+            list(register_map.keys()))
+        cls.link_documents(
+            move_lines=[(register_map[r], l) for r, l in move_lines],
+            invoices=[(register_map[r], i) for r, i in invoices])
+
+    @classmethod
+    def link_documents(cls, move_lines=None, invoices=None):
+        '''
+        Bulk insert the links between registers and their documents given as
+        lists of (register id, move line id) and (register id, invoice id)
+        '''
+        pool = Pool()
+        RegisterInvoice = pool.get('aeat.111.report.register-account.invoice')
+        RegisterLine = pool.get('aeat.111.report.register-account.move.line')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        for Relation, field, links in [
+                (RegisterLine, 'line', move_lines),
+                (RegisterInvoice, 'invoice', invoices),
+                ]:
+            table = Relation.__table__()
+            columns = [table.register, getattr(table, field),
+                table.create_uid, table.create_date]
+            # One multi-row insert by the rows fitting in the parameters
+            for sub_links in grouped_slice(links or [],
+                    backend.MAX_QUERY_PARAMS // len(columns)):
+                cursor.execute(*table.insert(columns, [
+                            [r, d, transaction.user, CurrentTimestamp()]
+                            for r, d in sub_links]))
+
     @fields.depends('report', '_parent_report.currency')
     def on_change_with_currency(self, name=None):
         return (self.report and self.report.currency
             and self.report.currency.id or None)
+
+
+class RegisterMoveLine(ModelSQL):
+    '''
+    AEAT 111 Register - Move Line
+    '''
+    __name__ = 'aeat.111.report.register-account.move.line'
+
+    register = fields.Many2One('aeat.111.report.register', 'Register',
+        required=True, ondelete='CASCADE')
+    line = fields.Many2One('account.move.line', 'Move Line', required=True,
+        ondelete='CASCADE')
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t, (t.register, Index.Range())),
+                Index(t, (t.line, Index.Range())),
+                })
+
+    @classmethod
+    def __register__(cls, module_name):
+        pool = Pool()
+        MoveLine = pool.get('account.move.line')
+        created = not backend.TableHandler.table_exist(cls._table)
+
+        super().__register__(module_name)
+
+        # Migration from 7.x: links stored on account.move.line
+        line_h = MoveLine.__table_handler__(module_name)
+        if line_h.column_exist('aeat111_register'):
+            if created:
+                migrate_register_links(cls, MoveLine, 'line')
+            line_h.drop_column('aeat111_register')
+
+
+class RegisterInvoice(ModelSQL):
+    '''
+    AEAT 111 Register - Invoice
+    '''
+    __name__ = 'aeat.111.report.register-account.invoice'
+
+    register = fields.Many2One('aeat.111.report.register', 'Register',
+        required=True, ondelete='CASCADE')
+    invoice = fields.Many2One('account.invoice', 'Invoice', required=True,
+        ondelete='CASCADE')
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t, (t.register, Index.Range())),
+                Index(t, (t.invoice, Index.Range())),
+                })
+
+    @classmethod
+    def __register__(cls, module_name):
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        created = not backend.TableHandler.table_exist(cls._table)
+
+        super().__register__(module_name)
+
+        # Migration from 7.x: links stored on account.invoice
+        invoice_h = Invoice.__table_handler__(module_name)
+        if invoice_h.column_exist('aeat111_register'):
+            if created:
+                migrate_register_links(cls, Invoice, 'invoice')
+            invoice_h.drop_column('aeat111_register')
+
+
+class RegisterArchive(ModelSQL, ModelView):
+    '''
+    AEAT 111 Register Archive
+
+    The registers of old done reports with the id they had when current.
+    '''
+    __name__ = 'aeat.111.report.register.archive'
+
+    report = fields.Many2One('aeat.111.report', "AEAT 111 Report",
+        required=True, ondelete='CASCADE', readonly=True)
+    type_ = fields.Selection([
+            ('work_payment', 'Work Payment'),
+            ('work_amount', 'Work Amount'),
+            ('economic_activity', 'Economic Activity'),
+            ], 'Type', required=True, readonly=True)
+    party = fields.Many2One('party.party', "Party", readonly=True)
+    amount = fields.Numeric("Amount", digits=(15, 2), readonly=True)
+    payroll = fields.Boolean("Payroll", readonly=True)
+    invoices = fields.Many2Many(
+        'aeat.111.report.register.archive-account.invoice',
+        'register', 'invoice', "Invoices", readonly=True)
+    move_lines = fields.Many2Many(
+        'aeat.111.report.register.archive-account.move.line',
+        'register', 'line', "Move Lines", readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(Index(t, (t.report, Index.Range())))
+
+
+class RegisterArchiveMoveLine(ModelSQL):
+    '''
+    AEAT 111 Register Archive - Move Line
+    '''
+    __name__ = 'aeat.111.report.register.archive-account.move.line'
+
+    register = fields.Many2One('aeat.111.report.register.archive',
+        "Register", required=True, ondelete='CASCADE')
+    line = fields.Many2One('account.move.line', "Move Line", required=True,
+        ondelete='CASCADE')
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t, (t.register, Index.Range())),
+                Index(t, (t.line, Index.Range())),
+                })
+
+
+class RegisterArchiveInvoice(ModelSQL):
+    '''
+    AEAT 111 Register Archive - Invoice
+    '''
+    __name__ = 'aeat.111.report.register.archive-account.invoice'
+
+    register = fields.Many2One('aeat.111.report.register.archive',
+        "Register", required=True, ondelete='CASCADE')
+    invoice = fields.Many2One('account.invoice', "Invoice", required=True,
+        ondelete='CASCADE')
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t, (t.register, Index.Range())),
+                Index(t, (t.invoice, Index.Range())),
+                })
+
+
+class RegisterAll(ModelSQL, ModelView):
+    '''
+    AEAT 111 Current and Archived Register
+
+    The registers of the reports whether they are archived or not.
+    '''
+    __name__ = 'aeat.111.report.register.all'
+
+    company = fields.Many2One('company.company', "Company", readonly=True)
+    report = fields.Many2One('aeat.111.report', "AEAT 111 Report",
+        readonly=True)
+    year = fields.Integer("Year", readonly=True)
+    type_ = fields.Selection([
+            ('work_payment', 'Work Payment'),
+            ('work_amount', 'Work Amount'),
+            ('economic_activity', 'Economic Activity'),
+            ], 'Type', readonly=True)
+    party = fields.Many2One('party.party', "Party", readonly=True,
+        context={
+            'company': Eval('company', -1),
+            },
+        depends={'company'})
+    amount = fields.Numeric("Amount", digits=(15, 2), readonly=True)
+    payroll = fields.Boolean("Payroll", readonly=True)
+    archived = fields.Boolean("Archived", readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls._order = [
+            ('year', 'DESC'),
+            ('report', 'DESC'),
+            ('id', 'ASC'),
+            ]
+
+    @classmethod
+    def table_query(cls):
+        pool = Pool()
+        Report = pool.get('aeat.111.report')
+        Register = pool.get('aeat.111.report.register')
+        Archive = pool.get('aeat.111.report.register.archive')
+        report = Report.__table__()
+        register = Register.__table__()
+        archive = Archive.__table__()
+
+        # The archived registers keep their id so they never collide and the
+        # registers kept for a draft report are left out
+        registers = Union(*(t.select(
+                    t.id, t.create_uid, t.create_date, t.write_uid,
+                    t.write_date, t.report, t.type_, t.party, t.amount,
+                    t.payroll,
+                    cls.archived.sql_cast(Literal(archived)).as_('archived'),
+                    where=where)
+                for t, archived, where in [
+                    (register, False, register.calculation_report == Null),
+                    (archive, True, Literal(True)),
+                    ]),
+            all_=True)
+        return registers.join(report, type_='LEFT',
+            condition=registers.report == report.id
+            ).select(
+            registers.id,
+            registers.create_uid,
+            registers.create_date,
+            registers.write_uid,
+            registers.write_date,
+            report.company.as_('company'),
+            registers.report,
+            report.year.as_('year'),
+            registers.type_,
+            registers.party,
+            cls.amount.sql_cast(registers.amount).as_('amount'),
+            registers.payroll,
+            registers.archived,
+            )
+
+
+class RegisterAnalytic(ModelSQL, ModelView):
+    '''
+    AEAT 111 Register Analytic
+
+    The current and archived registers of the last done report of each
+    period grouped by company, year, period, type and party.
+    '''
+    __name__ = 'aeat.111.report.register.analytic'
+
+    company = fields.Many2One('company.company', "Company", readonly=True)
+    year = fields.Integer("Year", readonly=True)
+    period = fields.Selection('get_periods', "Period", readonly=True,
+        sort=False)
+    type_ = fields.Selection([
+            ('work_payment', 'Work Payment'),
+            ('work_amount', 'Work Amount'),
+            ('economic_activity', 'Economic Activity'),
+            ], 'Type', readonly=True)
+    party = fields.Many2One('party.party', "Party", readonly=True,
+        context={
+            'company': Eval('company', -1),
+            },
+        depends={'company'})
+    amount = fields.Numeric("Amount", digits=(15, 2), readonly=True)
+    registers = fields.Integer("Registers", readonly=True)
+    previous_amount = fields.Numeric("Previous Amount", digits=(15, 2),
+        readonly=True,
+        help="The amount of the period just before of the same length for the "
+        "same company, type and party.")
+    variation = fields.Numeric("Variation", digits=(13, 4), readonly=True,
+        help="The relative change from the previous amount.")
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls._order = [
+            ('year', 'DESC'),
+            ('period', 'DESC'),
+            ('type_', 'ASC'),
+            ('amount', 'DESC'),
+            ('id', 'DESC'),
+            ]
+
+    @classmethod
+    def get_periods(cls):
+        pool = Pool()
+        Report = pool.get('aeat.111.report')
+        return Report.fields_get(['period'])['period']['selection']
+
+    @classmethod
+    def _get_grouped_query(cls):
+        '''
+        Return the query of the current and archived registers of the last
+        done reports grouped by company, year, period, type and party with the
+        first month of the period counted from year 0 and its number of months
+        '''
+        pool = Pool()
+        Report = pool.get('aeat.111.report')
+        RegisterAll = pool.get('aeat.111.report.register.all')
+        report = Report.__table__()
+        register = RegisterAll.__table__()
+
+        last_reports = report.select(Max(report.id),
+            where=report.state == 'done',
+            group_by=[report.company, report.year, report.period])
+        start_month, end_month = Report._get_period_months(report)
+        return register.join(report,
+            condition=register.report == report.id
+            ).select(
+            Min(register.id).as_('id'),
+            report.company.as_('company'),
+            report.year.as_('year'),
+            report.period.as_('period'),
+            (report.year * 12 + start_month).as_('month'),
+            (end_month - start_month + 1).as_('months'),
+            register.type_.as_('type_'),
+            register.party.as_('party'),
+            Sum(register.amount).as_('amount'),
+            Count().as_('registers'),
+            where=report.id.in_(last_reports),
+            group_by=[report.company, report.year, report.period,
+                register.type_, register.party])
+
+    @classmethod
+    def table_query(cls):
+        grouped = cls._get_grouped_query()
+
+        # Monthly and quarterly periods are compared only among them and
+        # only with the period just before as a missing one has no amount
+        window = Window([grouped.company, grouped.type_,
+                Coalesce(grouped.party, -1), grouped.months],
+            order_by=[grouped.month.asc])
+        previous_amount = Case(
+            (Lag(grouped.month, window=window)
+                == grouped.month - grouped.months,
+                Lag(grouped.amount, window=window)),
+            else_=Null)
+        return grouped.select(
+            grouped.id,
+            Literal(0).as_('create_uid'),
+            CurrentTimestamp().as_('create_date'),
+            Literal(None).as_('write_uid'),
+            Literal(None).as_('write_date'),
+            grouped.company,
+            grouped.year,
+            grouped.period,
+            grouped.type_,
+            grouped.party,
+            cls.amount.sql_cast(grouped.amount).as_('amount'),
+            grouped.registers,
+            cls.previous_amount.sql_cast(previous_amount).as_(
+                'previous_amount'),
+            cls.variation.sql_cast(
+                (grouped.amount - previous_amount)
+                / NullIf(previous_amount, 0)).as_('variation'),
+            )
+
+
+class CalculationChunk(ModelSQL):
+    '''
+    AEAT 111 Report Calculation Chunk
+    '''
+    __name__ = 'aeat.111.report.calculation.chunk'
+
+    report = fields.Many2One('aeat.111.report', "Report", required=True,
+        ondelete='CASCADE')
+    source = fields.Reference("Source", selection=[
+            ('account.account', "Account"),
+            ('account.tax.code', "Tax Code"),
+            ], required=True)
+    start = fields.Integer("Start", required=True,
+        help="The first move line of the account in the chunk.")
+    fingerprint = fields.Char("Fingerprint")
+    snapshot = fields.Char("Snapshot")
+    registers = fields.Dict(None, "Registers")
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(Index(t, (t.report, Index.Range())))
+
+    @staticmethod
+    def default_start():
+        return 0
+
+    @staticmethod
+    def dump_accumulators(accumulators):
+        '''
+        Return the accumulators as a value of the registers field
+        '''
+        return {
+            '%s,%s' % (type_, party_id or ''): {
+                'units': {str(k): u for k, u in a.units.items()},
+                'lines': a.lines,
+                'invoices': a.invoices,
+                } for (type_, party_id), a in accumulators.items()}
+
+    @staticmethod
+    def load_accumulators(registers, digits, accumulators):
+        '''
+        Add the value of the registers field to the accumulators
+        '''
+        for key, values in (registers or {}).items():
+            type_, party_id = key.split(',')
+            accumulator = _get_accumulator(accumulators, type_,
+                int(party_id) if party_id else None, digits)
+            for id_, units in values['units'].items():
+                accumulator.units[int(id_)] += units
+            accumulator.lines.extend(values['lines'])
+            accumulator.invoices.extend(values['invoices'])
+
+
+class LedgerChange(ModelSQL):
+    '''
+    AEAT 111 Ledger Change
+    '''
+    __name__ = 'aeat.111.ledger.change'
+
+    period = fields.Many2One('account.period', "Period", required=True,
+        ondelete='CASCADE')
+    date = fields.DateTime("Date", required=True)
+    transaction = fields.Char("Transaction",
+        help="The id of the database transaction of the change.")
+
+    # {company id: (mapped account ids, taxes of the mapped codes)}
+    _mapped_cache = Cache(__name__ + '.mapped', context=False)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(t, (t.period, Index.Range()), (t.date, Index.Range())))
+
+    @classmethod
+    def _get_mapped(cls, company_id):
+        pool = Pool()
+        Report = pool.get('aeat.111.report')
+        TaxCode = pool.get('account.tax.code')
+
+        mapped = cls._mapped_cache.get(company_id)
+        if mapped is not None:
+            account_ids, tax_ids = mapped
+            return set(account_ids), set(tax_ids)
+        mapping_accounts, mapping_codes = Report._get_mappings(company_id)
+        tax_ids = set()
+        if mapping_codes:
+            # The lines of any period may be mapped
+            closure = Report._get_tax_code_closure(company_id, active=False)
+            code_ids = set()
+            for code_id in mapping_codes:
+                code_ids |= closure.get(code_id, {code_id})
+            for code in TaxCode.browse(code_ids):
+                tax_ids.update(l.tax.id for l in code.lines)
+        account_ids = set(mapping_accounts.keys())
+        cls._mapped_cache.set(company_id, (list(account_ids), list(tax_ids)))
+        return account_ids, tax_ids
+
+    @classmethod
+    def touch(cls, period_ids):
+        '''
+        Record that the ledger of the periods changed.
+        Rows are only appended so concurrent postings never wait on each
+        other.
+        '''
+        if not period_ids:
+            return
+        table = cls.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        # The same clock as the calculation date of the reports
+        now = get_snapshot_date()
+        if backend.name == 'postgresql':
+            transaction_id = Cast(CurrentTransactionId(), 'TEXT')
+        else:
+            transaction_id = None
+        cursor.execute(*table.insert(
+                [table.period, table.date, table.transaction,
+                    table.create_uid, table.create_date],
+                [[p, now, transaction_id, transaction.user,
+                        CurrentTimestamp()]
+                    for p in period_ids]))
+
+    @classmethod
+    def _get_mapped_periods(cls, query):
+        '''
+        Return the periods of the rows of the query of company, account, tax
+        and period which are mapped
+        '''
+        cursor = Transaction().connection.cursor()
+        periods = set()
+        cursor.execute(*query)
+        for company_id, account_id, tax_id, period_id in cursor:
+            account_ids, tax_ids = cls._get_mapped(company_id)
+            if account_id in account_ids or tax_id in tax_ids:
+                periods.add(period_id)
+        return periods
+
+    @classmethod
+    def get_move_line_periods(cls, lines):
+        '''
+        Return the mapped periods of the move lines
+        '''
+        pool = Pool()
+        Move = pool.get('account.move')
+        MoveLine = pool.get('account.move.line')
+        Account = pool.get('account.account')
+        line = MoveLine.__table__()
+        move = Move.__table__()
+        account = Account.__table__()
+
+        periods = set()
+        for sub_ids in grouped_slice([l.id for l in lines],
+                backend.MAX_QUERY_PARAMS):
+            periods |= cls._get_mapped_periods(line.join(move,
+                    condition=line.move == move.id
+                    ).join(account, condition=line.account == account.id
+                    ).select(account.company, line.account, Literal(None),
+                    move.period,
+                    where=reduce_ids(line.id, sub_ids),
+                    group_by=[account.company, line.account, move.period]))
+        return periods
+
+    @classmethod
+    def get_tax_line_periods(cls, tax_lines):
+        '''
+        Return the mapped periods of the tax lines
+        '''
+        pool = Pool()
+        Move = pool.get('account.move')
+        MoveLine = pool.get('account.move.line')
+        TaxLine = pool.get('account.tax.line')
+        Tax = pool.get('account.tax')
+        tax_line = TaxLine.__table__()
+        line = MoveLine.__table__()
+        move = Move.__table__()
+        tax = Tax.__table__()
+
+        periods = set()
+        for sub_ids in grouped_slice([t.id for t in tax_lines],
+                backend.MAX_QUERY_PARAMS):
+            periods |= cls._get_mapped_periods(tax_line.join(line,
+                    condition=tax_line.move_line == line.id
+                    ).join(move, condition=line.move == move.id
+                    ).join(tax, condition=tax_line.tax == tax.id
+                    ).select(tax.company, Literal(None), tax_line.tax,
+                    move.period,
+                    where=reduce_ids(tax_line.id, sub_ids),
+                    group_by=[tax.company, tax_line.tax, move.period]))
+        return periods
+
+    @classmethod
+    def touch_move_lines(cls, lines):
+        cls.touch(cls.get_move_line_periods(lines))
+
+    @classmethod
+    def touch_tax_lines(cls, tax_lines):
+        cls.touch(cls.get_tax_line_periods(tax_lines))
+
+    @classmethod
+    def prune(cls):
+        '''
+        Delete the changes which can not make any report stale: those
+        followed by a later change of the same period and those read by the
+        calculation of all the reports of the period.
+        '''
+        pool = Pool()
+        Report = pool.get('aeat.111.report')
+        FiscalYear = pool.get('account.fiscalyear')
+        Period = pool.get('account.period')
+        table = cls.__table__()
+        later = cls.__table__()
+        report = Report.__table__()
+        fiscalyear = FiscalYear.__table__()
+        period = Period.__table__()
+        cursor = Transaction().connection.cursor()
+
+        start_month, end_month = Report._get_period_months(report)
+        # The reports calculated before the change
+        outdated = report.join(fiscalyear,
+            condition=fiscalyear.company == report.company
+            ).join(period,
+            condition=(period.fiscalyear == fiscalyear.id)
+            & (Extract('YEAR', period.start_date) == report.year)
+            & (Extract('MONTH', period.start_date) >= start_month)
+            & (Extract('YEAR', period.end_date) == report.year)
+            & (Extract('MONTH', period.end_date) <= end_month)
+            ).select(period.id,
+            where=report.state.in_(['calculated', 'done'])
+            & (report.calculation_date != Null)
+            & (period.id == table.period)
+            & Report._get_stale_condition(report, table))
+        later_condition = ((later.date > table.date)
+            | ((later.date == table.date) & (later.id > table.id)))
+        if backend.name == 'postgresql':
+            # A later change may be committed before so only the changes of
+            # the same transaction are read by the same snapshots
+            later_condition = (
+                ((later.transaction == table.transaction)
+                    & (later.id > table.id))
+                | ((later.transaction == Null) & (table.transaction == Null)
+                    & later_condition))
+        pruned = table.select(table.id,
+            where=Exists(later.select(later.id,
+                    where=(later.period == table.period)
+                    & later_condition))
+            | ~Exists(outdated))
+        change = cls.__table__()
+        cursor.execute(*change.delete(where=change.id.in_(pruned)))
+
+
+class ReportImport(ModelSQL):
+    '''
+    AEAT 111 Report Import
+
+    The files of the import directory waiting to be imported by the queue.
+    '''
+    __name__ = 'aeat.111.report.import'
+
+    company = fields.Many2One('company.company', "Company", required=True,
+        ondelete='CASCADE')
+    filenames = fields.Text("File Names", required=True,
+        help="One file name relative to the import directory per line.")
+
+    @classmethod
+    def process(cls, imports):
+        "Create the reports of the files and delete the imports"
+        pool = Pool()
+        Report = pool.get('aeat.111.report')
+        for import_ in imports:
+            Report.import_files(
+                import_.company, import_.filenames.splitlines())
+        cls.delete(imports)
+
+
+class ExportRegisters(Wizard):
+    """
+    AEAT 111 Export Registers
+    """
+    __name__ = 'aeat.111.report.export_registers'
+
+    start = StateTransition()
+
+    def transition_start(self):
+        self.record.export_registers()
+        return 'end'
+
+    def end(self):
+        return 'reload'
+
+
+class ImportPayrollStart(ModelView):
+    """
+    AEAT 111 Import Payroll Start
+    """
+    __name__ = 'aeat.111.report.import_payroll.start'
+
+    file_ = fields.Binary("File", filename='filename', required=True,
+        help="CSV file with a header and the columns: VAT, type "
+        "(work or economic_activity), payment and withholding.")
+    filename = fields.Char("File Name")
+
+
+class ImportPayroll(Wizard):
+    """
+    AEAT 111 Import Payroll
+    """
+    __name__ = 'aeat.111.report.import_payroll'
+
+    start = StateView('aeat.111.report.import_payroll.start',
+        'aeat_111.aeat_111_import_payroll_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Import', 'import_', 'tryton-ok', default=True),
+            ])
+    import_ = StateTransition()
+
+    def transition_import_(self):
+        report = self.record
+        stream = io.TextIOWrapper(
+            io.BytesIO(self.start.file_), encoding='utf-8', newline='')
+        report.read_payroll(stream)
+        return 'end'
+
+
+class History(Workflow, ModelSQL, ModelView):
+    """
+    AEAT 111 History Recalculation
+    """
+    __name__ = 'aeat.111.report.history'
+
+    company = fields.Many2One('company.company', "Company", required=True,
+        states={
+            'readonly': Eval('state') != 'draft',
+            })
+    start_year = fields.Integer("Start Year", required=True,
+        domain=[
+            ('start_year', '>=', 1000),
+            ('start_year', '<=', Eval('end_year', 9999)),
+            ],
+        states={
+            'readonly': Eval('state') != 'draft',
+            })
+    end_year = fields.Integer("End Year", required=True,
+        domain=[
+            ('end_year', '>=', Eval('start_year', 1000)),
+            ('end_year', '<=', 9999),
+            ],
+        states={
+            'readonly': Eval('state') != 'draft',
+            })
+    overwrite = fields.Boolean("Overwrite",
+        states={
+            'readonly': Eval('state') != 'draft',
+            },
+        help="Write the recalculated values on the calculated reports.")
+    lines = fields.One2Many('aeat.111.report.history.line', 'history',
+        "Differences", readonly=True)
+    error = fields.Text("Error", readonly=True,
+        states={
+            'invisible': Eval('state') != 'failed',
+            })
+    state = fields.Selection([
+            ('draft', 'Draft'),
+            ('running', 'Running'),
+            ('done', 'Done'),
+            ('failed', 'Failed'),
+            ], "State", readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls._transitions |= set((
+                ('draft', 'running'),
+                ('running', 'done'),
+                ('running', 'failed'),
+                ('done', 'draft'),
+                ('failed', 'draft'),
+                ))
+        cls._buttons.update({
+                'draft': {
+                    'invisible': ~Eval('state').in_(['done', 'failed']),
+                    },
+                'run': {
+                    'invisible': Eval('state') != 'draft',
+                    },
+                })
+
+    @staticmethod
+    def default_state():
+        return 'draft'
+
+    @staticmethod
+    def default_company():
+        return Transaction().context.get('company')
+
+    @staticmethod
+    def default_overwrite():
+        return False
+
+    @classmethod
+    @ModelView.button
+    @Workflow.transition('draft')
+    def draft(cls, histories):
+        pool = Pool()
+        Line = pool.get('aeat.111.report.history.line')
+        Line.delete([l for h in histories for l in h.lines])
+        cls.write(histories, {
+                'error': None,
+                })
+
+    @classmethod
+    @ModelView.button
+    @Workflow.transition('running')
+    def run(cls, histories):
+        # Each company is computed by its own task so they run in parallel
+        for history in histories:
+            cls.__queue__.compute([history])
+
+    @classmethod
+    def compute(cls, histories):
+        '''
+        Compute the differences of the running histories and recalculate
+        the calculated reports with differences when overwriting.
+        Each history is computed in its own transaction so a history which
+        fails with a user error is marked as failed without undoing the
+        others. Unexpected errors are raised to the queue.
+        '''
+        transaction = Transaction()
+
+        for history in histories:
+            try:
+                with transaction.new_transaction():
+                    history = cls(history.id)
+                    if history.state == 'running':
+                        history._compute()
+            except (UserError, UserWarning) as exception:
+                logger.info(
+                    "AEAT 111 history recalculation %s failed", history.id,
+                    exc_info=True)
+                with transaction.new_transaction():
+                    cls.fail(cls.browse([history.id]), exception.message)
+
+    def _compute(self):
+        pool = Pool()
+        Line = pool.get('aeat.111.report.history.line')
+        Report = pool.get('aeat.111.report')
+
+        lines = self._compute_lines()
+        Line.save(lines)
+        if self.overwrite:
+            reports = Report.browse(list({l.report.id for l in lines
+                        if l.report.state == 'calculated'}))
+            # Calculate again to update the registers and parties
+            Report.draft(reports)
+            Report.calculate(reports)
+        self.done([self])
+
+    @classmethod
+    @Workflow.transition('done')
+    def done(cls, histories):
+        pass
+
+    @classmethod
+    @Workflow.transition('failed')
+    def fail(cls, histories, error):
+        cls.write(histories, {
+                'error': error,
+                })
+
+    def _get_account_amounts(self, period_ids, account_ids):
+        '''
+        Return {period id: {account id: (debit, credit)}} for all periods in
+        a single grouped query.
+        '''
+        pool = Pool()
+        Move = pool.get('account.move')
+        MoveLine = pool.get('account.move.line')
+        line = MoveLine.__table__()
+        move = Move.__table__()
+        cursor = Transaction().connection.cursor()
+
+        amounts = {}
+        if not period_ids or not account_ids:
+            return amounts
+        with Transaction().set_context(periods=period_ids):
+            line_query, _ = MoveLine.query_get(line)
+        cursor.execute(*line.join(move, condition=line.move == move.id
+                ).select(move.period, line.account,
+                Sum(line.debit), Sum(line.credit),
+                where=line_query & reduce_ids(line.account, account_ids),
+                group_by=[move.period, line.account]))
+        for period_id, account_id, debit, credit in cursor:
+            # SQLite uses float for SUM
+            if not isinstance(debit, Decimal):
+                debit = Decimal(str(debit or 0))
+            if not isinstance(credit, Decimal):
+                credit = Decimal(str(credit or 0))
+            amounts.setdefault(period_id, {})[account_id] = (debit, credit)
+        return amounts
+
+    def _compute_lines(self):
+        pool = Pool()
+        Report = pool.get('aeat.111.report')
+        Period = pool.get('account.period')
+        TaxCode = pool.get('account.tax.code')
+        Line = pool.get('aeat.111.report.history.line')
+        Field = pool.get('ir.model.field')
+
+        reports = Report.search([
+                ('company', '=', self.company),
+                ('year', '>=', self.start_year),
+                ('year', '<=', self.end_year),
+                ('state', 'in', ['calculated', 'done']),
+                ])
+        if not reports:
+            return []
+        mapping_accounts, mapping_codes = Report._get_mappings(self.company)
+        periods = Period.search([
+                ('company', '=', self.company),
+                ('start_date', '>=', datetime.date(self.start_year, 1, 1)),
+                ('end_date', '<=', datetime.date(self.end_year, 12, 31)),
+                ])
+        account_amounts = self._get_account_amounts(
+            [p.id for p in periods], list(mapping_accounts.keys()))
+        model_fields = {f.name: f for f in Field.search([
+                    ('model', '=', Report.__name__),
+                    ])}
+
+        lines = []
+        for report in reports:
+            start_date, end_date = Report._get_date_range(
+                report.year, report.period)
+            period_ids = [p.id for p in periods
+                if p.start_date >= start_date and p.end_date <= end_date]
+
+            amounts = {}
+            for period_id in period_ids:
+                for account_id, (debit, credit) in account_amounts.get(
+                        period_id, {}).items():
+                    total_debit, total_credit = amounts.get(
+                        account_id, (_ZERO, _ZERO))
+                    amounts[account_id] = (
+                        total_debit + debit, total_credit + credit)
+            values = Report._get_account_totals(mapping_accounts, amounts)
+            with Transaction().set_context(periods=period_ids):
+                values.update(Report._get_code_totals(mapping_codes,
+                        {c.id: c.amount
+                            for c in TaxCode.browse(mapping_codes.keys())}))
+
+            for field, computed in values.items():
+                stored = getattr(report, field) or _ZERO
+                # SQLite sums floats
+                computed = self.company.currency.round(computed)
+                if stored == computed:
+                    continue
+                lines.append(Line(
+                        history=self,
+                        report=report,
+                        field=model_fields[field],
+                        stored_amount=stored,
+                        computed_amount=computed,
+                        ))
+        return lines
+
+
+class HistoryLine(ModelSQL, ModelView):
+    """
+    AEAT 111 History Recalculation Line
+    """
+    __name__ = 'aeat.111.report.history.line'
+
+    history = fields.Many2One('aeat.111.report.history', "History",
+        required=True, ondelete='CASCADE')
+    report = fields.Many2One('aeat.111.report', "Report", required=True,
+        ondelete='CASCADE')
+    year = fields.Function(fields.Integer("Year"), 'get_report_field')
+    period = fields.Function(fields.Char("Period"), 'get_report_field')
+    field = fields.Many2One('ir.model.field', "Field", required=True,
+        domain=[('model', '=', 'aeat.111.report')])
+    stored_amount = fields.Numeric("Stored Amount", digits=(15, 2))
+    computed_amount = fields.Numeric("Computed Amount", digits=(15, 2))
+    difference = fields.Function(fields.Numeric("Difference",
+            digits=(15, 2)), 'get_difference')
+
+    def get_report_field(self, name):
+        return getattr(self.report, name)
+
+    def get_difference(self, name):
+        return (self.computed_amount or _ZERO) - (self.stored_amount or _ZERO)
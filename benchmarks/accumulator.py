@@ -0,0 +1,77 @@
+# This file is part aeat_111 module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+"""Micro-benchmark of the register amount accumulation
+
+The rows are those returned by the single query of _get_move_line_units
+which reads the move lines of the search with their units, so no extra
+query is left out of the timing.
+
+Run with: python benchmarks/accumulator.py
+"""
+import random
+import timeit
+from decimal import Decimal
+from itertools import groupby
+
+from trytond.modules.aeat_111.aeat import _get_accumulator
+
+PARTIES = 5000
+LINES = 200000
+DIGITS = 2
+ACCOUNT = 1
+
+
+def payroll(seed=0):
+    """
+    Return (line id, party id, debit, credit) sorted by party like a large
+    payroll
+    """
+    rng = random.Random(seed)
+    lines = []
+    for line_id in range(LINES):
+        debit = Decimal(rng.randint(1, 10 ** 7)).scaleb(-DIGITS)
+        lines.append(
+            (line_id, rng.randint(1, PARTIES), debit, Decimal('0.00')))
+    lines.sort(key=lambda l: l[1])
+    return lines
+
+
+def accumulate_decimal(lines):
+    totals, documents = {}, {}
+    for party_id, group in groupby(lines, key=lambda l: l[1]):
+        group = list(group)
+        amount = sum(debit - credit for _, _, debit, credit in group)
+        totals[party_id] = totals.get(party_id, Decimal('0.0')) + abs(amount)
+        documents.setdefault(party_id, []).extend(l for l, _, _, _ in group)
+    return {p: (totals[p], documents[p]) for p in totals}
+
+
+def accumulate_units(lines):
+    accumulators = {}
+    for party_id, group in groupby(lines, key=lambda l: l[1]):
+        group = list(group)
+        accumulator = _get_accumulator(accumulators, 'work_amount', party_id,
+            DIGITS)
+        accumulator.units[ACCOUNT] += sum(u for _, _, u in group)
+        accumulator.lines.extend(l for l, _, _ in group)
+    return {p: (a.amount, a.lines) for (_, p), a in accumulators.items()}
+
+
+def main():
+    lines = payroll()
+    # The rows of _get_move_line_units
+    unit_lines = [(l, p, int((d - c).scaleb(DIGITS))) for l, p, d, c in lines]
+    assert accumulate_decimal(lines) == accumulate_units(unit_lines)
+    decimal_time = min(timeit.repeat(
+            lambda: accumulate_decimal(lines), number=1, repeat=5))
+    units_time = min(timeit.repeat(
+            lambda: accumulate_units(unit_lines), number=1, repeat=5))
+    print("%s lines for %s parties" % (LINES, PARTIES))
+    print("Decimal: %.4fs" % decimal_time)
+    print("Integer units: %.4fs" % units_time)
+    print("Speedup: %.1fx" % (decimal_time / units_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,31 +1,71 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
-from trytond.pool import PoolMeta
+from sql import Null
+
+from trytond import backend
+from trytond.pool import Pool, PoolMeta
 from trytond.model import fields
 from trytond.i18n import gettext
 from trytond.exceptions import UserError
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction
 
 
 class Invoice(metaclass=PoolMeta):
     __name__ = 'account.invoice'
 
-    aeat111_register = fields.Many2One('aeat.111.report.register',
-        'AEAT 111 Register', readonly=True)
+    aeat111_register = fields.Function(fields.Many2One(
+            'aeat.111.report.register', 'AEAT 111 Register'),
+        'get_aeat111_register')
 
     @classmethod
-    def __setup__(cls):
-        super().__setup__()
-        cls._check_modify_exclude.add('aeat111_register')
+    def get_aeat111_register(cls, invoices, name):
+        pool = Pool()
+        RegisterInvoice = pool.get(
+            'aeat.111.report.register-account.invoice')
+        register_invoice = RegisterInvoice.__table__()
+        cursor = Transaction().connection.cursor()
+
+        result = dict.fromkeys([i.id for i in invoices])
+        for sub_ids in grouped_slice([i.id for i in invoices],
+                backend.MAX_QUERY_PARAMS):
+            cursor.execute(*register_invoice.select(
+                    register_invoice.invoice, register_invoice.register,
+                    where=reduce_ids(register_invoice.invoice, sub_ids)))
+            result.update(cursor)
+        return result
 
     @classmethod
     def check_aeat111(cls, invoices):
-        for invoice in invoices:
-            if invoice.aeat111_register:
-                raise UserError(
-                    gettext('aeat_111.msg_draft_cancel_invoice_in_111report',
-                        invoice=invoice.rec_name,
-                        report=invoice.aeat111_register.report,
-                    ))
+        pool = Pool()
+        Report = pool.get('aeat.111.report')
+        cursor = Transaction().connection.cursor()
+
+        # The invoices of the archived registers are also filed
+        for RegisterInvoice, Register in [
+                (pool.get('aeat.111.report.register-account.invoice'),
+                    pool.get('aeat.111.report.register')),
+                (pool.get('aeat.111.report.register.archive-account.invoice'),
+                    pool.get('aeat.111.report.register.archive')),
+                ]:
+            register_invoice = RegisterInvoice.__table__()
+            register = Register.__table__()
+            for sub_ids in grouped_slice([i.id for i in invoices],
+                    backend.MAX_QUERY_PARAMS):
+                cursor.execute(*register_invoice.join(register,
+                        condition=register_invoice.register == register.id
+                        ).select(register_invoice.invoice, register.report,
+                        where=reduce_ids(register_invoice.invoice, sub_ids)
+                        & (register.report != Null),
+                        limit=1))
+                row = cursor.fetchone()
+                if row:
+                    invoice_id, report_id = row
+                    raise UserError(gettext(
+                            'aeat_111.msg_draft_cancel_invoice_in_111report',
+                            invoice=cls(invoice_id).rec_name,
+                            report=Report(report_id),
+                        ))
 
     @classmethod
     def draft(cls, invoices):
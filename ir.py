@@ -0,0 +1,20 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+from trytond.pool import PoolMeta
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.method.selection.append(
+            ('aeat.111.report.register|archive',
+                "Archive AEAT 111 Registers"))
+        cls.method.selection.append(
+            ('aeat.111.ledger.change|prune',
+                "Prune AEAT 111 Ledger Changes"))
+        cls.method.selection.append(
+            ('aeat.111.party.canonical|refresh_all',
+                "Refresh AEAT 111 Party Canonicals"))
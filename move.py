@@ -1,33 +1,119 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
-from trytond.pool import PoolMeta
-from trytond.model import fields
+from sql import Null
+
+from trytond import backend
+from trytond.pool import Pool, PoolMeta
+from trytond.model import ModelView, dualmethod, fields
 from trytond.i18n import gettext
 from trytond.exceptions import UserError
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction
+
+
+class Move(metaclass=PoolMeta):
+    __name__ = 'account.move'
+
+    @dualmethod
+    @ModelView.button
+    def post(cls, moves):
+        pool = Pool()
+        LedgerChange = pool.get('aeat.111.ledger.change')
+        super().post(moves)
+        LedgerChange.touch_move_lines([l for m in moves for l in m.lines])
 
 
 class MoveLine(metaclass=PoolMeta):
     __name__ = 'account.move.line'
 
-    aeat111_register = fields.Many2One('aeat.111.report.register',
-        'AEAT 111 Register', readonly=True)
+    aeat111_register = fields.Function(fields.Many2One(
+            'aeat.111.report.register', 'AEAT 111 Register'),
+        'get_aeat111_register')
 
     @classmethod
-    def __setup__(cls):
-        super().__setup__()
-        cls._check_modify_exclude.add('aeat111_register')
+    def get_aeat111_register(cls, lines, name):
+        pool = Pool()
+        RegisterLine = pool.get('aeat.111.report.register-account.move.line')
+        register_line = RegisterLine.__table__()
+        cursor = Transaction().connection.cursor()
+
+        result = dict.fromkeys([l.id for l in lines])
+        for sub_ids in grouped_slice([l.id for l in lines],
+                backend.MAX_QUERY_PARAMS):
+            cursor.execute(*register_line.select(
+                    register_line.line, register_line.register,
+                    where=reduce_ids(register_line.line, sub_ids)))
+            result.update(cursor)
+        return result
 
     @classmethod
     def check_aeat111(cls, lines):
-        for line in lines:
-            if line.aeat111_register:
-                raise UserError(
-                    gettext('aeat_111.msg_delete_move_line_in_111report',
-                        line=line.rec_name,
-                        report=line.aeat111_register.report,
-                    ))
+        pool = Pool()
+        Report = pool.get('aeat.111.report')
+        cursor = Transaction().connection.cursor()
+
+        # The lines of the archived registers are also filed
+        for RegisterLine, Register in [
+                (pool.get('aeat.111.report.register-account.move.line'),
+                    pool.get('aeat.111.report.register')),
+                (pool.get(
+                        'aeat.111.report.register.archive-account.move.line'),
+                    pool.get('aeat.111.report.register.archive')),
+                ]:
+            register_line = RegisterLine.__table__()
+            register = Register.__table__()
+            for sub_ids in grouped_slice([l.id for l in lines],
+                    backend.MAX_QUERY_PARAMS):
+                cursor.execute(*register_line.join(register,
+                        condition=register_line.register == register.id
+                        ).select(register_line.line, register.report,
+                        where=reduce_ids(register_line.line, sub_ids)
+                        & (register.report != Null),
+                        limit=1))
+                row = cursor.fetchone()
+                if row:
+                    line_id, report_id = row
+                    raise UserError(
+                        gettext('aeat_111.msg_delete_move_line_in_111report',
+                            line=cls(line_id).rec_name,
+                            report=Report(report_id),
+                        ))
+
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        LedgerChange = pool.get('aeat.111.ledger.change')
+        lines = super().create(vlist)
+        LedgerChange.touch_move_lines(lines)
+        return lines
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        LedgerChange = pool.get('aeat.111.ledger.change')
+        actions = iter(args)
+        lines = []
+        for records, values in zip(actions, actions):
+            if values.keys() & cls._aeat111_fields():
+                lines.extend(records)
+        # Before and after as the account or the move may change
+        periods = LedgerChange.get_move_line_periods(lines)
+        super().write(*args)
+        periods |= LedgerChange.get_move_line_periods(cls.browse(lines))
+        LedgerChange.touch(periods)
+
+    @classmethod
+    def _aeat111_fields(cls):
+        'Return the fields which change the AEAT 111 computation'
+        return {
+            'debit', 'credit', 'account', 'party', 'move', 'tax_lines',
+            'state',
+            }
 
     @classmethod
     def delete(cls, lines):
+        pool = Pool()
+        LedgerChange = pool.get('aeat.111.ledger.change')
         cls.check_aeat111(lines)
+        LedgerChange.touch_move_lines(lines)
         super().delete(lines)
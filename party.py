@@ -0,0 +1,241 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import re
+
+from sql import Literal, NullsFirst
+from sql.functions import CurrentTimestamp
+
+from trytond import backend
+from trytond.model import Index, ModelSQL, Unique, fields
+from trytond.pool import Pool, PoolMeta
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction
+
+
+class Party(metaclass=PoolMeta):
+    __name__ = 'party.party'
+
+    @classmethod
+    def delete(cls, parties):
+        pool = Pool()
+        PartyCanonical = pool.get('aeat.111.party.canonical')
+        # The rows of the duplicates are deleted with their canonical party
+        duplicate_ids = PartyCanonical.get_duplicates([p.id for p in parties])
+        super().delete(parties)
+        PartyCanonical.refresh(duplicate_ids)
+
+
+class PartyIdentifier(metaclass=PoolMeta):
+    __name__ = 'party.identifier'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(Index(t, (t.code, Index.Equality())))
+
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        PartyCanonical = pool.get('aeat.111.party.canonical')
+        identifiers = super().create(vlist)
+        PartyCanonical.refresh([i.party.id for i in identifiers])
+        return identifiers
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        PartyCanonical = pool.get('aeat.111.party.canonical')
+        identifiers = sum(args[::2], [])
+        party_ids = {i.party.id for i in identifiers}
+        super().write(*args)
+        party_ids.update(i.party.id for i in cls.browse(identifiers))
+        PartyCanonical.refresh(party_ids)
+
+    @classmethod
+    def delete(cls, identifiers):
+        pool = Pool()
+        PartyCanonical = pool.get('aeat.111.party.canonical')
+        party_ids = {i.party.id for i in identifiers}
+        super().delete(identifiers)
+        PartyCanonical.refresh(party_ids)
+
+    @staticmethod
+    def compact_code(code):
+        "Return the code without separators and in upper case"
+        return re.sub(r'[\s.\-/]', '', code or '').upper()
+
+    @classmethod
+    def get_parties_by_code(cls, codes):
+        '''
+        Return a dictionary of {code: party id} for the compacted codes.
+        The Spanish codes are also found with or without the country prefix.
+        '''
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        # {identifier code: codes it matches}
+        candidates = {}
+        for code in codes:
+            candidates.setdefault(code, set()).add(code)
+            if code.startswith('ES'):
+                candidates.setdefault(code[2:], set()).add(code)
+            else:
+                candidates.setdefault('ES' + code, set()).add(code)
+        parties = {}
+        for sub_codes in grouped_slice(
+                list(candidates.keys()), backend.MAX_QUERY_PARAMS):
+            cursor.execute(*table.select(table.code, table.party,
+                    where=table.code.in_(list(sub_codes)),
+                    order_by=[table.id.asc]))
+            for code, party_id in cursor:
+                for matched in candidates[code]:
+                    parties.setdefault(matched, party_id)
+        return parties
+
+
+class PartyCanonical(ModelSQL):
+    '''
+    AEAT 111 Party Canonical
+    '''
+    __name__ = 'aeat.111.party.canonical'
+
+    party = fields.Many2One('party.party', "Party", required=True,
+        ondelete='CASCADE')
+    tax_code = fields.Char("Tax Code", required=True)
+    canonical = fields.Many2One('party.party', "Canonical", required=True,
+        ondelete='CASCADE',
+        help="The first party with the same tax code.")
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('party_unique', Unique(t, t.party),
+                'aeat_111.msg_party_canonical_unique'),
+            ]
+        cls._sql_indexes.add(Index(t, (t.tax_code, Index.Equality())))
+
+    @staticmethod
+    def normalize_tax_code(code):
+        "Return the tax code compacted and without the Spanish prefix"
+        pool = Pool()
+        Identifier = pool.get('party.identifier')
+        code = Identifier.compact_code(code)
+        if code.startswith('ES'):
+            code = code[2:]
+        return code
+
+    @classmethod
+    def _get_tax_codes(cls, party_ids):
+        "Return the normalized tax code of the parties"
+        pool = Pool()
+        Party = pool.get('party.party')
+        Identifier = pool.get('party.identifier')
+        identifier = Identifier.__table__()
+        cursor = Transaction().connection.cursor()
+
+        types = list(Party.tax_identifier_types())
+        codes = {}
+        for sub_ids in grouped_slice(party_ids, backend.MAX_QUERY_PARAMS):
+            cursor.execute(*identifier.select(
+                    identifier.party, identifier.code,
+                    where=(reduce_ids(identifier.party, sub_ids)
+                        & identifier.type.in_(types)
+                        & (identifier.active == Literal(True))),
+                    order_by=[identifier.party,
+                        NullsFirst(identifier.sequence), identifier.id]))
+            for party_id, code in cursor:
+                if party_id not in codes:
+                    codes[party_id] = cls.normalize_tax_code(code)
+        return codes
+
+    @classmethod
+    def refresh(cls, party_ids):
+        '''
+        Update the rows of the parties and of the parties sharing their old
+        or new tax code
+        '''
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        party_ids = set(party_ids)
+        codes = set(cls._get_tax_codes(party_ids).values())
+        for sub_ids in grouped_slice(party_ids, backend.MAX_QUERY_PARAMS):
+            cursor.execute(*table.select(table.tax_code,
+                    where=reduce_ids(table.party, sub_ids)))
+            codes.update(c for c, in cursor)
+        for sub_codes in grouped_slice(codes, backend.MAX_QUERY_PARAMS):
+            cursor.execute(*table.select(table.party,
+                    where=table.tax_code.in_(list(sub_codes))))
+            party_ids.update(p for p, in cursor)
+
+        for sub_ids in grouped_slice(party_ids, backend.MAX_QUERY_PARAMS):
+            cursor.execute(*table.delete(
+                    where=reduce_ids(table.party, sub_ids)))
+        cls._insert_rows(cls._get_tax_codes(party_ids))
+
+    @classmethod
+    def refresh_all(cls):
+        '''
+        Rebuild the rows of all the parties.
+        It fills the table once the module is activated and repairs it.
+        '''
+        pool = Pool()
+        Party = pool.get('party.party')
+        table = cls.__table__()
+        party = Party.__table__()
+        cursor = Transaction().connection.cursor()
+
+        cursor.execute(*party.select(party.id))
+        party_ids = [p for p, in cursor]
+        cursor.execute(*table.delete())
+        cls._insert_rows(cls._get_tax_codes(party_ids))
+
+    @classmethod
+    def _insert_rows(cls, codes):
+        "Insert the rows of the {party id: tax code} codes"
+        table = cls.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        canonicals = {}
+        for party_id, code in codes.items():
+            canonicals[code] = min(canonicals.get(code, party_id), party_id)
+        columns = [table.party, table.tax_code, table.canonical,
+            table.create_uid, table.create_date]
+        rows = [[p, c, canonicals[c], transaction.user, CurrentTimestamp()]
+            for p, c in codes.items()]
+        # One multi-row insert by the rows fitting in the parameters
+        for sub_rows in grouped_slice(rows,
+                backend.MAX_QUERY_PARAMS // len(columns)):
+            cursor.execute(*table.insert(columns, list(sub_rows)))
+
+    @classmethod
+    def get_duplicates(cls, party_ids):
+        "Return the ids of the other parties with a canonical in party_ids"
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        party_ids = set(party_ids)
+        duplicates = set()
+        for sub_ids in grouped_slice(party_ids, backend.MAX_QUERY_PARAMS):
+            cursor.execute(*table.select(table.party,
+                    where=reduce_ids(table.canonical, sub_ids)))
+            duplicates.update(p for p, in cursor)
+        return duplicates - party_ids
+
+    @classmethod
+    def get_canonical(cls, party_ids):
+        "Return the canonical party id of each party id"
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        canonicals = {p: p for p in party_ids}
+        for sub_ids in grouped_slice([p for p in party_ids if p],
+                backend.MAX_QUERY_PARAMS):
+            cursor.execute(*table.select(table.party, table.canonical,
+                    where=reduce_ids(table.party, sub_ids)))
+            canonicals.update(cursor)
+        return canonicals
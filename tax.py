@@ -0,0 +1,85 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+from trytond.pool import Pool, PoolMeta
+
+
+class TaxLine(metaclass=PoolMeta):
+    __name__ = 'account.tax.line'
+
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        LedgerChange = pool.get('aeat.111.ledger.change')
+        tax_lines = super().create(vlist)
+        LedgerChange.touch_tax_lines(tax_lines)
+        return tax_lines
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        LedgerChange = pool.get('aeat.111.ledger.change')
+        tax_lines = sum(args[::2], [])
+        # Before and after as the move line or the tax may change
+        periods = LedgerChange.get_tax_line_periods(tax_lines)
+        super().write(*args)
+        periods |= LedgerChange.get_tax_line_periods(cls.browse(tax_lines))
+        LedgerChange.touch(periods)
+
+    @classmethod
+    def delete(cls, tax_lines):
+        pool = Pool()
+        LedgerChange = pool.get('aeat.111.ledger.change')
+        LedgerChange.touch_tax_lines(tax_lines)
+        super().delete(tax_lines)
+
+
+class TaxCode(metaclass=PoolMeta):
+    __name__ = 'account.tax.code'
+
+    @classmethod
+    def _clear_aeat111_cache(cls):
+        pool = Pool()
+        Report = pool.get('aeat.111.report')
+        LedgerChange = pool.get('aeat.111.ledger.change')
+        Report._tax_code_closure_cache.clear()
+        LedgerChange._mapped_cache.clear()
+
+    @classmethod
+    def create(cls, vlist):
+        cls._clear_aeat111_cache()
+        return super().create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        cls._clear_aeat111_cache()
+        super().write(*args)
+
+    @classmethod
+    def delete(cls, codes):
+        cls._clear_aeat111_cache()
+        super().delete(codes)
+
+
+class TaxCodeLine(metaclass=PoolMeta):
+    __name__ = 'account.tax.code.line'
+
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        LedgerChange = pool.get('aeat.111.ledger.change')
+        LedgerChange._mapped_cache.clear()
+        return super().create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        LedgerChange = pool.get('aeat.111.ledger.change')
+        LedgerChange._mapped_cache.clear()
+        super().write(*args)
+
+    @classmethod
+    def delete(cls, lines):
+        pool = Pool()
+        LedgerChange = pool.get('aeat.111.ledger.change')
+        LedgerChange._mapped_cache.clear()
+        super().delete(lines)
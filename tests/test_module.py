@@ -1,11 +1,2076 @@
 # This file is part aeat_111 module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
-from trytond.tests.test_tryton import ModuleTestCase
+import csv
+import datetime
+import io
+import os
+import sqlite3
+import tempfile
+import unittest
+from decimal import Decimal
+from unittest.mock import patch
 
+from trytond import backend, config
+from trytond.exceptions import UserError, UserWarning
+from trytond.modules.aeat_111 import aeat
+from trytond.modules.account.tests import create_chart, get_fiscalyear
+from trytond.modules.account_invoice.tests import set_invoice_sequences
+from trytond.modules.company.tests import create_company, set_company
+from trytond.pool import Pool
+from trytond.tests.test_tryton import (
+    DBTestCase, ModuleTestCase, with_transaction)
+from trytond.transaction import Transaction
 
-class Aeat111TestCase(ModuleTestCase):
+
+class QueryCounter:
+    "Connection which records the queries executed by its cursors"
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.queries = []
+
+    def cursor(self):
+        connection = self
+
+        class Cursor:
+            def __init__(self, cursor):
+                self.cursor = cursor
+
+            def execute(self, query, params=None):
+                connection.queries.append(query)
+                return self.cursor.execute(query, params)
+
+            def __iter__(self):
+                return iter(self.cursor)
+
+            def __getattr__(self, name):
+                return getattr(self.cursor, name)
+        return Cursor(self.connection.cursor())
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+class ReportTestMixin:
+    "Helpers to create the ledgers and reports of the tests"
+
+    def create_report(self, company, **values):
+        pool = Pool()
+        Report = pool.get('aeat.111.report')
+        values.setdefault('type', 'I')
+        values.setdefault('year', 2024)
+        values.setdefault('period', '01')
+        report = Report(company=company, **values)
+        report.save()
+        return report
+
+    def create_ledger(self, company):
+        "Return the period, journal and accounts of a mapped ledger"
+        pool = Pool()
+        FiscalYear = pool.get('account.fiscalyear')
+        Account = pool.get('account.account')
+        Journal = pool.get('account.journal')
+        Field = pool.get('ir.model.field')
+        Mapping = pool.get('aeat.111.mapping')
+
+        create_chart(company)
+        fiscalyear = get_fiscalyear(company)
+        fiscalyear.save()
+        FiscalYear.create_period([fiscalyear])
+        period = fiscalyear.periods[0]
+        journal, = Journal.search([('code', '=', 'EXP')])
+        expense, = Account.search([
+                ('type.expense', '=', True),
+                ('closed', '=', False),
+                ('company', '=', company.id),
+                ], limit=1)
+        payable, = Account.search([
+                ('type.payable', '=', True),
+                ('closed', '=', False),
+                ('company', '=', company.id),
+                ], limit=1)
+        field, = Field.search([
+                ('model', '=', 'aeat.111.report'),
+                ('name', '=', 'work_productivity_monetary_payments'),
+                ])
+        Mapping.create([{
+                    'type_': 'account',
+                    'debit_credit_type': 'debit',
+                    'aeat111_field': field.id,
+                    'account': [('add', [expense.id])],
+                    }])
+        return period, journal, expense, payable
+
+    def post_move(self, period, journal, expense, payable, party, amount):
+        pool = Pool()
+        Move = pool.get('account.move')
+        move, = Move.create([{
+                    'period': period.id,
+                    'journal': journal.id,
+                    'date': period.start_date,
+                    'lines': [('create', [{
+                                    'account': expense.id,
+                                    'debit': amount,
+                                    }, {
+                                    'account': payable.id,
+                                    'credit': amount,
+                                    'party': party.id,
+                                    }])],
+                    }])
+        Move.post([move])
+        return move
+
+    def create_code_mapping(self, company):
+        "Return the tax and the parent and child tax codes of a code mapping"
+        pool = Pool()
+        Account = pool.get('account.account')
+        Tax = pool.get('account.tax')
+        TaxCode = pool.get('account.tax.code')
+        Field = pool.get('ir.model.field')
+        Mapping = pool.get('aeat.111.mapping')
+
+        payable, = Account.search([
+                ('type.payable', '=', True),
+                ('closed', '=', False),
+                ('company', '=', company.id),
+                ], limit=1)
+        tax, = Tax.create([{
+                    'name': "IRPF",
+                    'description': "IRPF 15%",
+                    'type': 'percentage',
+                    'rate': Decimal('-0.15'),
+                    'invoice_account': payable.id,
+                    'credit_note_account': payable.id,
+                    }])
+        parent, = TaxCode.create([{
+                    'name': "Withholdings",
+                    }])
+        child, = TaxCode.create([{
+                    'name': "Withholdings of invoices",
+                    'parent': parent.id,
+                    'lines': [('create', [{
+                                    'tax': tax.id,
+                                    'amount': 'tax',
+                                    'type': 'invoice',
+                                    }])],
+                    }])
+        field, = Field.search([
+                ('model', '=', 'aeat.111.report'),
+                ('name', '=',
+                    'economic_activities_productivity_monetary_'
+                    'withholdings_amount'),
+                ])
+        Mapping.create([{
+                    'type_': 'code',
+                    'aeat111_field': field.id,
+                    'code': [('add', [parent.id])],
+                    }])
+        return tax, parent, child
+
+    def create_ledger_report(self, company, period, **values):
+        return self.create_report(company, year=period.start_date.year,
+            period='%02d' % period.start_date.month, **values)
+
+    def set_config(self, option, value):
+        if not config.has_section('aeat_111'):
+            config.add_section('aeat_111')
+        config.set('aeat_111', option, value)
+        self.addCleanup(config.remove_section, 'aeat_111')
+
+
+class Aeat111TestCase(ReportTestMixin, ModuleTestCase):
     'Test Aeat 111 module'
     module = 'aeat_111'
 
-del ModuleTestCase
+    @with_transaction()
+    def test_calculation_cache_hit(self):
+        "Test calculating reuses a report calculated from the same ledger"
+        pool = Pool()
+        Report = pool.get('aeat.111.report')
+        Party = pool.get('party.party')
+
+        company = create_company()
+        with set_company(company):
+            period, journal, expense, payable = self.create_ledger(company)
+            party = Party(name="Employee")
+            party.save()
+            self.post_move(
+                period, journal, expense, payable, party, Decimal(100))
+            first = self.create_ledger_report(company, period)
+            Report.calculate([first])
+            second = self.create_ledger_report(company, period)
+
+            with patch.object(Report, '_read_ledger_from_replica') as read:
+                Report.calculate([second])
+
+            read.assert_not_called()
+            self.assertEqual(second.state, 'calculated')
+            self.assertEqual(second.work_productivity_monetary_payments,
+                Decimal(100))
+            self.assertEqual(len(second.registers), 1)
+            self.assertEqual(
+                [(r.type_, r.party, r.amount) for r in second.registers],
+                [(r.type_, r.party, r.amount) for r in first.registers])
+
+    @with_transaction()
+    def test_calculation_cache_same_report(self):
+        "Test calculating again a report reuses its own calculation"
+        pool = Pool()
+        Report = pool.get('aeat.111.report')
+        Party = pool.get('party.party')
+        MoveLine = pool.get('account.move.line')
+
+        company = create_company()
+        with set_company(company):
+            period, journal, expense, payable = self.create_ledger(company)
+            party = Party(name="Employee")
+            party.save()
+            move = self.post_move(
+                period, journal, expense, payable, party, Decimal(100))
+            report = self.create_ledger_report(company, period)
+            Report.calculate([report])
+            registers = [(r.type_, r.party, r.amount, r.move_lines)
+                for r in report.registers]
+            Report.draft([report])
+            self.assertEqual(report.registers, ())
+            self.assertEqual(len(report.calculation_registers), 1)
+            report.complementary_declaration = True
+            report.previous_declaration_receipt = '1234567890123'
+            report.save()
+
+            with patch.object(Report, '_read_ledger_from_replica') as read:
+                Report.calculate([report])
+
+            read.assert_not_called()
+            self.assertEqual(report.state, 'calculated')
+            self.assertEqual(report.work_productivity_monetary_payments,
+                Decimal(100))
+            self.assertEqual(report.calculation_registers, ())
+            self.assertEqual(
+                [(r.type_, r.party, r.amount, r.move_lines)
+                    for r in report.registers],
+                registers)
+            with self.assertRaises(UserError):
+                MoveLine.check_aeat111(move.lines)
+
+    @with_transaction()
+    def test_calculation_lock_contention(self):
+        "Test calculating a report locked by another transaction fails"
+        pool = Pool()
+        Report = pool.get('aeat.111.report')
+
+        company = create_company()
+        with set_company(company):
+            report = self.create_report(company)
+
+            with patch.object(Report, '_try_lock_calculation',
+                    return_value=False), \
+                    patch.object(Report, '_read_ledger_from_replica') as read:
+                with self.assertRaises(UserError):
+                    Report.calculate([report])
+
+            read.assert_not_called()
+            self.assertEqual(Report(report.id).state, 'draft')
+
+            # The fingerprint is computed once
+            with patch.object(Report, '_get_calculation_fingerprint',
+                    wraps=Report._get_calculation_fingerprint) as fingerprint:
+                Report.calculate([report])
+            self.assertEqual(fingerprint.call_count, 1)
+            self.assertEqual(report.state, 'calculated')
+
+    @with_transaction()
+    def test_calculation_cache_miss_tax_code(self):
+        "Test calculating reads the ledger when the mapped codes change"
+        pool = Pool()
+        Report = pool.get('aeat.111.report')
+        TaxCode = pool.get('account.tax.code')
+        TaxCodeLine = pool.get('account.tax.code.line')
+
+        company = create_company()
+        with set_company(company):
+            period, *_ = self.create_ledger(company)
+            tax, parent, child = self.create_code_mapping(company)
+            mapping_accounts, mapping_codes = Report._get_mappings(company)
+            periods = [period.id]
+
+            def fingerprint():
+                return Report._get_calculation_fingerprint(
+                    company.id, mapping_accounts, mapping_codes, periods)
+            fingerprints = [fingerprint()]
+
+            # A code moved out of the tree of the mapped code
+            TaxCode.write([child], {'parent': None})
+            fingerprints.append(fingerprint())
+            TaxCode.write([child], {'parent': parent.id})
+            self.assertEqual(fingerprint(), fingerprints[0])
+
+            # A new line of a code of the tree
+            TaxCodeLine.create([{
+                        'code': child.id,
+                        'tax': tax.id,
+                        'amount': 'tax',
+                        'type': 'credit',
+                        }])
+            fingerprints.append(fingerprint())
+            # A line deleted from a code of the tree
+            TaxCodeLine.delete(child.lines)
+            fingerprints.append(fingerprint())
+
+            self.assertEqual(len(set(fingerprints)), len(fingerprints))
+
+    @with_transaction()
+    def test_tax_code_closure(self):
+        "Test the calculation follows the changes of the tax code tree"
+        pool = Pool()
+        Report = pool.get('aeat.111.report')
+        TaxCode = pool.get('account.tax.code')
+        Move = pool.get('account.move')
+
+        company = create_company()
+        with set_company(company):
+            period, journal, expense, payable = self.create_ledger(company)
+            tax, parent, child = self.create_code_mapping(company)
+            move, = Move.create([{
+                        'period': period.id,
+                        'journal': journal.id,
+                        'date': period.start_date,
+                        'lines': [('create', [{
+                                        'account': expense.id,
+                                        'debit': Decimal(15),
+                                        }, {
+                                        'account': payable.id,
+                                        'credit': Decimal(15),
+                                        'party': create_company().party.id,
+                                        'tax_lines': [('create', [{
+                                                        'type': 'tax',
+                                                        'tax': tax.id,
+                                                        'amount': Decimal(15),
+                                                        }])],
+                                        }])],
+                        }])
+            Move.post([move])
+
+            def withholdings():
+                report = self.create_ledger_report(company, period)
+                Report.calculate([report])
+                return (report.
+                    economic_activities_productivity_monetary_withholdings_amount)
+
+            self.assertEqual(Report._get_tax_code_closure(company)[parent.id],
+                {parent.id, child.id})
+            self.assertEqual(withholdings(), Decimal(15))
+
+            TaxCode.write([child], {'parent': None})
+            self.assertEqual(Report._get_tax_code_closure(company)[parent.id],
+                {parent.id})
+            self.assertEqual(withholdings(), Decimal(0))
+
+            # The codes inactive for the periods are not in the tree like for
+            # their amount
+            end_date = period.start_date - datetime.timedelta(days=400)
+            # The amount is validated for the dates of the context
+            with Transaction().set_context(date=end_date):
+                TaxCode.write([child], {
+                        'parent': parent.id,
+                        'end_date': end_date,
+                        })
+            with Transaction().set_context(periods=[period.id]):
+                self.assertEqual(
+                    Report._get_tax_code_closure(company)[parent.id],
+                    {parent.id})
+            self.assertEqual(
+                Report._get_tax_code_closure(company, active=False)[
+                    parent.id],
+                {parent.id, child.id})
+            self.assertEqual(withholdings(), Decimal(0))
+
+            TaxCode.write([child], {'end_date': None})
+            with Transaction().set_context(periods=[period.id]):
+                self.assertEqual(
+                    Report._get_tax_code_closure(company)[parent.id],
+                    {parent.id, child.id})
+            self.assertEqual(withholdings(), Decimal(15))
+
+    @with_transaction()
+    def test_calculate_registers(self):
+        "Test the registers of several parties with moves and invoices"
+        pool = Pool()
+        Report = pool.get('aeat.111.report')
+        Register = pool.get('aeat.111.report.register')
+        Chunk = pool.get('aeat.111.report.calculation.chunk')
+        Party = pool.get('party.party')
+        Invoice = pool.get('account.invoice')
+        Account = pool.get('account.account')
+        TaxCode = pool.get('account.tax.code')
+        Field = pool.get('ir.model.field')
+        Mapping = pool.get('aeat.111.mapping')
+
+        company = create_company()
+        with set_company(company):
+            period, journal, expense, payable = self.create_ledger(company)
+            tax, _, child = self.create_code_mapping(company)
+            # The withholdings of supplier invoices are credited
+            TaxCode.write([child], {
+                    'lines': [('create', [{
+                                    'tax': tax.id,
+                                    'amount': 'tax',
+                                    'type': 'credit',
+                                    }])],
+                    })
+            tax_account, = Account.search([
+                    ('company', '=', company.id),
+                    ('code', '=', '6.3.6'),
+                    ])
+            tax.invoice_account = tax.credit_note_account = tax_account
+            tax.save()
+            set_invoice_sequences(period.fiscalyear).save()
+            field, = Field.search([
+                    ('model', '=', 'aeat.111.report'),
+                    ('name', '=',
+                        'work_productivity_monetary_withholdings_amount'),
+                    ])
+            Mapping.create([{
+                        'type_': 'account',
+                        'debit_credit_type': 'credit',
+                        'aeat111_field': field.id,
+                        'account': [('add', [payable.id])],
+                        }])
+            first, second, third = Party.create([
+                    {'name': "First", 'addresses': [('create', [{}])]},
+                    {'name': "Second", 'addresses': [('create', [{}])]},
+                    {'name': "Third", 'addresses': [('create', [{}])]},
+                    ])
+            for party, amount in [(first, 100), (first, 50), (second, 30)]:
+                self.post_move(
+                    period, journal, expense, payable, party, Decimal(amount))
+            invoices = Invoice.create([{
+                        'type': 'in',
+                        'party': party.id,
+                        'invoice_address': party.address_get().id,
+                        'invoice_date': period.start_date,
+                        'journal': journal.id,
+                        'account': payable.id,
+                        'lines': [('create', [{
+                                        'account': expense.id,
+                                        'quantity': 1,
+                                        'unit_price': Decimal(amount),
+                                        'taxes': [('add', [tax.id])],
+                                        }])],
+                        } for party, amount in [
+                        (second, 200), (third, 100), (third, 40)]])
+            Invoice.post(invoices)
+
+            report = self.create_ledger_report(company, period)
+            Report.calculate([report])
+
+            registers = {(r.type_, r.party): r for r in Register.search([
+                        ('report', '=', report.id),
+                        ])}
+            self.assertEqual(
+                {k: r.amount for k, r in registers.items()}, {
+                    ('work_payment', None): Decimal(520),
+                    ('work_amount', first): Decimal(150),
+                    # The invoices without their withholding
+                    ('work_amount', second): Decimal(200),
+                    ('work_amount', third): Decimal(119),
+                    ('economic_activity', second): Decimal(30),
+                    ('economic_activity', third): Decimal(21),
+                    })
+            self.assertEqual(
+                len(registers['work_amount', first].move_lines), 2)
+            self.assertEqual(
+                len(registers['economic_activity', third].invoices), 2)
+            self.assertEqual(report.work_productivity_monetary_parties, 3)
+            self.assertEqual(
+                report.economic_activities_productivity_monetary_parties, 2)
+            self.assertEqual(
+                report.work_productivity_monetary_withholdings_amount,
+                Decimal(469))
+
+            # The accumulators are the same once stored in a chunk
+            mapping_accounts, mapping_codes = Report._get_mappings(company)
+            _, _, _, accumulators = Report._read_ledger(company.id,
+                mapping_accounts, mapping_codes, [period.id])
+            loaded = {}
+            Chunk.load_accumulators(
+                Chunk.dump_accumulators(accumulators), 2, loaded)
+            self.assertEqual(
+                {k: a.amount for k, a in loaded.items()},
+                {(r.type_, r.party.id if r.party else None): r.amount
+                    for r in registers.values()})
+
+            # The simulation of the mappings gives the calculated fields
+            result, without_codes = Report.simulate_mappings([report], [
+                    (mapping_accounts, mapping_codes),
+                    (mapping_accounts, {}),
+                    ])
+            self.assertEqual(result[report.id], {
+                    f: getattr(report, f) for f in result[report.id]})
+            self.assertEqual(
+                result[report.id][
+                    'economic_activities_productivity_monetary_'
+                    'withholdings_amount'],
+                Decimal(51))
+            self.assertEqual(
+                result[report.id][
+                    'economic_activities_productivity_monetary_parties'],
+                2)
+            self.assertNotIn(
+                'economic_activities_productivity_monetary_'
+                'withholdings_amount',
+                without_codes[report.id])
+            self.assertEqual(
+                without_codes[report.id][
+                    'economic_activities_productivity_monetary_parties'],
+                0)
+
+    @with_transaction()
+    def test_check_registers(self):
+        "Test processing warns when the registers disagree with the totals"
+        pool = Pool()
+        Report = pool.get('aeat.111.report')
+        Register = pool.get('aeat.111.report.register')
+        Party = pool.get('party.party')
+
+        company = create_company()
+        with set_company(company):
+            period, journal, expense, payable = self.create_ledger(company)
+            party = Party(name="Employee")
+            party.save()
+            self.post_move(
+                period, journal, expense, payable, party, Decimal(100))
+            report = self.create_ledger_report(company, period,
+                work_productivity_monetary_withholdings_amount=Decimal(0))
+            Report.calculate([report])
+            register, = report.registers
+            Register.write([register], {'amount': Decimal(60)})
+
+            Report.check_registers([report])
+
+            self.assertEqual(report.register_differences,
+                'Work Payment: 100.00 / 60.00')
+            with self.assertRaises(UserWarning):
+                Report.process([report])
+            self.assertEqual(Report(report.id).state, 'calculated')
+
+    @with_transaction()
+    def test_check_registers_agree(self):
+        "Test processing does not warn when the registers agree"
+        pool = Pool()
+        Report = pool.get('aeat.111.report')
+        Party = pool.get('party.party')
+
+        company = create_company()
+        with set_company(company):
+            period, journal, expense, payable = self.create_ledger(company)
+            for name, amount in [("Employee", 100), ("Other", 30)]:
+                party = Party(name=name)
+                party.save()
+                self.post_move(
+                    period, journal, expense, payable, party,
+                    Decimal(amount))
+            report = self.create_ledger_report(company, period,
+                work_productivity_monetary_withholdings_amount=Decimal(0))
+            Report.calculate([report])
+
+            self.assertIsNone(report.register_differences)
+            Report.process([report])
+            self.assertEqual(report.state, 'done')
+
+    @with_transaction()
+    def test_draft_deletes_registers(self):
+        "Test going back to draft deletes the registers"
+        pool = Pool()
+        Report = pool.get('aeat.111.report')
+        Party = pool.get('party.party')
+        MoveLine = pool.get('account.move.line')
+
+        company = create_company()
+        with set_company(company):
+            period, journal, expense, payable = self.create_ledger(company)
+            party = Party(name="Employee")
+            party.save()
+            move = self.post_move(
+                period, journal, expense, payable, party, Decimal(100))
+            report = self.create_ledger_report(company, period)
+            Report.calculate([report])
+            self.assertEqual(len(report.registers), 1)
+
+            Report.draft([report])
+            self.assertEqual(report.registers, ())
+            # The calculation is kept to be reused
+            self.assertNotEqual(report.calculation_fingerprint, None)
+            # The lines of the draft report are no more protected
+            MoveLine.check_aeat111(move.lines)
+
+    @with_transaction()
+    def test_company_fields(self):
+        "Test the company fields are read with one query for all records"
+        pool = Pool()
+        Report = pool.get('aeat.111.report')
+        Register = pool.get('aeat.111.report.register')
+
+        company = create_company()
+        with set_company(company):
+            reports = [self.create_report(company, period='%02d' % m)
+                for m in range(1, 13)]
+            registers = Register.create([{
+                        'report': r.id,
+                        'type_': 'work_payment',
+                        'amount': Decimal(1),
+                        } for r in reports])
+
+            connection = QueryCounter(Transaction().connection)
+            with patch.object(Transaction(), 'connection', connection):
+                report_fields = Report.get_company_fields(
+                    reports, ['currency', 'company_party'])
+                register_fields = Register.get_report_fields(
+                    registers, ['company', 'currency'])
+            self.assertEqual(len(connection.queries), 2)
+            self.assertEqual(set(report_fields['currency'].values()),
+                {company.currency.id})
+            self.assertEqual(set(register_fields['company'].values()),
+                {company.id})
+
+    @with_transaction()
+    def test_link_documents(self):
+        "Test the documents of the registers are linked in bulk"
+        pool = Pool()
+        Register = pool.get('aeat.111.report.register')
+        Move = pool.get('account.move')
+
+        company = create_company()
+        with set_company(company):
+            period, journal, expense, payable = self.create_ledger(company)
+            move, = Move.create([{
+                        'period': period.id,
+                        'journal': journal.id,
+                        'date': period.start_date,
+                        'lines': [('create', [{
+                                        'account': expense.id,
+                                        'debit': Decimal(1),
+                                        }] * 50)],
+                        }])
+            report = self.create_report(company)
+            registers = Register.create([{
+                        'report': report.id,
+                        'type_': 'work_payment',
+                        'amount': Decimal(25),
+                        }] * 2)
+            move_lines = [(registers[i % 2].id, l.id)
+                for i, l in enumerate(move.lines)]
+
+            connection = QueryCounter(Transaction().connection)
+            with patch.object(Transaction(), 'connection', connection):
+                Register.link_documents(move_lines=move_lines)
+                links, _ = Register.get_document_links(
+                    [r.id for r in registers])
+            # One query by table to link and one by table to read
+            self.assertEqual(len(connection.queries), 1 + 2)
+            self.assertEqual(sorted(links), sorted(move_lines))
+
+            connection = QueryCounter(Transaction().connection)
+            with patch.object(Transaction(), 'connection', connection), \
+                    patch('trytond.model.ModelSQL.delete'):
+                Register.delete(registers)
+            self.assertEqual(len(connection.queries), 2)
+
+    @with_transaction()
+    def test_archive_registers(self):
+        "Test archiving registers keeps them and their documents"
+        pool = Pool()
+        Report = pool.get('aeat.111.report')
+        Register = pool.get('aeat.111.report.register')
+        Party = pool.get('party.party')
+        MoveLine = pool.get('account.move.line')
+        Date = pool.get('ir.date')
+
+        company = create_company()
+        with set_company(company):
+            period, journal, expense, payable = self.create_ledger(company)
+            party = Party(name="Employee")
+            party.save()
+            move = self.post_move(
+                period, journal, expense, payable, party, Decimal(100))
+            report = self.create_ledger_report(company, period)
+            Report.calculate([report])
+            register, = report.registers
+            lines = register.move_lines
+            Report.write([report], {
+                    'state': 'done',
+                    'year': Date.today().year - 5,
+                    })
+
+            Register.archive(years=2)
+            Transaction().cache.clear()
+
+            report = Report(report.id)
+            self.assertEqual(report.registers, ())
+            archived, = report.archived_registers
+            self.assertEqual(archived.id, register.id)
+            self.assertEqual(archived.amount, Decimal(100))
+            self.assertEqual(archived.move_lines, lines)
+            self.assertEqual(Register.search([
+                        ('report', '=', report.id),
+                        ]), [])
+            with self.assertRaises(UserError):
+                MoveLine.check_aeat111(move.lines)
+            stream = io.StringIO()
+            report.write_registers(stream)
+            self.assertIn('Move Line', stream.getvalue())
+
+            Register.unarchive([report])
+            Transaction().cache.clear()
+
+            report = Report(report.id)
+            self.assertEqual(report.archived_registers, ())
+            current, = report.registers
+            self.assertEqual(current.id, register.id)
+            self.assertEqual(current.move_lines, lines)
+
+            # The archived registers are also deleted by going back to draft
+            Register.archive(years=2)
+            Report.write([report], {'state': 'calculated'})
+            Transaction().cache.clear()
+            Report.draft([Report(report.id)])
+            self.assertEqual(Report(report.id).archived_registers, ())
+            MoveLine.check_aeat111(move.lines)
+
+    @with_transaction()
+    def test_register_all(self):
+        "Test the current and archived registers are searched together"
+        pool = Pool()
+        Register = pool.get('aeat.111.report.register')
+        RegisterAll = pool.get('aeat.111.report.register.all')
+        Party = pool.get('party.party')
+        Date = pool.get('ir.date')
+
+        company = create_company()
+        with set_company(company):
+            party = Party(name="Employee")
+            party.save()
+            year = Date.today().year
+            old = self.create_report(company, year=year - 5, state='done')
+            current = self.create_report(company, year=year, state='done')
+            Register.create([{
+                        'report': old.id,
+                        'type_': 'work_payment',
+                        'party': party.id,
+                        'amount': Decimal(100),
+                        }, {
+                        'report': current.id,
+                        'type_': 'work_payment',
+                        'party': party.id,
+                        'amount': Decimal(50),
+                        }])
+
+            Register.archive(years=2)
+
+            registers = RegisterAll.search([
+                    ('company', '=', company.id),
+                    ('party', '=', party.id),
+                    ], order=[('year', 'ASC')])
+            self.assertEqual(
+                [(r.report, r.year, r.amount, r.archived)
+                    for r in registers],
+                [(old, year - 5, Decimal(100), True),
+                    (current, year, Decimal(50), False)])
+            self.assertEqual(
+                list(Register.get_yearly_totals(company, year - 5)),
+                [(party.id, 'work_payment', Decimal(100))])
+
+    @with_transaction()
+    def test_delete_report(self):
+        "Test deleting a report deletes its registers and their links"
+        pool = Pool()
+        Report = pool.get('aeat.111.report')
+        Register = pool.get('aeat.111.report.register')
+        Party = pool.get('party.party')
+        MoveLine = pool.get('account.move.line')
+
+        company = create_company()
+        with set_company(company):
+            period, journal, expense, payable = self.create_ledger(company)
+            party = Party(name="Employee")
+            party.save()
+            move = self.post_move(
+                period, journal, expense, payable, party, Decimal(100))
+            report = self.create_ledger_report(company, period)
+            Report.calculate([report])
+            register, = report.registers
+            Report.cancel([report])
+
+            Report.delete([report])
+
+            self.assertEqual(Register.search([
+                        ('id', '=', register.id),
+                        ]), [])
+            MoveLine.check_aeat111(move.lines)
+
+    @with_transaction()
+    def test_stale_move_line_write(self):
+        "Test only writing the computed fields of move lines changes ledger"
+        pool = Pool()
+        Move = pool.get('account.move')
+        MoveLine = pool.get('account.move.line')
+        LedgerChange = pool.get('aeat.111.ledger.change')
+        Party = pool.get('party.party')
+
+        company = create_company()
+        with set_company(company):
+            period, journal, expense, payable = self.create_ledger(company)
+            party = Party(name="Employee")
+            party.save()
+            move, = Move.create([{
+                        'period': period.id,
+                        'journal': journal.id,
+                        'date': period.start_date,
+                        'lines': [('create', [{
+                                        'account': expense.id,
+                                        'debit': Decimal(100),
+                                        }])],
+                        }])
+            line, = move.lines
+            changes = LedgerChange.search([('period', '=', period.id)])
+
+            MoveLine.write([line], {'description': "Salary"})
+            self.assertEqual(
+                LedgerChange.search([('period', '=', period.id)]), changes)
+
+            MoveLine.write([line], {'debit': Decimal(50)})
+            self.assertGreater(
+                len(LedgerChange.search([('period', '=', period.id)])),
+                len(changes))
+
+    @with_transaction()
+    def test_touch_move_lines(self):
+        "Test touching the ledger of move lines has a constant cost"
+        pool = Pool()
+        Move = pool.get('account.move')
+        MoveLine = pool.get('account.move.line')
+        LedgerChange = pool.get('aeat.111.ledger.change')
+
+        company = create_company()
+        with set_company(company):
+            period, journal, expense, payable = self.create_ledger(company)
+            move, = Move.create([{
+                        'period': period.id,
+                        'journal': journal.id,
+                        'date': period.start_date,
+                        'lines': [('create', [{
+                                        'account': expense.id,
+                                        'debit': Decimal(1),
+                                        }] * 50)],
+                        }])
+            lines = list(move.lines)
+            # Fill the cache of the mapped accounts
+            LedgerChange._get_mapped(company.id)
+
+            connection = QueryCounter(Transaction().connection)
+            with patch.object(Transaction(), 'connection', connection):
+                LedgerChange.touch_move_lines(lines)
+            # One query to find the periods and one to record them
+            self.assertEqual(len(connection.queries), 2)
+
+            with patch.object(LedgerChange, 'touch') as touch:
+                MoveLine.write(lines, {'debit': Decimal(2)})
+            touch.assert_called_once_with({period.id})
+
+    @with_transaction()
+    def test_yearly_totals(self):
+        "Test the yearly totals take the last done report of each period"
+        pool = Pool()
+        Report = pool.get('aeat.111.report')
+        Register = pool.get('aeat.111.report.register')
+        Party = pool.get('party.party')
+
+        company = create_company()
+        with set_company(company):
+            party = Party(name="Employee")
+            party.save()
+            first = self.create_report(company, period='01')
+            complementary = self.create_report(company, period='01')
+            second = self.create_report(company, period='02')
+            draft = self.create_report(company, period='03')
+            Report.write([first, complementary, second], {'state': 'done'})
+            Register.create([{
+                        'report': r.id,
+                        'type_': 'work_amount',
+                        'party': party.id,
+                        'amount': amount,
+                        } for r, amount in [
+                        (first, Decimal(10)),
+                        (complementary, Decimal(15)),
+                        (second, Decimal(20)),
+                        (draft, Decimal(40)),
+                        ]])
+
+            self.assertEqual(list(Report.get_yearly_totals(company, 2024)), [
+                    (party.id, 'work_amount', Decimal(35)),
+                    ])
+
+    @with_transaction()
+    def test_yearly_totals_mixed_periods(self):
+        "Test the yearly totals do not count twice the months of a quarter"
+        pool = Pool()
+        Report = pool.get('aeat.111.report')
+        Register = pool.get('aeat.111.report.register')
+        Party = pool.get('party.party')
+
+        company = create_company()
+        with set_company(company):
+            party = Party(name="Employee")
+            party.save()
+            january = self.create_report(company, period='01')
+            quarter = self.create_report(company, period='1T')
+            april = self.create_report(company, period='04')
+            Report.write([january, quarter, april], {'state': 'done'})
+            Register.create([{
+                        'report': r.id,
+                        'type_': 'work_amount',
+                        'party': party.id,
+                        'amount': amount,
+                        } for r, amount in [
+                        (january, Decimal(10)),
+                        (quarter, Decimal(30)),
+                        (april, Decimal(5)),
+                        ]])
+
+            self.assertEqual(list(Report.get_yearly_totals(company, 2024)), [
+                    (party.id, 'work_amount', Decimal(35)),
+                    ])
+
+    @with_transaction()
+    def test_check_move_lines_and_invoices(self):
+        "Test the documents of a report register cannot be changed"
+        pool = Pool()
+        Register = pool.get('aeat.111.report.register')
+        Party = pool.get('party.party')
+        MoveLine = pool.get('account.move.line')
+        Invoice = pool.get('account.invoice')
+
+        company = create_company()
+        with set_company(company):
+            period, journal, expense, payable = self.create_ledger(company)
+            party = Party(name="Employee", addresses=[{}])
+            party.save()
+            moves = [self.post_move(
+                    period, journal, expense, payable, party, Decimal(10))
+                for _ in range(3)]
+            invoice, other = Invoice.create([{
+                        'type': 'in',
+                        'party': party.id,
+                        'invoice_address': party.address_get().id,
+                        'account': payable.id,
+                        }] * 2)
+            report = self.create_report(company)
+            register, orphan = Register.create([{
+                        'report': report.id,
+                        'type_': 'work_amount',
+                        'amount': Decimal(10),
+                        }, {
+                        'type_': 'work_amount',
+                        'amount': Decimal(10),
+                        }])
+            linked = moves[1].lines[0]
+            Register.link_documents(
+                move_lines=[
+                    (register.id, linked.id),
+                    (orphan.id, moves[2].lines[0].id),
+                    ],
+                invoices=[(register.id, invoice.id), (orphan.id, other.id)])
+            lines = [l for m in moves for l in m.lines]
+
+            with self.assertRaisesRegex(UserError, linked.rec_name):
+                MoveLine.check_aeat111(lines)
+            with self.assertRaisesRegex(UserError, invoice.rec_name):
+                Invoice.check_aeat111([other, invoice])
+            # The documents of registers without report are not checked
+            # with one query by register table for all the documents
+            connection = QueryCounter(Transaction().connection)
+            with patch.object(Transaction(), 'connection', connection):
+                MoveLine.check_aeat111(
+                    [l for l in lines if l != linked])
+            self.assertEqual(len(connection.queries), 2)
+            connection = QueryCounter(Transaction().connection)
+            with patch.object(Transaction(), 'connection', connection):
+                Invoice.check_aeat111([other])
+            self.assertEqual(len(connection.queries), 2)
+
+    @with_transaction()
+    def test_export_registers(self):
+        "Test exporting the registers stores them in the file store"
+        pool = Pool()
+        Report = pool.get('aeat.111.report')
+        Register = pool.get('aeat.111.report.register')
+        Party = pool.get('party.party')
+
+        company = create_company()
+        with set_company(company):
+            period, journal, expense, payable = self.create_ledger(company)
+            party = Party(name="Employee", identifiers=[{
+                        'type': 'es_vat',
+                        'code': '00000000T',
+                        }])
+            party.save()
+            other = Party(name="Other")
+            other.save()
+            move = self.post_move(
+                period, journal, expense, payable, party, Decimal(100))
+            report = self.create_ledger_report(company, period)
+            register, other_register = Register.create([{
+                        'report': report.id,
+                        'type_': 'work_amount',
+                        'party': party.id,
+                        'amount': Decimal('100.00'),
+                        }, {
+                        'report': report.id,
+                        'type_': 'work_amount',
+                        'party': other.id,
+                        'amount': Decimal('50.00'),
+                        }])
+            Register.link_documents(
+                move_lines=[(register.id, l.id) for l in move.lines])
+
+            # Read the registers by chunks of one
+            with patch.object(backend, 'MAX_QUERY_PARAMS', 1):
+                report.export_registers()
+
+            report = Report(report.id)
+            self.assertTrue(report.registers_file_id)
+            self.assertEqual(report.registers_filename,
+                'aeat111-registers-%s-%s.csv' % (report.year, report.period))
+            rows = list(csv.reader(
+                    io.StringIO(report.registers_file.decode('utf-8'))))
+            self.assertEqual(rows, [
+                    ['Party', 'VAT', 'Type', 'Amount', 'Document Type',
+                        'Document'],
+                    ] + [
+                    ['Employee', '00000000T', 'Work Amount', '100.00',
+                        'Move Line', '%s/%s' % (move.number, l.id)]
+                    for l in sorted(move.lines, key=lambda l: l.id)] + [
+                    ['Other', '', 'Work Amount', '50.00', '', ''],
+                    ])
+
+    @with_transaction()
+    def test_register_without_report(self):
+        "Test reading the report fields of a register without report"
+        pool = Pool()
+        Register = pool.get('aeat.111.report.register')
+
+        company = create_company()
+        with set_company(company):
+            report = self.create_report(company)
+            register, orphan = Register.create([{
+                        'report': report.id,
+                        'type_': 'work_amount',
+                        'amount': Decimal(10),
+                        }, {
+                        'type_': 'work_amount',
+                        'amount': Decimal(20),
+                        }])
+
+            self.assertEqual(Register.read(
+                    [register.id, orphan.id], ['company', 'currency']), [{
+                        'id': register.id,
+                        'company': company.id,
+                        'currency': company.currency.id,
+                        }, {
+                        'id': orphan.id,
+                        'company': None,
+                        'currency': None,
+                        }])
+
+    @with_transaction()
+    def test_read_payroll(self):
+        "Test importing the payroll replaces the previous import"
+        pool = Pool()
+        Report = pool.get('aeat.111.report')
+        Party = pool.get('party.party')
+
+        company = create_company()
+        with set_company(company):
+            period, journal, expense, payable = self.create_ledger(company)
+            party = Party(name="Employee")
+            party.save()
+            employee = Party(name="Payroll", identifiers=[{
+                        'code': '12345678Z',
+                        }])
+            employee.save()
+            other = Party(name="Other", identifiers=[{
+                        'code': '87654321X',
+                        }])
+            other.save()
+            self.post_move(
+                period, journal, expense, payable, party, Decimal(100))
+            report = self.create_ledger_report(company, period)
+            payroll = io.StringIO(
+                'vat,type,payment,withholding\n'
+                '12345678Z,work,1000,150\n'
+                '87654321X,work,0,0\n')
+
+            with self.assertRaises(UserError):
+                report.read_payroll(payroll)
+
+            Report.calculate([report])
+            for _ in range(2):
+                payroll.seek(0)
+                report.read_payroll(payroll)
+
+            self.assertEqual(report.work_productivity_monetary_payments,
+                Decimal(1100))
+            self.assertEqual(
+                report.work_productivity_monetary_withholdings_amount,
+                Decimal(150))
+            self.assertEqual(report.work_productivity_monetary_parties, 1)
+            self.assertEqual(sorted(
+                    (r.type_, r.party, r.amount) for r in report.registers
+                    if r.payroll), [
+                    ('work_amount', employee, Decimal(150)),
+                    ('work_payment', employee, Decimal(1000)),
+                    ])
+            self.assertIsNone(report.calculation_fingerprint)
+
+    @with_transaction()
+    def test_mapping_analysis(self):
+        "Test the check reports an account mapped to several fields"
+        pool = Pool()
+        Field = pool.get('ir.model.field')
+        Mapping = pool.get('aeat.111.mapping')
+
+        company = create_company()
+        with set_company(company):
+            period, journal, expense, payable = self.create_ledger(company)
+            Mapping.check_analysis(company)
+            field, = Field.search([
+                    ('model', '=', 'aeat.111.report'),
+                    ('name', '=',
+                        'work_productivity_monetary_withholdings_amount'),
+                    ])
+            Mapping.create([{
+                        'type_': 'account',
+                        'debit_credit_type': 'credit',
+                        'aeat111_field': field.id,
+                        'account': [('add', [expense.id])],
+                        }])
+
+            self.assertEqual(Mapping.analyze(company), [
+                    'The account "%s" is mapped to several fields: '
+                    'work_productivity_monetary_payments, '
+                    'work_productivity_monetary_withholdings_amount.'
+                    % expense.rec_name])
+            with self.assertRaises(UserError):
+                Mapping.check_mappings(Mapping.search([
+                            ('company', '=', company.id),
+                            ]))
+            with self.assertLogs(aeat.logger, 'WARNING') as logs:
+                Mapping.log_analysis(company)
+            self.assertEqual(len(logs.output), 1)
+
+    @with_transaction()
+    def test_mapping_analysis_chart(self):
+        "Test the mappings are analyzed when the chart is created"
+        pool = Pool()
+        Mapping = pool.get('aeat.111.mapping')
+
+        company = create_company()
+        with set_company(company), \
+                patch.object(Mapping, 'log_analysis') as log_analysis:
+            create_chart(company)
+        log_analysis.assert_called_once_with(company.id)
+
+    @with_transaction()
+    def test_register_analytic_previous_amount(self):
+        "Test the previous amount is the one of the period just before"
+        pool = Pool()
+        Report = pool.get('aeat.111.report')
+        Register = pool.get('aeat.111.report.register')
+        Analytic = pool.get('aeat.111.report.register.analytic')
+        Party = pool.get('party.party')
+
+        company = create_company()
+        with set_company(company):
+            party = Party(name="Employee")
+            party.save()
+            reports = []
+            for year, period, amount in [
+                    (2023, '12', 10),
+                    (2024, '01', 20),
+                    (2024, '03', 30),
+                    (2024, '1T', 40),
+                    (2024, '2T', 50),
+                    ]:
+                report = self.create_report(company, year=year, period=period)
+                Register.create([{
+                            'report': report.id,
+                            'type_': 'work_amount',
+                            'party': party.id,
+                            'amount': Decimal(amount),
+                            }])
+                reports.append(report)
+            Report.write(reports, {'state': 'done'})
+
+            self.assertEqual(
+                [(a.year, a.period, a.previous_amount)
+                    for a in Analytic.search([
+                            ('company', '=', company.id),
+                            ], order=[('id', 'ASC')])], [
+                    (2023, '12', None),
+                    (2024, '01', Decimal(10)),
+                    (2024, '03', None),
+                    (2024, '1T', None),
+                    (2024, '2T', Decimal(40)),
+                    ])
+            # The previous period is found out of the filtered years
+            january, = Analytic.search([
+                    ('company', '=', company.id),
+                    ('year', '=', 2024),
+                    ('period', '=', '01'),
+                    ])
+            self.assertEqual(january.previous_amount, Decimal(10))
+            self.assertEqual(january.variation, 1)
+
+    @with_transaction()
+    def test_register_analytic_archived(self):
+        "Test the analytics read the archived registers"
+        pool = Pool()
+        Report = pool.get('aeat.111.report')
+        Register = pool.get('aeat.111.report.register')
+        Analytic = pool.get('aeat.111.report.register.analytic')
+        Party = pool.get('party.party')
+        Date = pool.get('ir.date')
+
+        company = create_company()
+        with set_company(company):
+            party = Party(name="Employee")
+            party.save()
+            year = Date.today().year
+            reports = []
+            for year_, period, amount in [
+                    (year - 5, '12', 10),
+                    (year - 5, '4T', 30),
+                    (year - 4, '01', 20),
+                    (year, '01', 40),
+                    ]:
+                report = self.create_report(
+                    company, year=year_, period=period)
+                Register.create([{
+                            'report': report.id,
+                            'type_': 'work_amount',
+                            'party': party.id,
+                            'amount': Decimal(amount),
+                            }])
+                reports.append(report)
+            Report.write(reports, {'state': 'done'})
+
+            Register.archive(years=2)
+            self.assertEqual(Register.search([
+                        ('report', 'in', [r.id for r in reports]),
+                        ]), list(reports[-1].registers))
+
+            self.assertEqual(
+                [(a.year, a.period, a.amount, a.registers, a.previous_amount)
+                    for a in Analytic.search([
+                            ('company', '=', company.id),
+                            ], order=[('id', 'ASC')])], [
+                    (year - 5, '12', Decimal(10), 1, None),
+                    (year - 5, '4T', Decimal(30), 1, None),
+                    (year - 4, '01', Decimal(20), 1, Decimal(10)),
+                    (year, '01', Decimal(40), 1, None),
+                    ])
+
+    @with_transaction()
+    def test_update_to_deduce(self):
+        "Test to deduce sums the results of the earlier done reports"
+        pool = Pool()
+        Report = pool.get('aeat.111.report')
+
+        company = create_company()
+        with set_company(company):
+            first = self.create_report(company, state='done',
+                work_productivity_monetary_withholdings_amount=Decimal(100))
+            second = self.create_report(company,
+                complementary_declaration=True,
+                previous_declaration_receipt='1234567890123',
+                work_productivity_monetary_withholdings_amount=Decimal(150))
+            # Other periods and states are not deduced
+            self.create_report(company, period='02', state='done',
+                work_productivity_monetary_withholdings_amount=Decimal(10))
+            self.create_report(company, state='cancelled',
+                work_productivity_monetary_withholdings_amount=Decimal(20))
+
+            Report.update_to_deduce([first, second])
+            self.assertEqual(first.to_deduce, Decimal(0))
+            self.assertEqual(second.to_deduce, Decimal(100))
+            self.assertEqual(second.result, Decimal(50))
+
+            Report.write([second], {'state': 'done'})
+            third = self.create_report(company,
+                complementary_declaration=True,
+                previous_declaration_receipt='1234567890124',
+                work_productivity_monetary_withholdings_amount=Decimal(180))
+            reports = Report.browse([second.id, third.id])
+            for report in reports:
+                report.complementary_declaration, report.to_deduce
+
+            connection = QueryCounter(Transaction().connection)
+            with patch.object(Transaction(), 'connection', connection), \
+                    patch.object(Report, 'write') as write:
+                Report.update_to_deduce(reports)
+
+            self.assertEqual(len(connection.queries), 1)
+            write.assert_called_once_with([third], {
+                    'to_deduce': Decimal(150),
+                    })
+
+    @with_transaction()
+    def test_update_to_deduce_without_previous(self):
+        "Test to deduce is kept without earlier done report"
+        pool = Pool()
+        Report = pool.get('aeat.111.report')
+
+        company = create_company()
+        with set_company(company):
+            # The original declaration was filed outside
+            report = self.create_report(company,
+                complementary_declaration=True,
+                previous_declaration_receipt='1234567890123',
+                to_deduce=Decimal(80),
+                work_productivity_monetary_withholdings_amount=Decimal(150))
+
+            Report.update_to_deduce([report])
+            self.assertEqual(report.to_deduce, Decimal(80))
+            self.assertEqual(report.result, Decimal(70))
+
+    @with_transaction()
+    def test_create_file_unchanged(self):
+        "Test creating the file again only regenerates it on changes"
+        pool = Pool()
+        Report = pool.get('aeat.111.report')
+
+        company = create_company()
+        with set_company(company):
+            report = self.create_report(company,
+                company_vat='B12345678',
+                company_surname="DUNDER MIFFLIN",
+                work_productivity_monetary_parties=2,
+                work_productivity_monetary_payments=Decimal(1000),
+                work_productivity_monetary_withholdings_amount=Decimal(150),
+                )
+            report.create_file()
+            data, file_hash = report.file_, report.file_hash
+
+            with patch.object(aeat, 'retrofix_write') as write, \
+                    patch.object(Report, 'write') as write_report:
+                report.create_file()
+            write.assert_not_called()
+            write_report.assert_not_called()
+
+            report.work_productivity_monetary_withholdings_amount = (
+                Decimal(200))
+            report.save()
+            report.create_file()
+            report = Report(report.id)
+            self.assertNotEqual(report.file_hash, file_hash)
+            self.assertNotEqual(report.file_, data)
+            self.assertIn(b'20000', report.file_)
+
+    @with_transaction()
+    def test_party_canonical(self):
+        "Test the parties with the same tax code share one register"
+        pool = Pool()
+        Report = pool.get('aeat.111.report')
+        Party = pool.get('party.party')
+        Identifier = pool.get('party.identifier')
+        PartyCanonical = pool.get('aeat.111.party.canonical')
+        Field = pool.get('ir.model.field')
+        Mapping = pool.get('aeat.111.mapping')
+
+        company = create_company()
+        with set_company(company):
+            period, journal, expense, payable = self.create_ledger(company)
+            field, = Field.search([
+                    ('model', '=', 'aeat.111.report'),
+                    ('name', '=',
+                        'work_productivity_monetary_withholdings_amount'),
+                    ])
+            Mapping.create([{
+                        'type_': 'account',
+                        'debit_credit_type': 'credit',
+                        'aeat111_field': field.id,
+                        'account': [('add', [payable.id])],
+                        }])
+            first, second = Party.create([{
+                        'name': "Employee",
+                        'identifiers': [('create', [{
+                                        'type': 'es_vat',
+                                        'code': '12345678Z',
+                                        }])],
+                        }, {
+                        'name': "Employee (duplicate)",
+                        'identifiers': [('create', [{
+                                        'type': 'es_vat',
+                                        'code': 'ES12345678-Z',
+                                        }])],
+                        }])
+            for party, amount in [(first, 100), (second, 50)]:
+                self.post_move(
+                    period, journal, expense, payable, party, Decimal(amount))
+
+            def registers():
+                report = self.create_ledger_report(company, period)
+                Report.calculate([report])
+                return sorted((r.party, r.amount) for r in report.registers
+                    if r.type_ == 'work_amount')
+
+            self.assertEqual(
+                PartyCanonical.get_canonical([first.id, second.id]),
+                {first.id: first.id, second.id: first.id})
+            self.assertEqual(registers(), [(first, Decimal(150))])
+
+            # A changed tax code splits the register
+            identifier, = second.identifiers
+            Identifier.write([identifier], {'code': '87654321X'})
+            self.assertEqual(
+                PartyCanonical.get_canonical([first.id, second.id]),
+                {first.id: first.id, second.id: second.id})
+            self.assertEqual(registers(),
+                [(first, Decimal(100)), (second, Decimal(50))])
+
+            # A party without tax code is its own canonical
+            Identifier.delete([identifier])
+            self.assertEqual(PartyCanonical.search([
+                        ('party', '=', second.id),
+                        ]), [])
+            self.assertEqual(
+                PartyCanonical.get_canonical([second.id]),
+                {second.id: second.id})
+
+    @with_transaction()
+    def test_party_canonical_refresh_all(self):
+        "Test refreshing all the parties rebuilds the canonical rows"
+        pool = Pool()
+        Party = pool.get('party.party')
+        PartyCanonical = pool.get('aeat.111.party.canonical')
+
+        parties = Party.create([{
+                    'name': "Employee %s" % i,
+                    'identifiers': [('create', [{
+                                    'type': 'es_vat',
+                                    'code': '12345678Z',
+                                    }])],
+                    } for i in range(10)])
+        canonical = parties[0]
+        table = PartyCanonical.__table__()
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*table.delete())
+
+        PartyCanonical.refresh_all()
+
+        self.assertEqual(
+            PartyCanonical.get_canonical([p.id for p in parties]),
+            {p.id: canonical.id for p in parties})
+
+        # The parties are refreshed with a constant number of queries
+        connection = QueryCounter(Transaction().connection)
+        with patch.object(Transaction(), 'connection', connection):
+            PartyCanonical.refresh([p.id for p in parties])
+        self.assertEqual(len(connection.queries), 6)
+
+    @with_transaction()
+    def test_party_canonical_delete(self):
+        "Test deleting the canonical party moves it to another duplicate"
+        pool = Pool()
+        Party = pool.get('party.party')
+        Identifier = pool.get('party.identifier')
+        PartyCanonical = pool.get('aeat.111.party.canonical')
+
+        parties = Party.create([{
+                    'name': "Employee %s" % i,
+                    'identifiers': [('create', [{
+                                    'type': 'es_vat',
+                                    'code': '12345678Z',
+                                    }])],
+                    } for i in range(3)])
+        canonical, *duplicates = parties
+        self.assertEqual(
+            PartyCanonical.get_canonical([p.id for p in duplicates]),
+            {p.id: canonical.id for p in duplicates})
+
+        # Remove the identifier without refreshing so the canonical rows are
+        # still pointing to the deleted party
+        table = Identifier.__table__()
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*table.delete(where=table.party == canonical.id))
+        Party.delete([canonical])
+
+        self.assertEqual(
+            PartyCanonical.get_canonical([p.id for p in duplicates]),
+            {p.id: duplicates[0].id for p in duplicates})
+        self.assertEqual(len(PartyCanonical.search([
+                        ('party', 'in', [p.id for p in duplicates]),
+                        ])), 2)
+
+    @with_transaction()
+    def test_import_files(self):
+        "Test importing the file created by a report"
+        pool = Pool()
+        Report = pool.get('aeat.111.report')
+
+        company = create_company()
+        company.party.identifiers = [{
+                'type': 'eu_vat',
+                'code': 'ESB12345674',
+                }]
+        company.party.save()
+        other = create_company()
+        with set_company(company):
+            report = self.create_report(company,
+                company_vat='B12345674',
+                company_surname="DUNDER MIFFLIN",
+                work_productivity_monetary_parties=2,
+                work_productivity_monetary_payments=Decimal('1000.50'),
+                work_productivity_monetary_withholdings_amount=Decimal(150),
+                )
+            report.create_file()
+            data = report.file_
+            values = Report.read([report.id], [
+                    'type', 'year', 'period', 'company_vat',
+                    'work_productivity_monetary_parties',
+                    'work_productivity_monetary_payments',
+                    'work_productivity_monetary_withholdings_amount',
+                    ])[0]
+            del values['id']
+            Report.delete([report])
+
+            directory = tempfile.mkdtemp()
+            self.addCleanup(os.rmdir, directory)
+            self.set_config('import_directory', directory)
+            filename = os.path.join(directory, '111.txt')
+            with open(filename, 'wb') as file_:
+                file_.write(data)
+            self.addCleanup(os.remove, filename)
+
+            with self.assertRaises(UserError):
+                Report.import_files(company, ['../111.txt'])
+            # The declarant is not the company
+            with self.assertRaisesRegex(UserError, 'B12345674'):
+                Report.import_files(other, ['111.txt'])
+            self.assertEqual(
+                Report.search([('company', '=', other.id)]), [])
+            Report.import_files(company, ['111.txt'])
+            Report.import_files(company, ['111.txt'])
+
+            imported, = Report.search([('company', '=', company.id)])
+            self.assertEqual(imported.state, 'done')
+            self.assertEqual(imported.file_, data)
+            for name, value in values.items():
+                self.assertEqual(getattr(imported, name), value, name)
+
+    @with_transaction()
+    def test_simulate_current_mappings(self):
+        "Test simulating the current mappings gives the calculated totals"
+        pool = Pool()
+        Report = pool.get('aeat.111.report')
+        Mapping = pool.get('aeat.111.mapping')
+        Party = pool.get('party.party')
+
+        company = create_company()
+        with set_company(company):
+            period, journal, expense, payable = self.create_ledger(company)
+            mapping, = Mapping.search([
+                    ('company', '=', company.id),
+                    ('aeat111_field.name', '=',
+                        'work_productivity_monetary_payments'),
+                    ])
+            Mapping.write([mapping], {
+                    'debit_credit_type': 'both',
+                    'account': [('add', [payable.id])],
+                    })
+            for name, amount in [("Employee", 100), ("Other", 30)]:
+                party = Party(name=name)
+                party.save()
+                self.post_move(
+                    period, journal, expense, payable, party,
+                    Decimal(amount))
+            report = self.create_ledger_report(company, period)
+            Report.calculate([report])
+            mappings = Report._get_mappings(company)
+
+            result, = Report.simulate_mappings([report], [mappings])
+
+            self.assertEqual(result[report.id], {
+                    'work_productivity_monetary_payments': (
+                        report.work_productivity_monetary_payments),
+                    'work_productivity_monetary_parties': (
+                        report.work_productivity_monetary_parties),
+                    'economic_activities_productivity_monetary_parties': 0,
+                    })
+
+    @with_transaction()
+    def test_calculate_chunks_mixed_sign(self):
+        "Test chunks splitting the lines of a party give the same register"
+        pool = Pool()
+        Report = pool.get('aeat.111.report')
+        Party = pool.get('party.party')
+        Move = pool.get('account.move')
+        Mapping = pool.get('aeat.111.mapping')
+        Chunk = pool.get('aeat.111.report.calculation.chunk')
+
+        company = create_company()
+        with set_company(company):
+            period, journal, expense, payable = self.create_ledger(company)
+            mapping, = Mapping.search([('account', '=', expense.id)])
+            mapping.debit_credit_type = 'both'
+            mapping.save()
+            party = Party(name="Employee")
+            party.save()
+            for debit, credit in [(5, 0), (0, 3), (1, 0)]:
+                move, = Move.create([{
+                            'period': period.id,
+                            'journal': journal.id,
+                            'date': period.start_date,
+                            'lines': [('create', [{
+                                            'account': expense.id,
+                                            'debit': Decimal(debit),
+                                            'credit': Decimal(credit),
+                                            }, {
+                                            'account': payable.id,
+                                            'debit': Decimal(credit),
+                                            'credit': Decimal(debit),
+                                            'party': party.id,
+                                            }])],
+                            }])
+                Move.post([move])
+            report = self.create_ledger_report(company, period)
+            mapping_accounts, _ = Report._get_mappings(company)
+            field, debit_credit_type = mapping_accounts[expense.id]
+
+            accumulators = {}
+            with Transaction().set_context(periods=[period.id]):
+                Report._calculate_account_registers(company.id, expense.id,
+                    field, debit_credit_type, [period.id], accumulators)
+            (_, accumulator), = accumulators.items()
+            self.assertEqual(accumulator.amount, Decimal(3))
+
+            self.set_config('calculation_chunk_size', '1')
+            sources = report._get_calculation_sources(
+                mapping_accounts, {}, [period.id])
+            self.assertEqual(len(sources), 3)
+            for source, start, end in sources:
+                chunk_accumulators = {}
+                with Transaction().set_context(periods=[period.id]):
+                    Report._calculate_account_registers(company.id,
+                        expense.id, field, debit_credit_type, [period.id],
+                        chunk_accumulators, lines=(start, end))
+                Chunk.create([{
+                            'report': report.id,
+                            'source': source,
+                            'start': start,
+                            'registers': Chunk.dump_accumulators(
+                                chunk_accumulators),
+                            }])
+            merged = {}
+            for chunk in Chunk.search([('report', '=', report.id)]):
+                Chunk.load_accumulators(chunk.registers, 2, merged)
+            (_, accumulator), = merged.items()
+            self.assertEqual(accumulator.amount, Decimal(3))
+            self.assertEqual(len(accumulator.lines), 3)
+
+    @unittest.skipIf(backend.name != 'sqlite', "The replica is a file")
+    @with_transaction()
+    def test_calculate_from_replica(self):
+        "Test calculating reads the ledger from the replica"
+        pool = Pool()
+        Report = pool.get('aeat.111.report')
+        Party = pool.get('party.party')
+        transaction = Transaction()
+
+        company = create_company()
+        with set_company(company):
+            period, journal, expense, payable = self.create_ledger(company)
+            party = Party(name="Employee")
+            party.save()
+            self.post_move(
+                period, journal, expense, payable, party, Decimal(100))
+
+            directory = tempfile.TemporaryDirectory()
+            self.addCleanup(directory.cleanup)
+            path = os.path.join(directory.name, 'replica.sqlite')
+            database_path = config.get('database', 'path')
+            config.set('database', 'path', directory.name)
+            self.addCleanup(config.set, 'database', 'path', database_path)
+            self.addCleanup(Pool.stop, 'replica')
+            # The backup API waits for the transaction to end
+            replica = sqlite3.connect(path)
+            replica.executescript(
+                '\n'.join(transaction.connection.iterdump()))
+            replica.close()
+            # Not yet replicated
+            self.post_move(
+                period, journal, expense, payable, party, Decimal(50))
+
+            self.set_config('replica_database', 'replica')
+            report = self.create_ledger_report(company, period)
+            Report.calculate([report])
+            self.assertEqual(
+                report.work_productivity_monetary_payments, Decimal(100))
+            register, = report.registers
+            self.assertEqual(len(register.move_lines), 1)
+
+            config.set('aeat_111', 'replica_database', '')
+            Report.draft([report])
+            Report.calculate([report])
+            self.assertEqual(
+                report.work_productivity_monetary_payments, Decimal(150))
+
+    @with_transaction()
+    def test_history_rounding(self):
+        "Test the history compares the amounts rounded to the currency"
+        pool = Pool()
+        History = pool.get('aeat.111.report.history')
+        Party = pool.get('party.party')
+
+        company = create_company()
+        with set_company(company):
+            period, journal, expense, payable = self.create_ledger(company)
+            party = Party(name="Employee")
+            party.save()
+            for amount in [Decimal('0.10'), Decimal('0.20')]:
+                self.post_move(
+                    period, journal, expense, payable, party, amount)
+            report = self.create_ledger_report(company, period,
+                state='calculated',
+                work_productivity_monetary_payments=Decimal('0.30'))
+            history = History(
+                company=company,
+                start_year=report.year,
+                end_year=report.year)
+
+            lines = history._compute_lines()
+
+            self.assertEqual(
+                [(l.field.name, l.stored_amount, l.computed_amount)
+                    for l in lines
+                    if l.field.name == 'work_productivity_monetary_payments'],
+                [])
+
+
+class Aeat111CommitTestCase(ReportTestMixin, DBTestCase):
+    '''
+    Test Aeat 111 module committing transactions
+
+    The committed records are kept in a database of their own which is
+    dropped once the tests are done so they do not leak into the other tests.
+    '''
+    module = 'aeat_111'
+
+    @with_transaction()
+    def test_calculation_cache_miss(self):
+        "Test calculating reads the ledger changed since the last calculation"
+        pool = Pool()
+        Report = pool.get('aeat.111.report')
+        Move = pool.get('account.move')
+        Party = pool.get('party.party')
+
+        company = create_company()
+        with set_company(company):
+            period, journal, expense, payable = self.create_ledger(company)
+            party = Party(name="Employee")
+            party.save()
+            move = self.post_move(
+                period, journal, expense, payable, party, Decimal(100))
+            first = self.create_ledger_report(company, period)
+            Report.calculate([first])
+
+            # A new move of the period
+            self.post_move(
+                period, journal, expense, payable, party, Decimal(50))
+            second = self.create_ledger_report(company, period)
+            Report.calculate([second])
+            self.assertEqual(second.work_productivity_monetary_payments,
+                Decimal(150))
+
+            # A new origin of a move of the period
+            mapping_accounts, mapping_codes = Report._get_mappings(company)
+            periods = [period.id]
+            fingerprint = Report._get_calculation_fingerprint(
+                company.id, mapping_accounts, mapping_codes, periods)
+            draft, = Move.create([{
+                        'period': period.id,
+                        'journal': journal.id,
+                        'date': period.start_date,
+                        }])
+            fingerprint_created = Report._get_calculation_fingerprint(
+                company.id, mapping_accounts, mapping_codes, periods)
+            # The modifications are timestamped by transaction
+            Transaction().commit()
+            Move.write([draft], {'origin': str(move)})
+            self.assertNotEqual(fingerprint_created, fingerprint)
+            self.assertNotEqual(Report._get_calculation_fingerprint(
+                    company.id, mapping_accounts, mapping_codes, periods),
+                fingerprint_created)
+
+    @with_transaction()
+    def test_stale(self):
+        "Test reports are stale when their ledger changes"
+        pool = Pool()
+        Report = pool.get('aeat.111.report')
+        LedgerChange = pool.get('aeat.111.ledger.change')
+        Party = pool.get('party.party')
+
+        company = create_company()
+        with set_company(company):
+            period, journal, expense, payable = self.create_ledger(company)
+            party = Party(name="Employee")
+            party.save()
+            self.post_move(
+                period, journal, expense, payable, party, Decimal(100))
+            report = self.create_ledger_report(company, period)
+            other = self.create_report(company,
+                year=period.start_date.year, period='4T')
+            Report.calculate([report, other])
+            self.assertFalse(report.stale)
+            LedgerChange.prune()
+            self.assertEqual(
+                LedgerChange.search([('period', '=', period.id)]), [])
+            # The changes are timestamped by transaction
+            Transaction().commit()
+
+            self.post_move(
+                period, journal, expense, payable, party, Decimal(50))
+            self.post_move(
+                period, journal, expense, payable, party, Decimal(20))
+            self.assertTrue(Report(report.id).stale)
+            self.assertFalse(Report(other.id).stale)
+            self.assertEqual(Report.search([
+                        ('company', '=', company.id),
+                        ('stale', '=', True),
+                        ]), [report])
+            self.assertEqual(Report.search([
+                        ('company', '=', company.id),
+                        ('stale', '=', False),
+                        ]), [other])
+            LedgerChange.prune()
+            self.assertEqual(
+                len(LedgerChange.search([('period', '=', period.id)])), 1)
+            self.assertTrue(Report(report.id).stale)
+
+            Report.draft([report])
+            Report.calculate([report])
+            self.assertFalse(Report(report.id).stale)
+            LedgerChange.prune()
+            self.assertEqual(
+                LedgerChange.search([('period', '=', period.id)]), [])
+
+    @with_transaction()
+    def test_stale_calculation_date(self):
+        "Test the calculation date is the start of the transaction"
+        pool = Pool()
+        Report = pool.get('aeat.111.report')
+        Party = pool.get('party.party')
+
+        company = create_company()
+        with set_company(company):
+            period, journal, expense, payable = self.create_ledger(company)
+            party = Party(name="Employee")
+            party.save()
+            report = self.create_ledger_report(company, period)
+            Transaction().commit()
+            # Posted while the report is calculated
+            self.post_move(
+                period, journal, expense, payable, party, Decimal(100))
+            before = datetime.datetime.now()
+
+            Report.calculate([report])
+
+            self.assertLess(report.calculation_date, before)
+            self.assertFalse(report.stale)
+
+    @with_transaction()
+    def test_calculate_chunked_resume(self):
+        "Test an interrupted chunked calculation resumes from the last chunk"
+        pool = Pool()
+        Report = pool.get('aeat.111.report')
+        Party = pool.get('party.party')
+
+        self.set_config('calculation_chunk_size', '2')
+        company = create_company()
+        with set_company(company):
+            period, journal, expense, payable = self.create_ledger(company)
+            party = Party(name="Employee")
+            party.save()
+            for amount in [1, 2, 3, 4, 5]:
+                self.post_move(
+                    period, journal, expense, payable, party, Decimal(amount))
+            report = self.create_ledger_report(company, period)
+            self.assertEqual(len(report._get_calculation_sources(
+                        *Report._get_mappings(company), [period.id])), 3)
+            # Each chunk is calculated by its own transaction
+            Transaction().commit()
+
+            calculate_account_registers = Report._calculate_account_registers
+            computed = []
+
+            def interrupt(*args, **kwargs):
+                if len(computed) == 2:
+                    raise KeyboardInterrupt
+                computed.append(kwargs['lines'])
+                return calculate_account_registers(*args, **kwargs)
+            with patch.object(Report, '_calculate_account_registers',
+                    side_effect=interrupt):
+                with self.assertRaises(KeyboardInterrupt):
+                    Report.calculate_chunked([report])
+
+            def resume(*args, **kwargs):
+                computed.append(kwargs['lines'])
+                return calculate_account_registers(*args, **kwargs)
+            with patch.object(Report, '_calculate_account_registers',
+                    side_effect=resume):
+                Report.calculate_chunked([Report(report.id)])
+
+            # Each chunk is computed only once
+            self.assertEqual(len(computed), 3)
+            self.assertEqual(len(set(computed)), 3)
+            # The report is calculated by other transactions
+            with Transaction().new_transaction():
+                report = Report(report.id)
+                self.assertEqual(report.state, 'calculated')
+                self.assertEqual(
+                    report.work_productivity_monetary_payments, Decimal(15))
+                register, = report.registers
+                self.assertEqual(register.amount, Decimal(15))
+                self.assertEqual(len(register.move_lines), 5)
+
+    @with_transaction()
+    def test_calculate_chunked_retries(self):
+        "Test a chunked calculation gives up when the ledger keeps changing"
+        pool = Pool()
+        Report = pool.get('aeat.111.report')
+
+        self.set_config('calculation_retries', '2')
+        company = create_company()
+        with set_company(company):
+            period, *_ = self.create_ledger(company)
+            report = self.create_ledger_report(company, period)
+            # Each chunk is calculated by its own transaction
+            Transaction().commit()
+
+            with patch.object(Report, '_get_calculation_chunks',
+                    return_value={}) as get_chunks, \
+                    self.assertRaises(UserError):
+                Report.calculate_chunked([report])
+            # The chunks are checked before each of their calculation
+            self.assertEqual(get_chunks.call_count, 3 * 2)
+
+    @with_transaction()
+    def test_history_failure(self):
+        "Test a failing history is marked as failed without the others"
+        pool = Pool()
+        History = pool.get('aeat.111.report.history')
+        transaction = Transaction()
+
+        company = create_company()
+        with set_company(company):
+            history, = History.create([{
+                        'start_year': 2024,
+                        'end_year': 2024,
+                        }])
+            History.run([history])
+
+            other, = History.create([{
+                        'start_year': 2023,
+                        'end_year': 2023,
+                        }])
+            History.run([other])
+            # Each history is computed by its own transaction
+            transaction.commit()
+
+            def compute_lines(self):
+                if self == history:
+                    raise UserError("Broken")
+                return []
+            with patch.object(History, '_compute_lines', compute_lines):
+                History.compute([history, other])
+
+            history = History(history.id)
+            self.assertEqual(history.state, 'failed')
+            self.assertEqual(history.error, "Broken")
+            self.assertEqual(History(other.id).state, 'done')
+
+            History.draft([history])
+            self.assertEqual(history.state, 'draft')
+            self.assertEqual(history.error, None)
+
+    @with_transaction()
+    def test_history_unexpected_error(self):
+        "Test an unexpected error of a history is raised to the queue"
+        pool = Pool()
+        History = pool.get('aeat.111.report.history')
+        transaction = Transaction()
+
+        company = create_company()
+        with set_company(company):
+            history, = History.create([{
+                        'start_year': 2024,
+                        'end_year': 2024,
+                        }])
+            History.run([history])
+            # Each history is computed by its own transaction
+            transaction.commit()
+
+            with patch.object(History, '_compute_lines',
+                    side_effect=ValueError("Broken")), \
+                    self.assertRaises(ValueError):
+                History.compute([history])
+
+            self.assertEqual(History(history.id).state, 'running')
+
+    @with_transaction()
+    def test_history_overwrite(self):
+        "Test overwriting a history recalculates the calculated reports"
+        pool = Pool()
+        History = pool.get('aeat.111.report.history')
+        Line = pool.get('aeat.111.report.history.line')
+        Report = pool.get('aeat.111.report')
+        Field = pool.get('ir.model.field')
+
+        company = create_company()
+        with set_company(company):
+            calculated = self.create_report(company)
+            done = self.create_report(company, period='02')
+            Report.write([calculated], {'state': 'calculated'})
+            Report.write([done], {'state': 'done'})
+            field, = Field.search([
+                    ('model', '=', 'aeat.111.report'),
+                    ('name', '=',
+                        'work_productivity_monetary_withholdings_amount'),
+                    ])
+            history, = History.create([{
+                        'start_year': 2024,
+                        'end_year': 2024,
+                        'overwrite': True,
+                        }])
+            History.run([history])
+            # Each history is computed by its own transaction
+            Transaction().commit()
+
+            def compute_lines(self):
+                return [Line(history=self, report=r, field=field,
+                        stored_amount=Decimal(0),
+                        computed_amount=Decimal(10))
+                    for r in [calculated, done]]
+            with patch.object(History, '_compute_lines', compute_lines), \
+                    patch.object(Report, 'calculate') as calculate:
+                History.compute([history])
+
+            history = History(history.id)
+            self.assertEqual(history.state, 'done')
+            self.assertEqual(len(history.lines), 2)
+            calculate.assert_called_once_with([calculated])
+            self.assertEqual(Report(done.id).state, 'done')
+
+
+del DBTestCase, ModuleTestCase
@@ -0,0 +1,308 @@
+# This file is part aeat_111 module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import sqlite3
+import threading
+import unittest
+from decimal import Decimal
+from unittest.mock import patch
+
+from proteus import Model
+from trytond import backend
+from trytond.modules.account.tests.tools import (
+    create_chart, create_fiscalyear, get_accounts)
+from trytond.modules.account_invoice.tests.tools import (
+    set_fiscalyear_invoice_sequences)
+from trytond.modules.company.tests.tools import create_company, get_company
+from trytond.pool import Pool
+from trytond.tests.test_tryton import drop_db
+from trytond.tests.tools import activate_modules
+from trytond.transaction import Transaction, TransactionError
+
+
+LEDGER_TABLES = {
+    'account_move', 'account_move_line', 'account_tax_line',
+    'account_invoice', 'account_invoice_line', 'account_invoice_tax',
+    }
+
+
+class Test(unittest.TestCase):
+    "Calculation against concurrent transactions"
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        drop_db()
+        cls.addClassCleanup(drop_db)
+        cls.config = activate_modules(['aeat_111'])
+
+        _ = create_company()
+        company = get_company()
+        fiscalyear = set_fiscalyear_invoice_sequences(
+            create_fiscalyear(company))
+        fiscalyear.click('create_period')
+        cls.periods = list(fiscalyear.periods)
+        _ = create_chart(company)
+        cls.accounts = get_accounts(company)
+
+        Party = Model.get('party.party')
+        cls.party = Party(name='Employee')
+        cls.party.save()
+
+        Journal = Model.get('account.journal')
+        cls.journal, = Journal.find([('code', '=', 'EXP')])
+
+        Field = Model.get('ir.model.field')
+        Mapping = Model.get('aeat.111.mapping')
+        field, = Field.find([
+                ('model', '=', 'aeat.111.report'),
+                ('name', '=', 'work_productivity_monetary_payments'),
+                ])
+        mapping = Mapping(type_='account', debit_credit_type='debit',
+            aeat111_field=field)
+        mapping.account.append(Model.get('account.account')(
+                cls.accounts['expense'].id))
+        mapping.save()
+
+    def create_report(self, period):
+        "Post the moves of the period and return its report"
+        Move = Model.get('account.move')
+        for _ in range(10):
+            move = Move(period=period, journal=self.journal,
+                date=period.start_date)
+            move.lines.new(account=self.accounts['expense'],
+                debit=Decimal(1000))
+            move.lines.new(account=self.accounts['payable'],
+                credit=Decimal(1000), party=self.party)
+            move.click('post')
+
+        Report = Model.get('aeat.111.report')
+        report = Report(year=period.start_date.year, type='I',
+            period='%02d' % period.start_date.month)
+        report.save()
+        return report
+
+    def test_ledger_access(self):
+        "Calculation only reads the ledger"
+        config = self.config
+        report = self.create_report(self.periods[0])
+
+        written, locked = [], []
+
+        def authorizer(action, table, *args):
+            if action in {sqlite3.SQLITE_INSERT, sqlite3.SQLITE_UPDATE,
+                    sqlite3.SQLITE_DELETE} and table in LEDGER_TABLES:
+                written.append(table)
+            return sqlite3.SQLITE_OK
+
+        with Transaction().start(config.database_name, config.user,
+                context=config.context) as transaction:
+            pool = Pool()
+            Report = pool.get('aeat.111.report')
+            ledger = [pool.get(n) for n in [
+                    'account.move', 'account.move.line', 'account.tax.line',
+                    'account.invoice']]
+
+            def lock(cls, records=None):
+                locked.append(cls.__name__)
+            connection = transaction.connection
+            if backend.name == 'sqlite':
+                connection.set_authorizer(authorizer)
+            patches = [patch.object(M, 'lock', classmethod(lock))
+                for M in ledger]
+            for patch_ in patches:
+                patch_.start()
+            try:
+                report = Report(report.id)
+                Report.calculate([report])
+                self.assertEqual(report.work_productivity_monetary_payments,
+                    Decimal('10000.00'))
+            finally:
+                for patch_ in patches:
+                    patch_.stop()
+                if backend.name == 'sqlite':
+                    connection.set_authorizer(None)
+            transaction.rollback()
+
+        self.assertEqual(written, [])
+        self.assertEqual(locked, [])
+
+    @unittest.skipIf(backend.name != 'postgresql',
+        "SQLite serializes all writers")
+    def test_concurrent_posting(self):
+        "Calculation does not block concurrent posting"
+        workers, moves_per_worker = 4, 10
+        config, period = self.config, self.periods[1]
+        journal, accounts, party = self.journal, self.accounts, self.party
+        report = self.create_report(period)
+        Move = Model.get('account.move')
+
+        database_name = config.database_name
+        user, context = config.user, config.context
+        report_id, journal_id, period_id = report.id, journal.id, period.id
+        account_ids = accounts['expense'].id, accounts['payable'].id
+        date, party_id = period.start_date, party.id
+
+        calculated = threading.Event()
+        posted = threading.Event()
+        errors = []
+
+        def calculate():
+            try:
+                with Transaction().start(
+                        database_name, user, context=context) as transaction:
+                    Report = Pool().get('aeat.111.report')
+                    Report.calculate([Report(report_id)])
+                    calculated.set()
+                    # Keep the calculation transaction open while posting
+                    if not posted.wait(60):
+                        errors.append('posting blocked by calculation')
+                    transaction.commit()
+            except Exception as e:
+                errors.append(e)
+                calculated.set()
+
+        def post():
+            extras = {}
+            posted_moves = 0
+            while posted_moves < moves_per_worker:
+                try:
+                    with Transaction().start(database_name, user,
+                            context=context, **extras) as transaction:
+                        try:
+                            cursor = transaction.connection.cursor()
+                            cursor.execute("SET LOCAL lock_timeout = '5s'")
+                            Move = Pool().get('account.move')
+                            move, = Move.create([{
+                                        'journal': journal_id,
+                                        'period': period_id,
+                                        'date': date,
+                                        'lines': [('create', [{
+                                                        'account': (
+                                                            account_ids[0]),
+                                                        'debit': Decimal(10),
+                                                        }, {
+                                                        'account': (
+                                                            account_ids[1]),
+                                                        'credit': (
+                                                            Decimal(10)),
+                                                        'party': party_id,
+                                                        }])],
+                                        }])
+                            Move.post([move])
+                            transaction.commit()
+                        except TransactionError as e:
+                            # Locks are taken when the transaction starts
+                            transaction.rollback()
+                            e.fix(extras)
+                            continue
+                except backend.DatabaseOperationalError as e:
+                    # Workers may conflict between them on the move sequence
+                    # but must never wait for the calculation
+                    if 'lock timeout' in str(e):
+                        errors.append(e)
+                        return
+                    continue
+                posted_moves += 1
+                extras = {}
+
+        calculation = threading.Thread(target=calculate)
+        calculation.start()
+        self.assertTrue(calculated.wait(60))
+        threads = [threading.Thread(target=post)
+            for _ in range(workers)]
+        for worker in threads:
+            worker.start()
+        for worker in threads:
+            worker.join()
+        posted.set()
+        calculation.join()
+
+        self.assertEqual(errors, [])
+        report.reload()
+        self.assertEqual(report.state, 'calculated')
+        self.assertEqual(
+            report.work_productivity_monetary_payments, Decimal('10000.00'))
+        self.assertEqual(len(Move.find([
+                        ('period', '=', period.id),
+                        ('state', '=', 'posted'),
+                        ])),
+            10 + workers * moves_per_worker)
+
+    @unittest.skipIf(backend.name != 'postgresql',
+        "SQLite serializes all writers")
+    def test_stale(self):
+        "Posting committed after the calculation makes the report stale"
+        config, period = self.config, self.periods[2]
+        journal, accounts, party = self.journal, self.accounts, self.party
+        report = self.create_report(period)
+
+        database_name = config.database_name
+        user, context = config.user, config.context
+        report_id, journal_id, period_id = report.id, journal.id, period.id
+        account_ids = accounts['expense'].id, accounts['payable'].id
+        date, party_id = period.start_date, party.id
+
+        posted = threading.Event()
+        calculated = threading.Event()
+        errors = []
+
+        def post():
+            extras = {}
+            try:
+                while True:
+                    with Transaction().start(database_name, user,
+                            context=context, **extras) as transaction:
+                        try:
+                            Move = Pool().get('account.move')
+                            move, = Move.create([{
+                                        'journal': journal_id,
+                                        'period': period_id,
+                                        'date': date,
+                                        'lines': [('create', [{
+                                                        'account': (
+                                                            account_ids[0]),
+                                                        'debit': Decimal(10),
+                                                        }, {
+                                                        'account': (
+                                                            account_ids[1]),
+                                                        'credit': (
+                                                            Decimal(10)),
+                                                        'party': party_id,
+                                                        }])],
+                                        }])
+                            Move.post([move])
+                        except TransactionError as e:
+                            # Locks are taken when the transaction starts
+                            transaction.rollback()
+                            e.fix(extras)
+                            continue
+                        posted.set()
+                        # Commit once the report is calculated
+                        if not calculated.wait(60):
+                            errors.append('calculation blocked by posting')
+                        transaction.commit()
+                        break
+            except Exception as e:
+                errors.append(e)
+                posted.set()
+
+        posting = threading.Thread(target=post)
+        posting.start()
+        self.assertTrue(posted.wait(60))
+        with Transaction().start(
+                database_name, user, context=context) as transaction:
+            Report = Pool().get('aeat.111.report')
+            Report.calculate([Report(report_id)])
+            transaction.commit()
+        calculated.set()
+        posting.join()
+
+        self.assertEqual(errors, [])
+        with Transaction().start(
+                database_name, user, context=context) as transaction:
+            Report = Pool().get('aeat.111.report')
+            report = Report(report_id)
+            self.assertEqual(report.work_productivity_monetary_payments,
+                Decimal('10000.00'))
+            self.assertTrue(report.stale)